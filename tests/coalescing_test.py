@@ -0,0 +1,177 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+import threading
+import numpy as np
+
+from volumina.config import cfg
+from volumina.slicingtools import sl
+from volumina.pixelpipeline.datasources import ArraySource, MinMaxSource
+from volumina.pixelpipeline.coalescing import RequestCoalescer, SharedRequest
+
+
+class _CountingRequest( object ):
+    def __init__( self, request ):
+        self._request = request
+        self.waited = 0
+        self.notified = 0
+        self.cancelled = 0
+
+    def wait( self ):
+        self.waited += 1
+        return self._request.wait()
+
+    def getResult( self ):
+        return self._request.getResult()
+
+    def cancel( self ):
+        self.cancelled += 1
+
+    def submit( self ):
+        pass
+
+    def notify( self, callback, **kwargs ):
+        self.notified += 1
+        self._request.notify(callback, **kwargs)
+
+class _CountingSource( ArraySource ):
+    def __init__( self, array ):
+        super(_CountingSource, self).__init__(array)
+        self.requests = []
+
+    def request( self, slicing ):
+        req = _CountingRequest(super(_CountingSource, self).request(slicing))
+        self.requests.append(req)
+        return req
+
+class _FailingRequest( _CountingRequest ):
+    def wait( self ):
+        self.waited += 1
+        raise RuntimeError('failed')
+
+class RequestCoalescerTest( ut.TestCase ):
+    def setUp( self ):
+        self.data = np.random.randint(0, 255, (1,20,20,3,1)).astype(np.uint8)
+        self.source = _CountingSource(self.data)
+        self.coalescer = RequestCoalescer()
+        self.slicing = sl[0:1, 0:10, 5:15, 1:2, 0:1]
+
+    def testInFlightRequestsAreShared( self ):
+        requests = [self.coalescer.request(self.source, self.slicing) for i in range(3)]
+        self.assertEqual( len(self.source.requests), 1 )
+        for req in requests:
+            self.assertTrue( np.all(req.wait() == self.data[self.slicing]) )
+        self.assertEqual( self.source.requests[0].waited, 1 )
+        self.assertEqual( self.coalescer.statistics(),
+                          {'requests': 3, 'coalesced': 2, 'inFlight': 0} )
+
+        # finished requests are not reused
+        self.coalescer.request(self.source, self.slicing)
+        self.assertEqual( len(self.source.requests), 2 )
+
+    def testOtherRegionsAndSources( self ):
+        self.coalescer.request(self.source, self.slicing)
+        self.coalescer.request(self.source, sl[0:1, 0:10, 5:15, 2:3, 0:1])
+        self.coalescer.request(self.source, sl[0:1, 0:10:2, 5:15, 1:2, 0:1])
+        other = _CountingSource(self.data)
+        self.coalescer.request(other, self.slicing)
+        self.assertEqual( len(self.source.requests), 3 )
+        self.assertEqual( len(other.requests), 1 )
+        self.assertEqual( self.coalescer.statistics()['coalesced'], 0 )
+
+    def testCancel( self ):
+        a = self.coalescer.request(self.source, self.slicing)
+        b = self.coalescer.request(self.source, self.slicing)
+        a.cancel()
+        self.assertEqual( self.source.requests[0].cancelled, 0 )
+        self.assertTrue( np.all(b.wait() == self.data[self.slicing]) )
+
+        c = self.coalescer.request(self.source, self.slicing)
+        c.cancel()
+        self.assertEqual( self.source.requests[1].cancelled, 1 )
+        # cancelled requests are not reused
+        self.coalescer.request(self.source, self.slicing)
+        self.assertEqual( len(self.source.requests), 3 )
+
+    def testCancelledRequestsGetNoConsumers( self ):
+        shared = SharedRequest(_CountingRequest(self.source.request(self.slicing)))
+        view = shared.view()
+        view.cancel()
+        self.assertTrue( shared.done )
+        self.assertFalse( shared.share() )
+        self.assertEqual( shared.view(), None )
+
+    def testDirtyRegionsAreNotCoalesced( self ):
+        a = self.coalescer.request(self.source, self.slicing)
+        self.source.setDirty(sl[0:1, 5:6, 10:11, 1:2, 0:1])
+        b = self.coalescer.request(self.source, self.slicing)
+        self.assertEqual( len(self.source.requests), 2 )
+        self.assertEqual( self.coalescer.statistics()['coalesced'], 0 )
+
+        # other regions stay in flight
+        self.source.setDirty(sl[0:1, 10:20, 0:20, 0:3, 0:1])
+        c = self.coalescer.request(self.source, self.slicing)
+        self.assertEqual( len(self.source.requests), 2 )
+        for req in (a, b, c):
+            self.assertTrue( np.all(req.wait() == self.data[self.slicing]) )
+
+    def testFailedRequestsAreNotReused( self ):
+        self.source.request = lambda slicing: _FailingRequest(None)
+        a = self.coalescer.request(self.source, self.slicing)
+        self.assertRaises( RuntimeError, a.wait )
+        self.assertEqual( self.coalescer.statistics()['inFlight'], 0 )
+        del self.source.request
+        b = self.coalescer.request(self.source, self.slicing)
+        self.assertTrue( np.all(b.wait() == self.data[self.slicing]) )
+        self.assertEqual( self.coalescer.statistics()['coalesced'], 0 )
+
+    def testNotify( self ):
+        results = {}
+        done = threading.Event()
+        def store( result, consumer ):
+            results[consumer] = result
+            if len(results) == 3:
+                done.set()
+        for consumer in range(3):
+            self.coalescer.request(self.source, self.slicing).notify(store, consumer=consumer)
+        done.wait(5)
+        self.assertEqual( sorted(results), [0, 1, 2] )
+        for result in results.values():
+            self.assertTrue( np.all(result == self.data[self.slicing]) )
+        self.assertEqual( len(self.source.requests), 1 )
+        self.assertEqual( self.source.requests[0].notified, 1 )
+
+    def testMinMaxSourcesShareRawRequests( self ):
+        layers = [MinMaxSource(self.source), MinMaxSource(self.source)]
+        requests = [mm.request(self.slicing) for mm in layers]
+        self.assertEqual( len(self.source.requests), 1 )
+        for mm, req in zip(layers, requests):
+            req.wait()
+            self.assertEqual( list(mm._bounds), [self.data[self.slicing].min(), self.data[self.slicing].max()] )
+
+    def testDisabled( self ):
+        cfg.set('pixelpipeline', 'coalesce_requests', 'false')
+        try:
+            self.coalescer.request(self.source, self.slicing)
+            self.coalescer.request(self.source, self.slicing)
+        finally:
+            cfg.set('pixelpipeline', 'coalesce_requests', 'true')
+        self.assertEqual( len(self.source.requests), 2 )
+
+
+if __name__ == '__main__':
+    ut.main()
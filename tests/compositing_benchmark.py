@@ -0,0 +1,54 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''
+Compares the tile compositing backends of volumina.compositing.
+
+usage: python compositing_benchmark.py [n_layers] [repetitions]
+'''
+
+import sys
+import time
+from PyQt4.QtCore import QSize
+
+from volumina.compositing import QPainterCompositor, NumpyCompositor, _has_numexpr
+from compositing_test import randomLayers
+
+
+def timeit( compositor, size, layers, repetitions ):
+    best = float('inf')
+    for i in xrange(repetitions):
+        canvas = compositor.newCanvas(QSize(size, size))
+        start = time.time()
+        compositor.blend(canvas, layers)
+        best = min(best, time.time() - start)
+    return best
+
+if __name__ == '__main__':
+    n_layers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    backends = [('qpainter', QPainterCompositor()),
+                ('numpy', NumpyCompositor(use_numexpr=False))]
+    if _has_numexpr:
+        backends.append(('numexpr', NumpyCompositor(use_numexpr=True)))
+
+    print "%d layers, best of %d" % (n_layers, repetitions)
+    for size in (256, 512):
+        layers = randomLayers(size, n_layers)
+        for name, compositor in backends:
+            t = timeit(compositor, size, layers, repetitions)
+            print "  %3dx%3d %-9s %7.2f ms" % (size, size, name, 1000*t)
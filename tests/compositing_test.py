@@ -0,0 +1,79 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+import numpy as np
+from PyQt4.QtCore import QSize
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view, array2qimage
+
+from volumina.compositing import QPainterCompositor, NumpyCompositor, createCompositor, _has_numexpr
+
+
+def randomLayers( size, n, seed=0 ):
+    rng = np.random.RandomState(seed)
+    layers = []
+    for i in range(n):
+        rgba = rng.randint(0, 256, (size, size, 4)).astype(np.uint8)
+        # a fully transparent and a fully opaque region
+        rgba[:size//4, :, 3] = 0
+        rgba[-size//4:, :, 3] = 255
+        qimg = array2qimage(rgba).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        layers.append((rng.uniform(0.1, 1.0), qimg))
+    return layers
+
+def composite( compositor, size, layers ):
+    canvas = compositor.newCanvas(QSize(size, size))
+    compositor.blend(canvas, layers)
+    return byte_view(canvas).astype(np.int32)
+
+
+class CompositorTest( ut.TestCase ):
+    SIZE = 64
+
+    def _check( self, compositor ):
+        layers = randomLayers(self.SIZE, 4)
+        expected = composite(QPainterCompositor(), self.SIZE, layers)
+        result = composite(compositor, self.SIZE, layers)
+        # QPainter rounds after every layer, the NumPy backend only once
+        self.assertTrue( np.abs(result - expected).max() <= len(layers) )
+
+    def testNumpy( self ):
+        self._check( NumpyCompositor(use_numexpr=False) )
+
+    def testNumexpr( self ):
+        if not _has_numexpr:
+            import nose
+            raise nose.SkipTest
+        self._check( NumpyCompositor(use_numexpr=True) )
+
+    def testNonPremultipliedPatch( self ):
+        opacity, patch = randomLayers(self.SIZE, 1)[0]
+        layers = [(opacity, patch.convertToFormat(QImage.Format_ARGB32))]
+        expected = composite(QPainterCompositor(), self.SIZE, layers)
+        result = composite(NumpyCompositor(use_numexpr=False), self.SIZE, layers)
+        self.assertTrue( np.abs(result - expected).max() <= 2 )
+
+    def testCreateCompositor( self ):
+        self.assertTrue( isinstance(createCompositor('numpy'), NumpyCompositor) )
+        c = QPainterCompositor()
+        self.assertTrue( createCompositor(c) is c )
+        with self.assertRaises(ValueError):
+            createCompositor('opengl')
+
+
+if __name__=='__main__':
+    ut.main()
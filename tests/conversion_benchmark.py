@@ -0,0 +1,98 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''
+Times the array to QImage converters of volumina.pixelpipeline.conversion.
+The grayscale converters of vigra and NumPy are compared, and rgba2argb()
+with the per channel conversion it replaced.
+
+usage: python conversion_benchmark.py [repetitions]
+'''
+
+import sys
+import time
+import numpy as np
+from PyQt4.QtGui import QImage
+from qimage2ndarray import array2qimage
+
+from volumina.pixelpipeline.conversion import gray2argb, rgba2argb, colortable2argb, _vigraHas
+
+
+def timeit( f, repetitions ):
+    best = float('inf')
+    for i in xrange(repetitions):
+        start = time.time()
+        f()
+        best = min(best, time.time() - start)
+    return best
+
+def channelwiseRgba( channels, normalize ):
+    '''The former conversion of RGBAImageRequest, for comparison.'''
+    data = np.empty(channels[0].shape + (4,), dtype=np.uint8)
+    for i, a in enumerate(channels):
+        n = normalize[i]
+        if n is not None and n[0] < n[1]:
+            a = a.astype(np.float32)
+            a = (a - n[0])*255.0 / (n[1]-n[0])
+            a[a > 255] = 255
+            a[a < 0]   = 0
+            a = a.astype(np.uint8)
+        data[:,:,i] = a
+    img = array2qimage(data)
+    return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    backends = [('numpy', False)]
+    if _vigraHas('gray2qimage_ARGB32Premultiplied'):
+        backends.append(('vigra', True))
+
+    rng = np.random.RandomState(0)
+    print "gray2argb, best of %d" % repetitions
+    for size in (256, 512):
+        out = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+        for dtype, high in ((np.uint8, 256), (np.uint16, 2**16), (np.float32, 1.0)):
+            a = (rng.uniform(0, high, (size, size))).astype(dtype)
+            normalize = (0, high) if dtype == np.float32 else (0, high-1)
+            for name, use_vigra in backends:
+                t = timeit(lambda: gray2argb(a, normalize, out=out, use_vigra=use_vigra), repetitions)
+                print "  %3dx%3d %-8s %-6s %7.2f ms" % (size, size, np.dtype(dtype).name, name, 1000*t)
+
+    colorTable = rng.randint(0, 256, (256, 4)).astype(np.uint8)
+    print "colortable2argb, best of %d" % repetitions
+    for size in (256, 512):
+        out = QImage(size, size, QImage.Format_ARGB32)
+        for dtype, normalize in ((np.uint8, None), (np.uint16, (0, 1000)), (np.uint32, None), (np.float32, (0, 1000))):
+            a = (rng.uniform(0, 1000, (size, size))).astype(dtype)
+            luts = {}
+            t = timeit(lambda: colortable2argb(a, colorTable, normalize, out=out, luts=luts), repetitions)
+            print "  %3dx%3d %-8s %-10s %7.2f ms" % (size, size, np.dtype(dtype).name, normalize, 1000*t)
+
+    print "rgba2argb, best of %d" % repetitions
+    for size in (256, 512):
+        out = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+        opaque = np.empty((size, size), dtype=np.uint8)
+        opaque[:] = 255
+        for dtype, high in ((np.uint8, 256), (np.uint16, 2**16), (np.float32, 1.0)):
+            channels = [(rng.uniform(0, high, (size, size))).astype(dtype) for i in range(4)]
+            for alpha, a in (('opaque', opaque), ('alpha', channels[3])):
+                c = channels[:3] + [a]
+                normalize = [(0, high)] * 3 + [None if a is opaque else (0, high)]
+                tFused = timeit(lambda: rgba2argb(c, normalize, out=out), repetitions)
+                tChannelwise = timeit(lambda: channelwiseRgba(c, normalize), repetitions)
+                print "  %3dx%3d %-8s %-6s fused %7.2f ms, channelwise %7.2f ms" \
+                    % (size, size, np.dtype(dtype).name, alpha, 1000*tFused, 1000*tChannelwise)
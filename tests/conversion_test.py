@@ -0,0 +1,214 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+import numpy as np
+from PyQt4.QtGui import QImage, QTransform
+from qimage2ndarray import raw_view, byte_view
+
+from volumina.pixelpipeline.conversion import gray2argb, rgba2argb, colortable2argb, axisOrientation, orient, orientedShape, _vigraHas
+
+
+def expectedGray( a, normalize ):
+    nmin, nmax = normalize
+    g = np.clip((a.astype(np.float64) - nmin) * 255.0 / (nmax - nmin), 0, 255).astype(np.uint8)
+    return g.astype(np.uint32) * 0x010101 | 0xff000000
+
+class Gray2ArgbTest( ut.TestCase ):
+    def setUp( self ):
+        rng = np.random.RandomState(0)
+        self.data = { np.uint8:   rng.randint(0, 256, (40, 30)).astype(np.uint8),
+                      np.uint16:  rng.randint(0, 2**16, (40, 30)).astype(np.uint16),
+                      np.float32: rng.uniform(-10, 300, (40, 30)).astype(np.float32) }
+
+    def _check( self, a, normalize, use_vigra=False, tolerance=0 ):
+        img = gray2argb(a, normalize, use_vigra=use_vigra)
+        self.assertEqual( img.format(), QImage.Format_ARGB32_Premultiplied )
+        self.assertEqual( (img.height(), img.width()), a.shape )
+        expected = expectedGray(a, normalize or (0, 255))
+        diff = np.abs((raw_view(img) & 0xff).astype(int) - (expected & 0xff).astype(int))
+        self.assertTrue( diff.max() <= tolerance )
+        self.assertTrue( np.all(raw_view(img) >> 24 == 0xff) )
+        self.assertTrue( np.all(raw_view(img) & 0xff == (raw_view(img) >> 8) & 0xff) )
+
+    def testLookupTable( self ):
+        for dtype in (np.uint8, np.uint16):
+            for normalize in (None, (0, 255), (10, 200), (100, 50000)):
+                self._check( self.data[dtype], normalize )
+
+    def testScaled( self ):
+        for normalize in (None, (-5.0, 250.0)):
+            self._check( self.data[np.float32], normalize )
+
+    def testEmptyNormalization( self ):
+        a = self.data[np.uint8]
+        self.assertTrue( np.all(raw_view(gray2argb(a, (0, 0))) == raw_view(gray2argb(a))) )
+
+    def testStridedInput( self ):
+        a = self.data[np.uint16]
+        self._check( a[::2, ::3], (0, 1000) )
+        self._check( a.T, (0, 1000) )
+
+    def testOut( self ):
+        a = self.data[np.uint8]
+        out = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+        self.assertTrue( gray2argb(a, out=out) is out )
+        with self.assertRaises(AssertionError):
+            gray2argb(a.T, out=out)
+
+    def testVigra( self ):
+        if not _vigraHas('gray2qimage_ARGB32Premultiplied'):
+            import nose
+            raise nose.SkipTest
+        for dtype, a in self.data.items():
+            self._check( a, (10, 200), use_vigra=True, tolerance=1 )
+
+
+def expectedRgba( channels, normalize ):
+    '''(h, w, 4) uint8 premultiplied red, green, blue and alpha'''
+    rgba = []
+    for a, n in zip(channels, normalize):
+        if n is not None and n[0] < n[1]:
+            a = np.clip((a.astype(np.float64) - n[0]) * 255.0 / (n[1] - n[0]), 0, 255)
+        rgba.append(a.astype(np.uint8).astype(np.float64))
+    alpha = rgba[3] / 255.0
+    return np.dstack([np.round(c * alpha) for c in rgba[:3]] + [rgba[3]]).astype(np.uint8)
+
+def argbBytes( img ):
+    # bytes of the ARGB32 pixels as red, green, blue, alpha
+    raw = raw_view(img)
+    return np.dstack([(raw >> shift) & 0xff for shift in (16, 8, 0, 24)]).astype(np.uint8)
+
+class Rgba2ArgbTest( ut.TestCase ):
+    def setUp( self ):
+        rng = np.random.RandomState(0)
+        self.u8 = [rng.randint(0, 256, (40, 30)).astype(np.uint8) for i in range(4)]
+        self.opaque = np.empty((40, 30), dtype=np.uint8)
+        self.opaque[:] = 255
+
+    def _check( self, channels, normalize=(None, None, None, None), tolerance=0 ):
+        img = rgba2argb(channels, normalize)
+        self.assertEqual( img.format(), QImage.Format_ARGB32_Premultiplied )
+        self.assertEqual( (img.height(), img.width()), channels[0].shape )
+        diff = np.abs(argbBytes(img).astype(int) - expectedRgba(channels, normalize))
+        self.assertTrue( diff.max() <= tolerance )
+
+    def testUint8( self ):
+        self._check( self.u8 )
+        self._check( self.u8[:3] + [self.opaque] )
+
+    def testNormalize( self ):
+        channels = [c.astype(np.uint16) * 100 for c in self.u8[:3]] + [self.opaque]
+        self._check( channels, [(0, 25500), (1000, 20000), None, None] )
+        channels = [c.astype(np.int16) - 128 for c in self.u8]
+        self._check( channels, [(-128, 127), (-50, 50), (0, 0), (-128, 127)] )
+
+    def testFloat( self ):
+        channels = [c.astype(np.float32) / 255.0 for c in self.u8]
+        self._check( channels, [(0.0, 1.0)] * 4, tolerance=1 )
+
+    def testMixedDtypes( self ):
+        channels = [self.u8[0], self.u8[1].astype(np.uint16), self.u8[2].astype(np.float64), self.u8[3]]
+        self._check( channels )
+
+    def testStridedInput( self ):
+        self._check( [c.T for c in self.u8] )
+        self._check( [c[::2, ::3] for c in self.u8], [(0, 100)] * 4 )
+
+    def testOut( self ):
+        out = QImage(30, 40, QImage.Format_ARGB32_Premultiplied)
+        self.assertTrue( rgba2argb(self.u8, out=out) is out )
+        with self.assertRaises(AssertionError):
+            rgba2argb(self.u8[:3] + [self.opaque.T])
+
+
+class Colortable2ArgbTest( ut.TestCase ):
+    def setUp( self ):
+        rng = np.random.RandomState(0)
+        self.colorTable = rng.randint(0, 256, (10, 4)).astype(np.uint8)
+        self.colors = self.colorTable.view(np.uint32).reshape(-1)
+        self.labels = rng.randint(0, 25, (40, 30))
+
+    def _check( self, a, expectedIndex, normalize=None, luts=None ):
+        img = colortable2argb(a, self.colorTable, normalize, luts=luts)
+        self.assertEqual( img.format(), QImage.Format_ARGB32 )
+        self.assertEqual( (img.height(), img.width()), a.shape )
+        self.assertTrue( np.all(raw_view(img) == self.colors[expectedIndex % len(self.colors)]) )
+
+    def testLabels( self ):
+        for dtype in (np.uint8, np.uint16, np.int16, np.uint32, np.int64):
+            a = self.labels.astype(dtype)
+            self._check( a, self.labels )
+            self._check( a, self.labels, normalize=(0, 9) )
+
+    def testNormalize( self ):
+        for dtype in (np.uint8, np.uint16, np.int32, np.float32):
+            a = (self.labels * 10).astype(dtype)
+            expected = np.floor((self.labels * 10 - 20) * 9 / 100.0).astype(int)
+            self._check( a, expected, normalize=(20, 120) )
+
+    def testFloat( self ):
+        self._check( self.labels.astype(np.float32) + 0.5, self.labels )
+
+    def testNegativeLabels( self ):
+        self._check( (self.labels - 12).astype(np.int8), self.labels - 12 )
+
+    def testLookupTableCache( self ):
+        luts = {}
+        a = self.labels.astype(np.uint8)
+        self._check( a, self.labels, luts=luts )
+        self._check( a, self.labels, luts=luts )
+        self.assertEqual( len(luts), 1 )
+        self._check( a * 10, self.labels * 9 // 10, normalize=(0, 100), luts=luts )
+        self.assertEqual( len(luts), 2 )
+
+    def testStridedInput( self ):
+        a = self.labels.astype(np.uint16)
+        self._check( a[::2, ::3], self.labels[::2, ::3] )
+        self._check( a.T, self.labels.T, normalize=(0, 9) )
+
+    def testOut( self ):
+        a = self.labels.astype(np.uint8)
+        out = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
+        self.assertTrue( colortable2argb(a, self.colorTable, out=out) is out )
+        with self.assertRaises(AssertionError):
+            colortable2argb(a, self.colorTable, out=QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied))
+
+
+class OrientationTest( ut.TestCase ):
+    def testMatchesTransformed( self ):
+        a = np.arange(12, dtype=np.uint8).reshape(3,4)
+        img = gray2argb(a)
+        for swap in (False, True):
+            for rotation in range(4):
+                t = QTransform(0,1,0,1,0,0,1,1,1) if swap else QTransform()
+                t *= QTransform().rotate(90*rotation)
+                t *= QTransform.fromTranslate(5, 7)
+                orientation = axisOrientation(t)
+                self.assertTrue( orientation is not None )
+                expected = raw_view(img.transformed(t))
+                self.assertEqual( orientedShape(a.shape, orientation), expected.shape )
+                self.assertTrue( np.all(raw_view(gray2argb(orient(a, orientation))) == expected) )
+
+    def testOtherTransforms( self ):
+        self.assertEqual( axisOrientation(QTransform().scale(2, 2)), None )
+        self.assertEqual( axisOrientation(QTransform().rotate(45)), None )
+        self.assertEqual( axisOrientation(QTransform().shear(0.5, 0)), None )
+        self.assertEqual( orient(np.zeros((2,3)), None).shape, (2,3) )
+
+
+if __name__=='__main__':
+    ut.main()
@@ -14,11 +14,14 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
-from numpy import ndarray,squeeze,ndarray
+import os
+import shutil
+import tempfile
+from numpy import ndarray,squeeze,ndarray,memmap
 from numpy.random import rand
 from unittest import TestCase
 from volumina.pixelpipeline.datasourcefactories import createDataSource
-from volumina.pixelpipeline.datasources import LazyflowSource,ArraySource
+from volumina.pixelpipeline.datasources import LazyflowSource,ArraySource,ChunkedSource
 
 hasLazyflow = True
 try:
@@ -80,6 +83,19 @@ class Test_DatasourceFactories(TestCase):
             self.assertEqual(type(source), ArraySource, 'Resulting datatype is not as expected')
             self.assertEqual(squeeze(ndarray(source._array.shape)).shape, array.shape, 'Inputdatashape does not match outputdatashape')
     
+    def test_memmapSource(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i in range(2,6):
+                array = memmap(os.path.join(tmpdir, "%d.bin" % i), dtype='float64', mode='w+', shape=self.dim[:i])
+                source, shape = createDataSource(array, True)
+                self.assertEqual(type(source), ChunkedSource, 'Resulting datatype is not as expected')
+                self.assertEqual(len(shape), 5)
+                self.assertEqual(squeeze(ndarray(shape)).shape, array.shape, 'Inputdatashape does not match outputdatashape')
+                source.clean_up()
+        finally:
+            shutil.rmtree(tmpdir)
+
     #yet to implement    
 #    def test_folderSource(self):
 #        pass
@@ -16,9 +16,12 @@
 
 import unittest as ut
 import os
+import shutil
+import tempfile
 from abc import ABCMeta, abstractmethod
 import volumina._testing
-from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource
+from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource, ChannelSource, channelSources, MinMaxSource, \
+    ChunkedSource, rawFileSource
 import numpy as np
 from volumina.slicingtools import sl, slicing2shape
 try:
@@ -85,6 +88,19 @@ class ArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         self.samesource = ArraySource( self.raw )
         self.othersource = ArraySource( np.array(self.raw) )
 
+    def testDownsampledRequest( self ):
+        slicing = (slice(0,1), slice(10,20,2), slice(20,25,2), slice(0,1), slice(0,1))
+        requested = self.source.request(slicing).wait()
+        self.assertEqual( requested.shape, slicing2shape(slicing) )
+        self.assertTrue( np.all(requested == self.raw[slicing]) )
+
+        mean = ArraySource( self.raw, downsampling='mean' ).request(slicing).wait()
+        self.assertEqual( mean.shape, (1,5,3,1,1) )
+        # the data is float, so the means are not rounded
+        self.assertEqual( mean[0,0,0,0,0], self.raw[0,10:12,20:22,0,0].mean() )
+        # the last block along y holds a single row
+        self.assertEqual( mean[0,1,2,0,0], self.raw[0,12:14,24,0,0].mean() )
+
 class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
     def setUp( self ):
         GenericArraySourceTest.setUp(self)
@@ -132,5 +148,273 @@ class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         del self.signal_emitted
         del self.slicing
 
+class _ChangingArray( object ):
+    '''Calls change() whenever it is read.'''
+    def __init__( self, array, change ):
+        self._array = array
+        self._change = change
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def __getitem__( self, slicing ):
+        self._change()
+        return self._array[slicing]
+
+class RelabelingTest( ut.TestCase ):
+    def setUp( self ):
+        # four 4x4 quadrants with the labels 1..4
+        a = np.zeros((1,8,8,1,1), dtype=np.uint32)
+        a[0,:4,:4] = 1
+        a[0,:4,4:] = 2
+        a[0,4:,:4] = 3
+        a[0,4:,4:] = 4
+        self.source = RelabelingArraySource(a, blockShape=(1,4,4,1,1))
+        self.source.setRelabeling(np.arange(5, dtype=np.uint32))
+        self.source.labelIndex()
+        self.dirty = []
+        self.source.isDirty.connect(self.dirty.append)
+
+    def testRelabelingIsDeferred( self ):
+        req = self.source.request(sl[:,:,:,:,:])
+        self.source.setRelabelingEntry(2, 7)
+        self.assertTrue( np.all(req.wait()[0,:4,4:] == 7) )
+
+    def testEntryDirtiesBlocksOfLabel( self ):
+        self.source.setRelabelingEntry(3, 0, setDirty=False)
+        self.source.setRelabelingEntry(4, 0)
+        self.assertEqual( self.dirty, [sl[0:1,4:8,0:4,0:1,0:1], sl[0:1,4:8,4:8,0:1,0:1]] )
+        # unchanged entries and unknown labels are not dirty
+        self.source.setRelabelingEntry(1, 1)
+        self.source.setRelabelingEntry(0, 5)
+        self.assertEqual( len(self.dirty), 2 )
+
+    def testRegionsRelabeledDuringChangeAreNotCached( self ):
+        # the relabeling changes while a region is read
+        change = lambda: self.source.setRelabelingEntry(1, 9, setDirty=False)
+        self.source._array = _ChangingArray(self.source._array, change)
+        self.source.request(sl[:,0:4,:,:,:]).wait()
+        self.assertEqual( len(self.source._cache), 0 )
+
+    def testClearRelabeling( self ):
+        self.source.setRelabeling(np.array([0, 0, 9, 0, 0], dtype=np.uint32))
+        del self.dirty[:]
+        self.source.clearRelabeling()
+        self.assertEqual( self.dirty, [sl[0:1,0:4,4:8,0:1,0:1]] )
+
+    def testCache( self ):
+        top, bottom = sl[:,0:4,:,:,:], sl[:,4:8,:,:,:]
+        a = self.source.request(top).wait()
+        b = self.source.request(bottom).wait()
+        self.assertTrue( self.source.request(top).wait() is a )
+        # only the cached regions with the changed label are dropped
+        self.source.setRelabelingEntry(3, 8)
+        self.assertTrue( self.source.request(top).wait() is a )
+        c = self.source.request(bottom).wait()
+        self.assertTrue( c is not b )
+        self.assertTrue( np.all(c[0,:,:4] == 8) )
+
+    def testDataChange( self ):
+        a = self.source.request(sl[:,0:4,:,:,:]).wait()
+        self.assertEqual( self.source.labelIndex().boundingBox(4), sl[0:1,4:8,4:8,0:1,0:1] )
+        self.source._array[0,0,0] = 4
+        self.source.setDirty(sl[0:1,0:1,0:1,0:1,0:1])
+        # the index is updated and the cached region is dropped
+        self.assertEqual( self.source.labelIndex().boundingBox(4), sl[0:1,0:8,0:8,0:1,0:1] )
+        self.assertEqual( list(self.source.labelIndex().blocks([4])), [0, 3] )
+        self.assertEqual( self.source.request(sl[:,0:4,:,:,:]).wait()[0,0,0,0,0], 4 )
+
+    def testIndexNotReady( self ):
+        # the index is computed in the background; until it is
+        # available, everything is dirty
+        source = RelabelingArraySource(self.source._array, blockShape=(1,4,4,1,1))
+        source.setRelabeling(np.arange(5, dtype=np.uint32))
+        dirty = []
+        source.isDirty.connect(dirty.append)
+        source.setRelabelingEntry(4, 0)
+        self.assertEqual( dirty, [sl[:,:,:,:,:]] )
+        source.labelIndex()
+        source.setRelabelingEntry(3, 0)
+        self.assertEqual( dirty[1:], [sl[0:1,4:8,0:4,0:1,0:1]] )
+
+
+class ChunkedSourceTest( ut.TestCase, GenericArraySourceTest ):
+    def setUp( self ):
+        GenericArraySourceTest.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "raw.bin")
+        self.raw = np.random.randint(0, 255, (1,40,30,5,1)).astype(np.uint8)
+        self.raw.tofile(self.filename)
+        self.source = rawFileSource( self.filename, self.raw.shape, np.uint8, chunkShape=(1,16,16,4,1) )
+
+        self.samesource = ChunkedSource( self.source._dataset )
+        self.othersource = rawFileSource( self.filename, self.raw.shape, np.uint8 )
+
+    def tearDown( self ):
+        shutil.rmtree(self.tmpdir)
+
+    def testChunks( self ):
+        slicing = sl[0:1,10:35,5:30,2:5,0:1]
+        self.assertTrue( np.all(self.source.request(slicing).wait() == self.raw[slicing]) )
+        # the 3*2*2 chunks that intersect the slicing are cached
+        self.assertEqual( len(self.source._cache._chunks), 12 )
+        inner = sl[0:1,16:20,16:20,0:4,0:1]
+        self.assertTrue( np.all(self.source.request(inner).wait() == self.raw[inner]) )
+
+        strided = sl[0:1,1:40:4,0:30:2,0:5,0:1]
+        self.assertTrue( np.all(self.source.request(strided).wait() == self.raw[strided]) )
+
+    def testCacheBudget( self ):
+        source = rawFileSource( self.filename, self.raw.shape, np.uint8,
+                                chunkShape=(1,16,16,4,1), cacheBytes=2*16*16*4 )
+        source.request(sl[0:1,0:32,0:16,0:4,0:1]).wait()
+        source.request(sl[0:1,32:40,0:16,0:4,0:1]).wait()
+        self.assertEqual( list(source._cache._chunks.keys()), [(0,1,0,0,0), (0,2,0,0,0)] )
+        source.clean_up()
+
+    def testSetDirtyDropsChunks( self ):
+        self.source.request(sl[0:1,0:32,0:16,0:4,0:1]).wait()
+        writable = np.memmap(self.filename, dtype=np.uint8, mode='r+', shape=self.raw.shape)
+        writable[0,20,3,1,0] = 7
+        writable.flush()
+        self.source.setDirty(sl[0:1,20:21,3:4,1:2,0:1])
+        self.assertEqual( list(self.source._cache._chunks.keys()), [(0,0,0,0,0)] )
+        self.assertEqual( self.source.request(sl[0:1,20:21,3:4,1:2,0:1]).wait()[0,0,0,0,0], 7 )
+
+    def testEmbedding( self ):
+        volume = np.memmap(os.path.join(self.tmpdir, "volume.bin"), dtype=np.uint16, mode='w+', shape=(20,10,6))
+        volume[...] = np.arange(20*10*6).reshape(20,10,6)
+        source = ChunkedSource( volume, chunkShape=(1,8,8,8,1) )
+        self.assertEqual( source._shape, (1,20,10,6,1) )
+        self.assertTrue( np.all(source.request(sl[0:1,5:15,2:10,0:6,0:1]).wait()[0,...,0] == volume[5:15,2:10,:]) )
+        source.clean_up()
+
+class _CountingArraySource( ArraySource ):
+    def __init__( self, array ):
+        super(_CountingArraySource, self).__init__(array)
+        self.requested = []
+
+    def request( self, slicing ):
+        self.requested.append(slicing)
+        return super(_CountingArraySource, self).request(slicing)
+
+class ChannelSourceTest( ut.TestCase, GenericArraySourceTest ):
+    def setUp( self ):
+        GenericArraySourceTest.setUp(self)
+        self.multichannel = np.random.randint(0, 255, (1,30,30,2,4)).astype(np.uint8)
+        self.raw = self.multichannel[..., 2:3]
+        self.array = _CountingArraySource( self.multichannel )
+        self.channels = channelSources( self.array )
+        self.source = self.channels[2]
+
+        self.samesource = ChannelSource( self.array, 2 )
+        self.othersource = ChannelSource( self.array, 1 )
+
+    def testBatchedRequests( self ):
+        slicing = (slice(0,1), slice(5,25,2), slice(0,30), slice(1,2), slice(0,1))
+        requests = [source.request(slicing) for source in self.channels]
+        self.assertEqual( len(self.array.requested), 1 )
+        for c, request in enumerate(requests):
+            self.assertTrue( np.all(request.wait() == self.multichannel[slicing[:-1] + (slice(c, c+1),)]) )
+
+        # a channel that requests a region again starts a new batch
+        self.channels[0].request(slicing)
+        self.channels[0].request(slicing)
+        self.channels[1].request(slicing)
+        self.assertEqual( len(self.array.requested), 3 )
+
+        # other regions are not batched
+        self.channels[0].request(self.slicing)
+        self.assertEqual( len(self.array.requested), 4 )
+
+    def testBatchedNotify( self ):
+        results = {}
+        def store( result, channel ):
+            results[channel] = result
+        for c, source in enumerate(self.channels):
+            source.request(self.slicing).notify(store, channel=c)
+        import time
+        timeout = time.time() + 5
+        while len(results) < 4 and time.time() < timeout:
+            time.sleep(0.01)
+        for c in range(4):
+            self.assertTrue( np.all(results[c] == self.multichannel[self.slicing[:-1] + (slice(c, c+1),)]) )
+
+    def testDirtyChannels( self ):
+        dirty = []
+        self.source.isDirty.connect(dirty.append)
+        self.array.setDirty( sl[:,:,:,:,0:2] )
+        self.assertEqual( dirty, [] )
+        self.array.setDirty( sl[:,0:5,:,:,1:3] )
+        self.assertEqual( dirty, [sl[:,0:5,:,:,:]] )
+
+class MinMaxSourceTest( ut.TestCase ):
+    def setUp( self ):
+        np.random.seed(0)
+        self.data = np.random.randint(10, 200, (1,300,300,1,1)).astype(np.float32)
+        self.source = ArraySource(self.data)
+
+    def _watch( self, mm ):
+        scheduled, dirty = [], []
+        mm._delayedBoundsChange.connect(lambda: scheduled.append(True))
+        mm.isDirty.connect(dirty.append)
+        return scheduled, dirty
+
+    def testMinMax( self ):
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        mm.request(sl[:,0:100,0:100,:,:]).wait()
+        part = self.data[:,0:100,0:100,:,:]
+        self.assertEqual( list(mm._bounds), [part.min(), part.max()] )
+
+    def testSampledRequests( self ):
+        # only a strided subset of large results is examined
+        self.data[0,1,1,0,0] = 1000
+        mm = MinMaxSource(self.source, percentiles=(0, 100), maxSamples=1000)
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertTrue( 10 <= mm._bounds[0] <= mm._bounds[1] < 200 )
+
+    def testPercentiles( self ):
+        self.data[0,::50,::50,0,0] = 1e6
+        self.data[0,::60,::60,0,0] = -1e6
+        mm = MinMaxSource(self.source, percentiles=(1, 99))
+        mm.request(sl[:,:,:,:,:]).wait()
+        dmin, dmax = mm._bounds
+        self.assertTrue( 10 <= dmin < 20 )
+        self.assertTrue( 190 < dmax < 200 )
+
+    def testNonFiniteValuesAreIgnored( self ):
+        self.data[0,0,0,0,0] = np.nan
+        self.data[0,0,1,0,0] = np.inf
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        mm.request(sl[:,0:10,0:10,:,:]).wait()
+        self.assertTrue( np.all(np.isfinite(mm._bounds)) )
+
+    def testBoundChangesAreDebounced( self ):
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        scheduled, dirty = self._watch(mm)
+        published = []
+        mm.boundsChanged.connect(published.append)
+        for i in range(1, 4):
+            self.data[0,10*i,10*i,0,0] = 1000*i
+            mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( len(scheduled), 1 )
+        self.assertEqual( dirty, [] )
+
+        # the timer publishes the latest bounds once
+        mm._publishBounds()
+        self.assertEqual( published, [[self.data.min(), 3000]] )
+        self.assertEqual( len(dirty), 1 )
+
+        self.data[0,50,50,0,0] = 5000
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( len(scheduled), 2 )
+
+    def testResetBounds( self ):
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.data[...] = 50
+        mm.resetBounds()
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( list(mm._bounds), [50, 50] )
+
 if __name__ == '__main__':
     ut.main()
@@ -0,0 +1,68 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+from PyQt4.QtGui import QImage
+
+from volumina.pixelpipeline.imagepool import ImagePool
+
+
+class ImagePoolTest( ut.TestCase ):
+    def testReuse( self ):
+        pool = ImagePool(maxmemory=2**20)
+        img = pool.take(64, 32)
+        self.assertEqual( (img.width(), img.height(), img.format()),
+                          (64, 32, QImage.Format_ARGB32_Premultiplied) )
+        imgId = id(img)
+        self.assertTrue( pool.give(img) )
+        del img
+        # other sizes and formats are allocated
+        self.assertNotEqual( id(pool.take(32, 64)), imgId )
+        self.assertNotEqual( id(pool.take(64, 32, QImage.Format_ARGB32)), imgId )
+        self.assertEqual( id(pool.take(64, 32)), imgId )
+        s = pool.statistics()
+        self.assertEqual( (s['allocated'], s['reused'], s['returned']), (3, 1, 1) )
+        self.assertEqual( (s['images'], s['memoryUsage']), (0, 0) )
+
+    def testImageIsReturnedOnce( self ):
+        pool = ImagePool(maxmemory=2**20)
+        img = pool.take(64, 32)
+        self.assertTrue( pool.give(img) )
+        self.assertFalse( pool.give(img) )
+        self.assertEqual( pool.statistics()['images'], 1 )
+
+    def testMemoryLimit( self ):
+        nbytes = 64*32*4
+        pool = ImagePool(maxmemory=2*nbytes)
+        for i in range(3):
+            img = pool.take(64, 32)
+            pool.give(img)
+            del img
+        # the pool hands out its only image three times
+        self.assertEqual( pool.statistics()['allocated'], 1 )
+        images = [pool.take(64, 32) for i in range(3)]
+        while images:
+            img = images.pop()
+            pool.give(img)
+            del img
+        s = pool.statistics()
+        self.assertEqual( (s['images'], s['memoryUsage'], s['discarded']), (2, 2*nbytes, 1) )
+        pool.clear()
+        self.assertEqual( pool.statistics()['memoryUsage'], 0 )
+
+
+if __name__=='__main__':
+    ut.main()
@@ -0,0 +1,127 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+
+from volumina.slicingtools import sl
+from volumina.pixelpipeline.labelindex import LabelIndex, LabelIndexJob, computeLabelIndex
+
+
+class LabelIndexTest( ut.TestCase ):
+    def setUp( self ):
+        np.random.seed(0)
+        self.data = np.random.randint(0, 50, (1, 20, 13, 6, 1)).astype(np.uint16)
+        self.data[0, 16:, 10:, 4:, 0] = 1000
+        self.index = computeLabelIndex(self.data, blockShape=(1, 8, 8, 4, 1))
+
+    def testBlocks( self ):
+        self.assertEqual( self.index.grid, (1, 3, 2, 2, 1) )
+        for label in (0, 17, 1000):
+            expected = [n for n in range(self.index.blockCount)
+                        if np.any(self.data[self.index.blockSlicing(n)] == label)]
+            self.assertEqual( list(self.index.blocks([label])), expected )
+        self.assertEqual( list(self.index.blocks([1000])), [11] )
+        self.assertEqual( len(self.index.blocks([51, 999])), 0 )
+        self.assertTrue( 1000 in self.index )
+        self.assertFalse( 999 in self.index )
+
+    def testSlicings( self ):
+        self.assertEqual( self.index.blockSlicing(11), sl[0:1, 16:20, 8:13, 4:6, 0:1] )
+        self.assertEqual( self.index.dirtySlicings([1000]), [sl[0:1, 16:20, 8:13, 4:6, 0:1]] )
+        self.assertEqual( self.index.dirtySlicings([3], maxSlicings=2), [sl[0:1, 0:20, 0:13, 0:6, 0:1]] )
+
+    def testIntersects( self ):
+        numbers = self.index.blocks([1000])
+        self.assertTrue( self.index.intersects(sl[:, 19:20, :, :, :], numbers) )
+        self.assertFalse( self.index.intersects(sl[:, 0:16, :, :, :], numbers) )
+        self.assertFalse( self.index.intersects(sl[:, :, :, 0:4, :], numbers) )
+
+    def testBoundingBox( self ):
+        self.assertEqual( self.index.boundingBox(1000), sl[0:1, 16:20, 10:13, 4:6, 0:1] )
+        self.assertEqual( self.index.boundingBox(999), None )
+        self.data[0, 3, 2, 1, 0] = 1000
+        self.assertEqual( self.index.boundingBox(1000), sl[0:1, 16:20, 10:13, 4:6, 0:1] )
+        self.index.update(self.data, sl[0:1, 3:4, 2:3, 1:2, 0:1])
+        self.assertEqual( self.index.boundingBox(1000), sl[0:1, 3:20, 2:13, 1:6, 0:1] )
+        self.assertEqual( list(self.index.blocks([1000])), [0, 11] )
+
+    def testUpdate( self ):
+        self.data[0, 16:, 10:, 4:, 0] = 7
+        self.index.update(self.data, sl[0:1, 16:20, 10:13, 4:6, 0:1])
+        self.assertFalse( 1000 in self.index )
+        expected = computeLabelIndex(self.data, blockShape=(1, 8, 8, 4, 1))
+        self.assertTrue( np.array_equal(self.index.labels, expected.labels) )
+        for label in expected.labels:
+            self.assertTrue( np.array_equal(self.index.blocks([label]), expected.blocks([label])) )
+            self.assertEqual( self.index.boundingBox(label), expected.boundingBox(label) )
+
+    def testRefresh( self ):
+        self.data[0, 0:3, 0:3, 0:2, 0] = 1000
+        self.data[0, 9, 12, 5, 0] = 2000
+        self.index.markDirty(sl[0:1, 0:3, 0:3, 0:2, 0:1])
+        self.index.markDirty(sl[0:1, 9:10, 12:13, 5:6, 0:1])
+        self.assertTrue( self.index.dirty )
+        # dirty blocks may contain any label until they are rescanned
+        self.assertEqual( list(self.index.blocks([1000])), [0, 7, 11] )
+        self.assertEqual( list(self.index.blocks([2000])), [0, 7] )
+        self.assertTrue( self.index.refresh(self.data) )
+        self.assertFalse( self.index.dirty )
+        expected = computeLabelIndex(self.data, blockShape=(1, 8, 8, 4, 1))
+        self.assertTrue( np.array_equal(self.index.labels, expected.labels) )
+        for label in expected.labels:
+            self.assertTrue( np.array_equal(self.index.blocks([label]), expected.blocks([label])) )
+            self.assertEqual( self.index.boundingBox(label), expected.boundingBox(label) )
+
+    def testCancelledRefresh( self ):
+        self.index.markDirty(sl[0:1, 0:1, 0:1, 0:1, 0:1])
+        self.assertFalse( self.index.refresh(self.data, cancelled=lambda: True) )
+        self.assertTrue( self.index.dirty )
+        self.assertEqual( list(self.index.blocks([1000])), [0, 11] )
+
+    def testJob( self ):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "index.npz")
+            done = []
+            job = LabelIndexJob(self.data, (1, 8, 8, 4, 1), filename, done.append)
+            job.start()
+            index = job.wait()
+            self.assertEqual( done, [index] )
+            self.assertTrue( os.path.exists(filename) )
+            self.assertEqual( index.boundingBox(1000), self.index.boundingBox(1000) )
+
+            loaded = LabelIndexJob(self.data, filename=filename).run()
+            self.assertEqual( loaded.blockShape, (1, 8, 8, 4, 1) )
+            self.assertTrue( np.array_equal(loaded.labels, self.index.labels) )
+            self.assertTrue( np.array_equal(loaded.blocks([17]), self.index.blocks([17])) )
+
+            # an index of an array of a different shape is not used
+            other = LabelIndexJob(self.data[:, :10], filename=filename).run()
+            self.assertEqual( other.shape, (1, 10, 13, 6, 1) )
+
+            cancelled = LabelIndexJob(self.data, (1, 8, 8, 4, 1))
+            cancelled.cancel()
+            self.assertEqual( cancelled.run(), None )
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,62 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+import numpy as np
+
+from volumina.metrics import RingBuffer, Metrics
+
+
+class RingBufferTest( ut.TestCase ):
+    def testWrapAround( self ):
+        b = RingBuffer(4)
+        for i in range(6):
+            b.append(i, t=10+i)
+        self.assertEqual( len(b), 4 )
+        self.assertEqual( b.count, 6 )
+        values, times = b.values()
+        self.assertEqual( list(values), [2,3,4,5] )
+        self.assertEqual( list(times), [12,13,14,15] )
+
+    def testSummary( self ):
+        b = RingBuffer(100)
+        self.assertEqual( b.summary(), {'count': 0, 'samples': 0} )
+        for i in range(11):
+            b.append(i, t=0.5*i)
+        s = b.summary()
+        self.assertEqual( (s['min'], s['max'], s['last']), (0, 10, 10) )
+        self.assertAlmostEqual( s['mean'], 5 )
+        self.assertAlmostEqual( s['median'], 5 )
+        self.assertAlmostEqual( s['rate'], 2 )
+
+
+class MetricsTest( ut.TestCase ):
+    def testSnapshot( self ):
+        m = Metrics(size=8)
+        for i in range(10):
+            m.record('convert', 0.1)
+        m.mark('tiles')
+        s = m.snapshot()
+        self.assertEqual( sorted(s.keys()), ['convert', 'tiles'] )
+        self.assertEqual( s['convert']['count'], 10 )
+        self.assertEqual( s['convert']['samples'], 8 )
+        self.assertAlmostEqual( s['convert']['p95'], 0.1 )
+        m.reset()
+        self.assertEqual( m.snapshot(), {} )
+
+
+if __name__=='__main__':
+    ut.main()
@@ -0,0 +1,211 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''
+Benchmarks the pixel pipeline from an ArraySource to composited tiles:
+
+ArraySource -> SliceSource -> ImageSource -> TileProvider
+
+For every layer type, slice size and number of render threads it measures
+
+fill        -- time to render all tiles of the viewport into an empty cache
+firstTile   -- time until the first tile of a new slice is available
+sliceSwitch -- time to render the viewport after switching to another slice
+
+and the throughput of the fill in tiles and megapixels per second. Every
+value is the median of 'repetitions' runs. No window is opened, so the
+benchmark runs without a display.
+
+The results are written as JSON, e.g. to compare two revisions:
+
+usage: python pipeline_benchmark.py [-o results.json] [--sizes 512 2048]
+                                    [--threads 1 2 4] [--layers grayscale rgba]
+'''
+
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+
+from PyQt4.QtCore import QRectF, Qt
+from PyQt4.QtGui import QApplication, QColor
+
+from volumina.config import cfg
+from volumina.tiling import Tiling, TileProvider
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer, ColortableLayer, AlphaModulatedLayer, RGBALayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.slicingtools import SliceProjection
+
+VIEWPORT = (1024, 768)
+
+
+def grayscaleLayer( data ):
+    return GrayscaleLayer( ArraySource(data), normalize=False )
+
+def colortableLayer( data ):
+    colorTable = [QColor(i, 255-i, (7*i) % 256).rgba() for i in range(256)]
+    return ColortableLayer( ArraySource(data), colorTable )
+
+def alphaModulatedLayer( data ):
+    return AlphaModulatedLayer( ArraySource(data), tintColor=QColor(255,0,0) )
+
+def rgbaLayer( data ):
+    return RGBALayer( red=ArraySource(data), green=ArraySource(255-data),
+                      blue=ArraySource(data//2) )
+
+layerTypes = [('grayscale', grayscaleLayer),
+              ('colortable', colortableLayer),
+              ('alphamodulated', alphaModulatedLayer),
+              ('rgba', rgbaLayer)]
+
+
+def testData( size, nSlices, seed=0 ):
+    '''Random uint8 volume of shape (t,x,y,z,c) = (1,size,size,nSlices,1).'''
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, (1, size, size, nSlices, 1)).astype(np.uint8)
+
+class Pipeline( object ):
+    '''A layer stack with a single layer, rendered by a TileProvider.'''
+    def __init__( self, layer, size, n_threads ):
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(layer)
+        self.tiling = Tiling((size, size))
+        self.tp = TileProvider(self.tiling, self.pump.stackedImageSources, n_threads=n_threads)
+        self.viewport = QRectF(0, 0, min(size, VIEWPORT[0]), min(size, VIEWPORT[1]))
+        self._firstTile = None
+        self.tp.sceneRectChanged.connect(self._onSceneRectChanged, Qt.DirectConnection)
+
+    def _onSceneRectChanged( self, rect ):
+        if self._firstTile is None and rect.isValid():
+            self._firstTile = time.time()
+
+    def render( self ):
+        '''Render the viewport, return (total time, time to the first tile).'''
+        self._firstTile = None
+        start = time.time()
+        self.tp.requestRefresh(self.viewport)
+        self.tp.join()
+        for tile in self.tp.getTiles(self.viewport):
+            if tile.qimg is None or tile.progress < 1.0:
+                # the render threads report the exception
+                raise RuntimeError("tile %d was not rendered" % tile.id)
+        stop = time.time()
+        first = self._firstTile if self._firstTile is not None else stop
+        return stop - start, first - start
+
+    def setSlice( self, z ):
+        self.pump.syncedSliceSources.through = [0, z, 0]
+
+    def close( self ):
+        self.tp.notifyThreadsToStop()
+        self.tp.joinThreads()
+
+def benchmark( makeLayer, size, n_threads, repetitions ):
+    data = testData(size, 2*repetitions + 1)
+    fill, switch, first = [], [], []
+    nTiles = 0
+    for i in range(repetitions):
+        p = Pipeline(makeLayer(data), size, n_threads)
+        try:
+            p.setSlice(2*i)
+            t, _ = p.render()
+            fill.append(t)
+            nTiles = len(p.tiling.intersected(p.viewport))
+
+            p.setSlice(2*i + 1)
+            t, f = p.render()
+            switch.append(t)
+            first.append(f)
+            metrics = p.tp.metricsSnapshot()
+        finally:
+            p.close()
+
+    fill = float(np.median(fill))
+    pixels = p.viewport.width() * p.viewport.height()
+    return {'fill': fill,
+            'firstTile': float(np.median(first)),
+            'sliceSwitch': float(np.median(switch)),
+            'tiles': nTiles,
+            'tilesPerSecond': nTiles / fill,
+            'megapixelsPerSecond': pixels / fill / 1e6,
+            'stages': dict((stage, summary.get('median'))
+                           for layer in metrics['layers'].values()
+                           for stage, summary in layer.items()),
+            'composite': metrics['pipeline'].get('composite', {}).get('median')}
+
+def environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'time': time.time(),
+            'revision': revision,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'compositor': cfg.get('tiling', 'compositor')}
+
+def main( argv ):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--output', help="write the JSON results to this file")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 2048])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--layers', nargs='+', default=[name for name, f in layerTypes],
+                        choices=[name for name, f in layerTypes])
+    parser.add_argument('--repetitions', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication([], False)
+
+    results = []
+    for name, makeLayer in layerTypes:
+        if name not in args.layers:
+            continue
+        for size in args.sizes:
+            for n_threads in args.threads:
+                result = {'layer': name, 'size': size, 'threads': n_threads}
+                try:
+                    result.update(benchmark(makeLayer, size, n_threads, args.repetitions))
+                except RuntimeError, e:
+                    # e.g. colortable layers without vigra
+                    result['error'] = str(e)
+                results.append(result)
+                if 'error' in result:
+                    print >> sys.stderr, "%-14s %5d %d threads: %s" % (name, size, n_threads, result['error'])
+                else:
+                    print >> sys.stderr, "%-14s %5d %d threads: fill %7.1f ms, slice switch %7.1f ms (first tile %6.1f ms), %6.1f tiles/s" \
+                        % (name, size, n_threads, 1000*result['fill'], 1000*result['sliceSwitch'],
+                           1000*result['firstTile'], result['tilesPerSecond'])
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -48,6 +48,19 @@ class SlicingToolsTest(unittest.TestCase):
 
         self.assertEquals(a, c)
 
+    def test_steps(self):
+        slicing = st.rect2slicing(self.qrect, step=2)
+        self.assertEquals(slicing, (slice(5, 7, 2), slice(10, 18, 2)))
+        self.assertEquals(st.slicing2shape(slicing), (1, 4))
+        self.assertEquals(st.slicing2shape((slice(0, 9, 4),)), (3,))
+        self.assertEquals(st.level2step(0), None)
+        self.assertEquals(st.level2step(3), 8)
+
+        unstrided, strides = st.strip_steps(slicing)
+        self.assertEquals(unstrided, self.slicing)
+        a = np.arange(400).reshape(20, 20)
+        self.assertTrue(np.all(a[unstrided][strides] == a[slicing]))
+
 
 if __name__=='__main__':
     unittest.main()
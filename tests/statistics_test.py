@@ -0,0 +1,167 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import unittest as ut
+import numpy as np
+
+from volumina.slicingtools import sl
+from volumina.pixelpipeline.datasources import ArraySource, ChunkedSource, ConstantSource, MinMaxSource
+from volumina.pixelpipeline.statistics import StatisticsJob, blocks, sourceShape, \
+    cachedStatistics, forgetStatistics, statisticsJob
+
+
+class BlocksTest( ut.TestCase ):
+    def testBlocksCoverShape( self ):
+        shape = (2, 30, 20, 7, 3)
+        covered = np.zeros(shape, dtype=int)
+        for slicing in blocks(shape, 4, 4*30*20*3):
+            self.assertTrue( covered[slicing].nbytes // covered.itemsize * 4 <= 4*30*20*3 )
+            covered[slicing] += 1
+        self.assertTrue( np.all(covered == 1) )
+
+    def testWholeSlices( self ):
+        shape = (1, 30, 20, 7, 1)
+        for slicing in blocks(shape, 1, 30*20):
+            self.assertEqual( slicing[1:3], (slice(0, 30), slice(0, 20)) )
+
+
+class StatisticsJobTest( ut.TestCase ):
+    def setUp( self ):
+        np.random.seed(0)
+
+    def _job( self, data, **kwargs ):
+        source = ArraySource(data)
+        return source, StatisticsJob(source, sourceShape(source), **kwargs)
+
+    def testIntegerData( self ):
+        data = np.random.randint(3, 250, (1, 40, 30, 5, 1)).astype(np.uint8)
+        source, job = self._job(data, blockBytes=40*30)
+        progress = []
+        job.progress.connect(progress.append)
+        stats = job.run()
+        self.assertEqual( (stats.min, stats.max), (data.min(), data.max()) )
+        self.assertTrue( np.all(stats.counts == np.bincount(data.ravel(), minlength=256)) )
+        self.assertEqual( len(progress), 5 )
+        self.assertEqual( progress[-1], 1.0 )
+        self.assertTrue( cachedStatistics(source) is stats )
+
+    def testSignedData( self ):
+        data = np.random.randint(-300, 200, (1, 20, 30, 2, 1)).astype(np.int16)
+        source, job = self._job(data, blockBytes=20*30*2)
+        stats = job.run()
+        self.assertEqual( (stats.min, stats.max), (data.min(), data.max()) )
+        self.assertTrue( np.all(stats.counts == np.bincount(data.ravel().astype(np.int64) + 2**15, minlength=2**16)) )
+        self.assertEqual( stats.edges[0], -2**15 )
+
+    def testChunkCacheIsBypassed( self ):
+        data = np.random.randint(3, 250, (1, 40, 30, 5, 1)).astype(np.uint8)
+        source = ChunkedSource(data, chunkShape=(1, 8, 8, 5, 1))
+        source.request(sl[0:1, 0:8, 0:8, 0:5, 0:1]).wait()
+        cached = source._cache.nbytes
+        stats = StatisticsJob(source, sourceShape(source), blockBytes=40*30).run()
+        self.assertEqual( (stats.min, stats.max), (data.min(), data.max()) )
+        self.assertEqual( source._cache.nbytes, cached )
+
+    def testFloatData( self ):
+        data = np.random.normal(size=(1, 50, 50, 4, 1)).astype(np.float32)
+        data[0, 0, 0, 0, 0] = np.nan
+        source, job = self._job(data, bins=100, blockBytes=50*50*4)
+        stats = job.run()
+        finite = data[np.isfinite(data)]
+        self.assertEqual( (stats.min, stats.max), (finite.min(), finite.max()) )
+        self.assertEqual( stats.counts.sum(), finite.size )
+        lo, hi = stats.percentiles((1, 99))
+        expected = np.percentile(finite, (1, 99))
+        binWidth = stats.edges[1] - stats.edges[0]
+        self.assertTrue( abs(lo - expected[0]) < binWidth )
+        self.assertTrue( abs(hi - expected[1]) < binWidth )
+
+    def testCancel( self ):
+        data = np.zeros((1, 10, 10, 10, 1), dtype=np.uint8)
+        source, job = self._job(data, blockBytes=100)
+        finished = []
+        job.finished.connect(finished.append)
+        job.progress.connect(lambda p: job.cancel())
+        self.assertTrue( job.run() is None )
+        self.assertEqual( finished, [] )
+        self.assertTrue( cachedStatistics(source) is None )
+
+    def testSharedJob( self ):
+        source = ArraySource(np.zeros((1, 10, 10, 1, 1), dtype=np.uint8))
+        job = statisticsJob(source)
+        self.assertTrue( statisticsJob(source) is job )
+        job.start()
+        job.wait()
+        self.assertTrue( statisticsJob(source) is not job )
+        forgetStatistics(source)
+        self.assertTrue( cachedStatistics(source) is None )
+
+
+class PrecomputedBoundsTest( ut.TestCase ):
+    def setUp( self ):
+        self.data = np.random.randint(10, 200, (1, 60, 60, 3, 1)).astype(np.uint8)
+        self.source = ArraySource(self.data)
+
+    def testBoundsAreFixed( self ):
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        bounds = []
+        mm.boundsChanged.connect(bounds.append)
+        # the finished signal is queued to the thread of the MinMaxSource
+        mm.setStatistics(mm.precomputeBounds().wait())
+        self.assertEqual( bounds[-1], [self.data.min(), self.data.max()] )
+
+        # requests no longer change the bounds
+        self.data[0, 0, 0, 0, 0] = 255
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( mm._bounds, [self.data[self.data < 255].min(), 199] )
+
+        mm.resetBounds()
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( mm._bounds[1], 255 )
+
+    def testDataChangeRecomputesBounds( self ):
+        mm = MinMaxSource(self.source, percentiles=(0, 100))
+        mm.setStatistics(mm.precomputeBounds().wait())
+        self.assertTrue( cachedStatistics(self.source) is not None )
+
+        # the bounds are kept until the statistics are recomputed
+        self.data[0, 0, 0, 0, 0] = 255
+        self.source.setDirty(sl[0:1,0:1,0:1,0:1,0:1])
+        self.assertTrue( cachedStatistics(self.source) is None )
+        mm.request(sl[:,:,:,:,:]).wait()
+        self.assertEqual( mm._bounds[1], 199 )
+
+        # called by the recompute timer
+        mm.setStatistics(mm._recomputeBounds().wait())
+        self.assertEqual( mm._bounds[1], 255 )
+
+    def testComputedSourcesAreSkipped( self ):
+        mm = MinMaxSource(ConstantSource(3))
+        self.assertTrue( mm.precomputeBounds() is None )
+
+    def testBackgroundJob( self ):
+        mm = MinMaxSource(self.source, percentiles=(1, 99))
+        job = mm.precomputeBounds()
+        self.assertTrue( job is not None )
+        stats = job.wait()
+        # the finished signal is queued to the thread of the MinMaxSource
+        mm.setStatistics(stats)
+        lo, hi = mm._bounds
+        self.assertTrue( 10 <= lo < 15 and 195 < hi <= 199 )
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,72 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''
+Measures the lookups of the tile cache of the TileProvider (the calls
+of the GUI thread while painting) without and with render threads that
+update layer patches at the same time.
+
+usage: python tilescache_benchmark.py [n_writers] [n_lookups]
+'''
+
+import sys
+import time
+import threading
+from PyQt4.QtGui import QImage
+
+from volumina.tiling import _TilesCache
+from volumina.layerstack import LayerStackModel
+from volumina.pixelpipeline.imagepump import StackedImageSources
+
+N_TILES = 64
+
+def lookups( cache, n ):
+    start = time.time()
+    for i in xrange(n):
+        tile_id = i % N_TILES
+        cache.tile('stack', tile_id)
+        cache.tileDirty('stack', tile_id)
+        cache.layer('stack', 'layer', tile_id)
+        cache.layerDirty('stack', 'layer', tile_id)
+    return time.time() - start
+
+def contended( cache, n, n_writers ):
+    img = QImage(16, 16, QImage.Format_ARGB32_Premultiplied)
+    stop = threading.Event()
+    def write():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            cache.updateTileIfNecessary('stack', 'layer', i % N_TILES, time.time(), img)
+
+    writers = [threading.Thread(target=write) for i in range(n_writers)]
+    for w in writers:
+        w.start()
+    try:
+        return lookups(cache, n)
+    finally:
+        stop.set()
+        for w in writers:
+            w.join()
+
+if __name__ == '__main__':
+    n_writers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    cache = _TilesCache('stack', StackedImageSources( LayerStackModel() ))
+    print "%d lookups" % (4*n_lookups)
+    print "  without writers    %7.1f ms" % (1000*lookups(cache, n_lookups))
+    print "  with %2d writers    %7.1f ms" % (n_writers, 1000*contended(cache, n_lookups, n_writers))
@@ -15,16 +15,20 @@
 # Copyright 2011-2014, the ilastik developers
 
 import os
+import time
+import json
+import threading
 import unittest as ut
 import numpy as np
-from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform, qApp
+from PyQt4.QtCore import QRectF, QPoint, QPointF, QRect, QSize
+from PyQt4.QtGui import QTransform, QImage, qApp
+from Queue import Empty
 from qimage2ndarray import byte_view
 
-from volumina.tiling import TileProvider, Tiling
+from volumina.tiling import TileProvider, Tiling, _TilesCache, _RequestScheduler
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
-from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
+from volumina.pixelpipeline.datasources import ConstantSource, ArraySource, ArrayRequest
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
 from volumina.pixelpipeline.slicesources import SliceSource
@@ -60,6 +64,249 @@ class TilingTest ( ut.TestCase ):
         with self.assertRaises(AssertionError):
             t.data2scene = trans
 
+    def testLevels(self):
+        t = Tiling((900, 400), blockSize=100, maxLevel=3)
+        self.assertEqual( t.levelForScale(2.0), 0 )
+        self.assertEqual( t.levelForScale(1.0), 0 )
+        self.assertEqual( t.levelForScale(0.6), 0 )
+        self.assertEqual( t.levelForScale(0.5), 1 )
+        self.assertEqual( t.levelForScale(0.3), 1 )
+        self.assertEqual( t.levelForScale(0.01), 3 )
+        self.assertEqual( t.levelSize(0, 0), t.imageRects[0].size() )
+        self.assertEqual( (t.levelSize(0, 3).width(), t.levelSize(0, 3).height()), (13, 13) )
+        self.assertEqual( Tiling((900, 400), blockSize=4, maxLevel=8).maxLevel, 2 )
+
+    def testIntersectedMergedPatch(self):
+        # the remainder of 20 pixels belongs to the last patch of a row
+        tiling = Tiling((1020,100), blockSize=100)
+        self.assertEqual( len(tiling), 10 )
+        self.assertEqual( tiling.intersected(QRectF(1005,0,5,50)), [9] )
+
+    def testContainsF(self):
+        tiling = Tiling((1020,450), blockSize=100)
+        for x, y in [(0,0), (99.5,0), (100,100), (1010,449), (-1,5), (1021,5)]:
+            point = QPointF(x, y)
+            expected = None
+            for i, rect in enumerate(tiling.tileRectFs):
+                if rect.contains(point):
+                    expected = i
+                    break
+            self.assertEqual( tiling.containsF(point), expected )
+
+    def testChooseBlockSize(self):
+        t = Tiling((4000, 4000), blockSize=256, maxLevel=4)
+        # cheap layers: zoomed out, larger tiles save the per tile overhead
+        self.assertEqual( t.chooseBlockSize(QSize(1000, 800), 0.25), 1024 )
+        # expensive layers: smaller tiles waste less work outside the viewport
+        self.assertEqual( t.chooseBlockSize(QSize(500, 400), 1.0, timePerPixel=1e-5), 128 )
+        # small gains do not cause a switch
+        self.assertEqual( t.chooseBlockSize(QSize(1000, 800), 1.0, hysteresis=0), 512 )
+        self.assertEqual( t.chooseBlockSize(QSize(1000, 800), 1.0), 256 )
+        self.assertEqual( t.chooseBlockSize(QSize(), 1.0), 256 )
+        # without overhead per tile, the smallest tiles are cheapest
+        self.assertEqual( t.chooseBlockSize(QSize(1000, 800), 1.0, tileOverhead=0.0), 128 )
+
+
+class TilesCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+        self.nbytes = QImage(10, 10, QImage.Format_ARGB32_Premultiplied).byteCount()
+
+    def _image( self ):
+        return QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+
+    def testMemoryLimit( self ):
+        cache = _TilesCache('stack0', self.sims, maxmemory=3*self.nbytes)
+        cache.setLayer('stack0', 'layer', 0, self._image())
+        cache.setLayer('stack0', 'layer', 1, self._image())
+        cache.setTile('stack0', 0, self._image(), [], [])
+
+        # touch the first layer patch, so that the second one is the
+        # least recently used image
+        self.assertTrue( cache.layer('stack0', 'layer', 0) is not None )
+
+        cache.addStack('stack1')
+        cache.setLayer('stack1', 'layer', 0, self._image())
+        self.assertEqual( cache.statistics()['memoryUsage'], 3*self.nbytes )
+        self.assertEqual( cache.statistics()['evictions'], 1 )
+        self.assertTrue( cache.layer('stack0', 'layer', 1) is None )
+        self.assertTrue( cache.layerDirty('stack0', 'layer', 1) )
+        self.assertTrue( cache.layer('stack0', 'layer', 0) is not None )
+        self.assertTrue( cache.tile('stack0', 0)[0] is not None )
+
+        stats = cache.statistics()
+        self.assertEqual( stats['layerHits'], 2 )
+        self.assertEqual( stats['layerMisses'], 1 )
+        self.assertEqual( stats['tileHits'], 1 )
+
+    def testDirtyRect( self ):
+        cache = _TilesCache('stack0', self.sims)
+        # patches that are not cached are refreshed as a whole
+        cache.setLayerDirtyAll('layer', 0, True, QRect(0,0,2,2))
+        self.assertTrue( cache.layerDirtyRect('stack0', 'layer', 0) is None )
+
+        cache.updateTileIfNecessary('stack0', 'layer', 0, 1.0, self._image())
+        self.assertFalse( cache.layerDirty('stack0', 'layer', 0) )
+        cache.setLayerDirtyAll('layer', 0, True, QRect(0,0,2,2))
+        cache.setLayerDirtyAll('layer', 0, True, QRect(5,5,2,2))
+        self.assertTrue( cache.layerDirty('stack0', 'layer', 0) )
+        self.assertEqual( cache.layerDirtyRect('stack0', 'layer', 0), QRect(0,0,7,7) )
+        # other layers are not affected
+        self.assertTrue( cache.layerDirtyRect('stack0', 'other', 0) is None )
+
+        # a dirty rect never shrinks the dirty part
+        cache.setLayerDirtyAll('layer', 0, True)
+        cache.setLayerDirtyAll('layer', 0, True, QRect(0,0,2,2))
+        self.assertTrue( cache.layerDirtyRect('stack0', 'layer', 0) is None )
+
+        cache.updateTileIfNecessary('stack0', 'layer', 0, 2.0, self._image())
+        self.assertTrue( cache.layerDirtyRect('stack0', 'layer', 0) is None )
+
+    def testBulkTileDirty( self ):
+        cache = _TilesCache('stack0', self.sims)
+        cache.addStack('stack1')
+        cache.setAllTilesDirtyAll(False)
+        self.assertFalse( cache.tileDirty('stack0', 12345) )
+        cache.setTilesDirtyAll([3, 700], True)
+        for stack_id in ('stack0', 'stack1'):
+            self.assertTrue( cache.tileDirty(stack_id, 3) )
+            self.assertTrue( cache.tileDirty(stack_id, 700) )
+            self.assertFalse( cache.tileDirty(stack_id, 4) )
+        cache.setTileDirty('stack1', 700, False)
+        self.assertTrue( cache.tileDirty('stack0', 700) )
+        self.assertFalse( cache.tileDirty('stack1', 700) )
+        # new stacks start dirty
+        cache.addStack('stack2')
+        self.assertTrue( cache.tileDirty('stack2', 3) )
+
+    def testDroppedStackReleasesMemory( self ):
+        cache = _TilesCache('stack0', self.sims, maxstacks=1)
+        cache.setLayer('stack0', 'layer', 0, self._image())
+        self.assertEqual( cache.statistics()['memoryUsage'], self.nbytes )
+        cache.addStack('stack1')
+        self.assertEqual( cache.statistics()['memoryUsage'], 0 )
+
+
+class TilesCacheContentionTest( ut.TestCase ):
+    N_WRITERS = 4
+    N_TILES = 64
+    N_LOOKUPS = 2000
+
+    def setUp( self ):
+        self.cache = _TilesCache('stack', StackedImageSources( LayerStackModel() ))
+        self.img = QImage(16, 16, QImage.Format_ARGB32_Premultiplied)
+
+    def _lookups( self, n ):
+        cache = self.cache
+        for i in xrange(n):
+            tile_id = i % self.N_TILES
+            cache.tile('stack', tile_id)
+            cache.tileDirty('stack', tile_id)
+            cache.layer('stack', 'layer', tile_id)
+            cache.layerDirty('stack', 'layer', tile_id)
+
+    def testLookupsDoNotWaitForWriters( self ):
+        finished = threading.Event()
+        def lookup():
+            self._lookups(self.N_TILES)
+            finished.set()
+
+        # simulate a render thread that holds the lock
+        self.cache._lock.acquire()
+        try:
+            t = threading.Thread(target=lookup)
+            t.daemon = True
+            t.start()
+            finished.wait(2.0)
+            self.assertTrue( finished.is_set() )
+        finally:
+            self.cache._lock.release()
+
+    def testConcurrentLookupsAndWriters( self ):
+        stop = threading.Event()
+        errors = []
+        def write():
+            i = 0
+            try:
+                while not stop.is_set():
+                    i += 1
+                    self.cache.updateTileIfNecessary('stack', 'layer', i % self.N_TILES,
+                                                     time.time(), self.img)
+            except Exception as e:
+                errors.append(e)
+
+        writers = [threading.Thread(target=write) for i in range(self.N_WRITERS)]
+        for w in writers:
+            w.start()
+        try:
+            self._lookups(self.N_LOOKUPS)
+        finally:
+            stop.set()
+            for w in writers:
+                w.join()
+
+        self.assertEqual( errors, [] )
+        stats = self.cache.statistics()
+        self.assertEqual( stats['layerHits'] + stats['layerMisses'], self.N_LOOKUPS )
+        for tile_id in range(self.N_TILES):
+            self.assertTrue( self.cache.layer('stack', 'layer', tile_id) in (None, self.img) )
+
+
+class RequestSchedulerTest( ut.TestCase ):
+    def setUp( self ):
+        self.live = set(['stack0'])
+        self.dropped = []
+        self.scheduler = _RequestScheduler(lambda req: req[0] in self.live,
+                                           onDrop=self.dropped.append)
+
+    def testPriorityOrder( self ):
+        s = self.scheduler
+        s.put_nowait(('stack0', 'far'), (0, 3, 0.0), 'far')
+        s.put_nowait(('stack0', 'prefetch'), (2, 0, 0.0), 'prefetch')
+        s.put_nowait(('stack0', 'expensive'), (0, 0, 1.0), 'expensive')
+        s.put_nowait(('stack0', 'cheap'), (0, 0, 0.1), 'cheap')
+        s.put_nowait(('stack0', 'newer'), (0, 0, 0.1), 'newer')
+        order = []
+        for i in range(5):
+            order.append(s.get_nowait()[1])
+            s.task_done()
+        self.assertEqual( order, ['newer', 'cheap', 'expensive', 'far', 'prefetch'] )
+        self.assertRaises( Empty, s.get, True, 0.01 )
+        s.join()
+
+    def testSupersededRequestIsCancelled( self ):
+        s = self.scheduler
+        s.put_nowait(('stack0', 'old'), (0, 0, 0.0), 'layer tile')
+        s.put_nowait(('stack0', 'new'), (0, 0, 0.0), 'layer tile')
+        self.assertEqual( s.get_nowait()[1], 'new' )
+        s.task_done()
+        self.assertRaises( Empty, s.get_nowait )
+        s.join()
+        self.assertEqual( s.statistics()['cancelled'], 1 )
+
+    def testStaleRequestsAreDropped( self ):
+        s = self.scheduler
+        s.put_nowait(('stack0', 'a'), (0, 0, 0.0), 'a')
+        s.put_nowait(('stack1', 'b'), (0, 0, 0.0), 'b')
+        s.put_nowait(('stack0', 'c'), (0, 0, 0.0), 'c')
+        self.assertEqual( s.statistics()['dropped'], 0 )
+        self.live = set(['stack1'])
+        s.dropStale()
+        self.assertEqual( s.statistics()['dropped'], 2 )
+        self.assertEqual( sorted(req[1] for req in self.dropped), ['a', 'c'] )
+        self.assertEqual( s.get_nowait()[1], 'b' )
+        s.task_done()
+        s.join()
+
+        # requests that became stale while queued are dropped on dequeue
+        s.put_nowait(('stack1', 'd'), (0, 0, 0.0), 'd')
+        self.live = set()
+        self.assertRaises( Empty, s.get_nowait )
+        s.join()
+        stats = s.statistics()
+        self.assertEqual( (stats['executed'], stats['dropped']), (1, 3) )
+        self.assertEqual( self.dropped[-1][1], 'd' )
+
 
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
@@ -134,6 +381,127 @@ class TileProviderTest( ut.TestCase ):
             tp.notifyThreadsToStop()
             tp.joinThreads()
 
+    def testIncrementalCompositing( self ):
+        self.layer1.visible = True
+        self.layer1.opacity = 1.0
+        self.layer2.opacity = 0.5
+        self.layer3.opacity = 0.5
+        rect = QRectF(100,100,200,200)
+
+        def render( tp ):
+            tp.requestRefresh(rect)
+            tp.join()
+            return [byte_view(tile.qimg).copy() for tile in tp.getTiles(rect)]
+
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        tp_full = TileProvider(tiling, self.sims, incremental_compositing=False)
+        try:
+            render(tp)
+            # repeatedly update the middle layer, the blend of the bottom
+            # layer is reused
+            for gray in (10, 20, 30):
+                self.ds2.constant = gray
+                tiles, expected = render(tp), render(tp_full)
+                self.assertEqual( len(tiles), len(expected) )
+                for aimg, eimg in zip(tiles, expected):
+                    self.assertTrue( np.all(aimg == eimg) )
+        finally:
+            for p in (tp, tp_full):
+                p.notifyThreadsToStop()
+                p.joinThreads()
+
+
+    def testSetTiling( self ):
+        rect = QRectF(100,100,200,200)
+        small, large = Tiling((900,400), blockSize=100), Tiling((900,400), blockSize=200)
+        tp = TileProvider(small, self.sims)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            smallTiles = dict((tile.id, tile.qimg) for tile in tp.getTiles(rect))
+
+            tp.setTiling(large)
+            tp.requestRefresh(rect)
+            tp.join()
+            for tile in tp.getTiles(rect):
+                self.assertTrue( tile.tiling is large )
+                self.assertEqual( tile.qimg.size(), large.imageRects[tile.id].size() )
+
+            # the tiles of the previous tiling are reused...
+            tp.setTiling(small)
+            for tile in tp.getTiles(rect):
+                self.assertTrue( tile.qimg is smallTiles[tile.id] )
+
+            # ...but were marked dirty while another tiling was active
+            tp.setTiling(large)
+            self.ds3.constant = 200
+            tp.setTiling(small)
+            stack_id = tp._current_stack_id
+            for tile_no in small.intersected(rect):
+                self.assertTrue( tp._cache.tileDirty(stack_id, tile_no) )
+            tp.join()
+            for tile in tp.getTiles(rect):
+                self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0:3] == 200) )
+
+            # only the cache of the previous tiling is kept, and all
+            # caches share the memory budget
+            tp.setTiling(Tiling((900,400), blockSize=150))
+            self.assertEqual( tp._inactiveTilings.keys(), [100] )
+            caches = [tp._cache] + [cache for tiling, cache in tp._inactiveTilings.values()]
+            self.assertEqual( sum(cache._maxmemory for cache in caches), tp._cache_memory )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+    def testTilesAreNotRecycled( self ):
+        rect = QRectF(100,100,200,200)
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            tiles = [tile.qimg for tile in tp.getTiles(rect)]
+            contents = [byte_view(qimg).copy() for qimg in tiles]
+            # replaced tiles may still be painted by the GUI, so they
+            # are not given back to the image pool and reused
+            for gray in (10, 20, 30):
+                self.ds2.constant = gray
+                tp.requestRefresh(rect)
+                tp.join()
+                for tile in tp.getTiles(rect):
+                    self.assertTrue( np.all(byte_view(tile.qimg)[:,:,3] == 255) )
+            for qimg, content in zip(tiles, contents):
+                self.assertTrue( np.all(byte_view(qimg) == content) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testMetrics( self ):
+        self.layer1.name, self.layer2.name, self.layer3.name = "a", "b", "c"
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(QRectF(100,100,200,200))
+            tp.join()
+            list(tp.getTiles(QRectF(100,100,200,200)))
+            m = tp.metricsSnapshot()
+            self.assertTrue( m['pipeline']['tiles']['count'] > 0 )
+            self.assertTrue( m['pipeline']['composite']['count'] > 0 )
+            self.assertTrue( tp.tileOverhead() > 0 )
+            self.assertTrue( m['pipeline']['queueDepth']['count'] > 0 )
+            # the invisible layer is not requested
+            self.assertEqual( m['layers']['a'], {} )
+            for name in ('b', 'c'):
+                for key in ('queued', 'wait', 'convert'):
+                    self.assertTrue( m['layers'][name][key]['count'] > 0 )
+            self.assertTrue( 0 < m['cache']['tileHitRatio'] <= 1 )
+            self.assertEqual( sorted(json.loads(tp.metricsJson())['layers']), sorted(m['layers']) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
 
 class DirtyPropagationTest( ut.TestCase ):
 
@@ -254,5 +622,221 @@ class DirtyPropagationTest( ut.TestCase ):
             tp.joinThreads()
 
 
+    def testPartialRefresh( self ):
+        self.lsm.append(self.layer1)
+        self.lsm.append(self.layer2)
+        sims = self.pump.stackedImageSources
+        ims1, ims2 = sims._layerToIms[self.layer1], sims._layerToIms[self.layer2]
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, sims)
+        try:
+            rect = QRectF(101,101,98,98)
+            tp.requestRefresh(rect)
+            tp.join()
+            tile_no = tiling.intersected(rect)[0]
+            stack_id = tp._current_stack_id
+            before = tp._cache.layer(stack_id, ims1, tile_no)
+
+            # change a small part of the tile on the current z-slice
+            slicing = (slice(None), slice(120,150), slice(130,160),
+                       slice(0,1), slice(None))
+            self.ds1._array[slicing] = 99
+            self.ds1.setDirty( slicing )
+
+            # only the changed layer is dirty, and only within the change
+            self.assertTrue( tp._cache.layerDirty(stack_id, ims1, tile_no) )
+            self.assertFalse( tp._cache.layerDirty(stack_id, ims2, tile_no) )
+            self.assertEqual( tp._cache.layerDirtyRect(stack_id, ims1, tile_no),
+                              QRect(120,130,30,30) )
+
+            tp.requestRefresh(rect)
+            tp.join()
+            patch = tp._cache.layer(stack_id, ims1, tile_no)
+            self.assertTrue( patch is not before )
+            aimg = byte_view(patch)[:,:,0]
+            changed = np.zeros(aimg.shape, dtype=bool)
+            changed[30:60, 20:50] = True
+            self.assertTrue( np.all(aimg[changed] == 99) )
+            self.assertTrue( np.all(aimg[~changed] == 0) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class LevelOfDetailTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        data = (np.indices(dataShape)[1] % 256).astype(np.uint8) # Data is labeled according to x-index
+        self.ds = ArraySource( data )
+        self.layer = GrayscaleLayer( self.ds, normalize=False )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(self.layer)
+
+    def testDownsampledTiles( self ):
+        tiling = Tiling((900,400), blockSize=100, maxLevel=2)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+        try:
+            rect = QRectF(101,101,198,198)
+            tp.requestRefresh(rect)
+            tp.join()
+            fullResolution = dict((tile.id, tile.qimg) for tile in tp.getTiles(rect))
+
+            tp.setLevel(1)
+            # until the level is rendered, the full resolution tiles are shown
+            for tile in tp.getTiles(rect):
+                self.assertTrue( tile.qimg is fullResolution[tile.id] )
+            tp.join()
+            for tile in tp.getTiles(rect):
+                self.assertEqual( tile.qimg.size(), tiling.levelSize(tile.id, 1) )
+                aimg = byte_view(tile.qimg)
+                x = int(tile.rectF.x()) + 2*np.arange(aimg.shape[1])
+                self.assertTrue( np.all(aimg[:,:,0] == (x % 256)[np.newaxis,:]) )
+
+            # each level is cached separately
+            tp.setLevel(0)
+            for tile in tp.getTiles(rect):
+                self.assertTrue( tile.qimg is fullResolution[tile.id] )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class _UnorientableImageSource( GrayscaleImageSource ):
+    orientable = False
+
+class OrientationTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 300, 200, 1, 1) # t,x,y,z,c
+        x, y = np.indices(dataShape)[1:3]
+        self.ds = ArraySource( ((x + 3*y) % 256).astype(np.uint8) )
+        self.layer = GrayscaleLayer( self.ds, normalize=False )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(self.layer)
+
+    def _tiles( self, data2scene, axesSwapped, imageSourceClass ):
+        tiling = Tiling((300,200), data2scene, blockSize=64)
+        sims = StackedImageSources( self.lsm )
+        sims.register( self.layer, imageSourceClass(self.pump.stackedImageSources.getImageSource(0)._arraySource2D, self.layer) )
+        tp = TileProvider(tiling, sims)
+        tp.axesSwapped = axesSwapped
+        try:
+            rect = tiling.boundingRectF()
+            tp.requestRefresh(rect)
+            tp.join()
+            return [byte_view(tile.qimg).copy() for tile in tp.getTiles(rect)]
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testPatchesInSceneOrientation( self ):
+        for rotation in range(4):
+            for axesSwapped in (False, True):
+                data2scene = QTransform()
+                data2scene.rotate(90*rotation)
+                data2scene *= QTransform.fromTranslate(*[(0,0), (200,0), (300,200), (0,300)][rotation])
+                oriented = self._tiles(data2scene, axesSwapped, GrayscaleImageSource)
+                transformed = self._tiles(data2scene, axesSwapped, _UnorientableImageSource)
+                self.assertEqual( len(oriented), len(transformed) )
+                for a, b in zip(oriented, transformed):
+                    self.assertEqual( a.shape, b.shape )
+                    self.assertTrue( np.all(a == b) )
+
+
+class _BlockingRequest( ArrayRequest ):
+    '''Blocks in wait() until cancelled, like a long running lazyflow request.'''
+    def __init__( self, array, slicing, source ):
+        super(_BlockingRequest, self).__init__(array, slicing)
+        self._source = source
+        self._cancelled = threading.Event()
+
+    def wait( self ):
+        self._source.started.set()
+        self._cancelled.wait(5.0)
+        if self._cancelled.is_set():
+            raise RuntimeError("request was cancelled")
+        return super(_BlockingRequest, self).wait()
+
+    def cancel( self ):
+        self._source.cancelled += 1
+        self._cancelled.set()
+
+class _BlockingSource( ArraySource ):
+    def __init__( self, array ):
+        super(_BlockingSource, self).__init__(array)
+        self.started = threading.Event()
+        self.cancelled = 0
+        self.blocking = True
+
+    def request( self, slicing ):
+        if not self.blocking:
+            return ArrayRequest(self._array, slicing)
+        return _BlockingRequest(self._array, slicing, self)
+
+class CancellationTest( ut.TestCase ):
+    def setUp( self ):
+        self.ds = _BlockingSource( np.zeros((1, 900, 400, 10, 1), dtype=np.uint8) )
+        self.layer = GrayscaleLayer( self.ds, normalize=False )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(self.layer)
+
+    def testSliceChangeCancelsRunningRequests( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+        try:
+            tp.requestRefresh(QRectF(0,0,100,100))
+            self.assertTrue( self.ds.started.wait(2.0) )
+
+            start = time.time()
+            self.pump.syncedSliceSources.through = [0,1,0]
+            tp.join()
+            self.assertTrue( time.time() - start < 2.0 )
+            self.assertEqual( self.ds.cancelled, 1 )
+            self.assertEqual( tp.schedulerStatistics()['cancelledInFlight'], 1 )
+
+            # back on the first slice, the cancelled tile is rendered
+            self.ds.blocking = False
+            self.pump.syncedSliceSources.through = [0,0,0]
+            tiles = self._renderAll(tp, QRectF(0,0,100,100))
+            self.assertTrue( all(t.progress == 1.0 for t in tiles) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testDroppedRequestsAreRequestedAgain( self ):
+        # with one render thread, the first request blocks and the
+        # others stay queued until they are dropped by the slice change
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, n_threads=1)
+        rect = QRectF(0,0,200,200)
+        try:
+            tp.requestRefresh(rect)
+            self.assertTrue( self.ds.started.wait(2.0) )
+            self.ds.blocking = False
+            self.pump.syncedSliceSources.through = [0,1,0]
+            tp.join()
+            self.assertEqual( tp.schedulerStatistics()['refresh']['dropped'], 3 )
+
+            # back on the first slice, the dropped tiles are rendered
+            self.pump.syncedSliceSources.through = [0,0,0]
+            tiles = self._renderAll(tp, rect)
+            self.assertEqual( len(tiles), 4 )
+            self.assertTrue( all(t.progress == 1.0 for t in tiles) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def _renderAll( self, tp, rect ):
+        for i in range(10):
+            tp.requestRefresh(rect)
+            tp.join()
+            tiles = list(tp.getTiles(rect))
+            if all(t.progress == 1.0 for t in tiles):
+                break
+        return tiles
+
+
 if __name__=='__main__':
     ut.main()
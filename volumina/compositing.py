@@ -0,0 +1,140 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+#Python
+import sys
+
+#SciPy
+import numpy
+
+#PyQt
+from PyQt4.QtGui import QImage, QPainter
+from qimage2ndarray import byte_view
+
+from volumina.pixelpipeline.imagepool import imagePool
+
+_has_numexpr = True
+try:
+    import numexpr
+except ImportError:
+    _has_numexpr = False
+
+# index of the alpha byte of a 32 bit pixel in byte_view()
+_ALPHA = 3 if sys.byteorder == 'little' else 0
+
+#*******************************************************************************
+# C o m p o s i t o r                                                          *
+#*******************************************************************************
+
+class Compositor( object ):
+    '''
+    Blends layer patches on top of each other.
+
+    The canvas is a QImage in Format_ARGB32_Premultiplied, taken from
+    the image pool. Layers are given bottom-up as a sequence of
+    (opacity, patch) pairs and are blended with the 'source over'
+    operator, scaled by the layer opacity.
+
+    '''
+    def newCanvas( self, size ):
+        qimg = imagePool.take(size.width(), size.height())
+        qimg.fill(0xffffffff)
+        return qimg
+
+    def blend( self, canvas, layers ):
+        raise NotImplementedError
+
+#*******************************************************************************
+# Q P a i n t e r C o m p o s i t o r                                          *
+#*******************************************************************************
+
+class QPainterCompositor( Compositor ):
+    def blend( self, canvas, layers ):
+        if not layers:
+            return
+        p = QPainter(canvas)
+        for opacity, patch in layers:
+            p.setOpacity(opacity)
+            p.drawImage(0,0, patch)
+        p.end()
+
+#*******************************************************************************
+# N u m p y C o m p o s i t o r                                                *
+#*******************************************************************************
+
+class NumpyCompositor( Compositor ):
+    '''
+    Blends directly on the pixel buffers with vectorized array operations.
+
+    All layers of one call are accumulated in a single float32 buffer,
+    which is converted back to bytes only once. numexpr is used for the
+    per-layer arithmetic if it is installed.
+
+    '''
+    def __init__( self, use_numexpr=None ):
+        if use_numexpr is None:
+            use_numexpr = _has_numexpr
+        assert not use_numexpr or _has_numexpr, "numexpr is not installed"
+        self._use_numexpr = use_numexpr
+
+    def blend( self, canvas, layers ):
+        if not layers:
+            return
+        dst = byte_view(canvas)
+        h, w = dst.shape[:2]
+        acc = dst.astype(numpy.float32)
+        for opacity, patch in layers:
+            if opacity <= 0:
+                continue
+            if patch.format() != QImage.Format_ARGB32_Premultiplied:
+                patch = patch.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            src = byte_view(patch)[:h, :w]
+            a = acc[:src.shape[0], :src.shape[1]]
+            self._over(a, src, float(opacity))
+        numpy.add(acc, 0.5, out=acc)
+        numpy.clip(acc, 0, 255, out=acc)
+        dst[...] = acc
+
+    def _over( self, acc, src, opacity ):
+        # premultiplied source over: acc = src*o + acc*(1 - alpha(src)*o)
+        sa = src[..., _ALPHA:_ALPHA+1]
+        k = opacity / 255.
+        if self._use_numexpr:
+            numexpr.evaluate('src*opacity + acc*(1 - sa*k)', out=acc,
+                             casting='unsafe')
+        else:
+            s = src.astype(numpy.float32)
+            inv = 1 - sa.astype(numpy.float32) * k
+            acc *= inv
+            s *= opacity
+            acc += s
+
+#*******************************************************************************
+# c r e a t e C o m p o s i t o r                                              *
+#*******************************************************************************
+
+compositors = { 'qpainter' : QPainterCompositor,
+                'numpy'    : NumpyCompositor }
+
+def createCompositor( compositor ):
+    '''Return a Compositor, given either an instance or one of the names in 'compositors'.'''
+    if isinstance(compositor, Compositor):
+        return compositor
+    try:
+        return compositors[compositor]()
+    except KeyError:
+        raise ValueError("unknown compositor '%s', choose one of %s"
+                         % (compositor, sorted(compositors.keys())))
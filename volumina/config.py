@@ -20,6 +20,27 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+image_pool_mb: 64
+coalesce_requests: true
+minmax_samples: 65536
+minmax_percentiles: 0, 100
+minmax_interval_ms: 250
+volume_statistics: true
+statistics_block_mb: 16
+statistics_delay_ms: 2000
+chunk_cache_mb: 256
+
+[tiling]
+cache_memory_mb: 1024
+compositor: qpainter
+max_lod_level: 4
+adaptive_block_size: false
+tile_overhead_ms: 2.0
+pixel_cost_ns: 20
+
+[metrics]
+history: 512
+interval: 1.0
 """
 
 cfg = ConfigParser.SafeConfigParser()
@@ -22,6 +22,7 @@ from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolyg
                         QGraphicsRectItem
 
 from volumina.tiling import Tiling, TileProvider, TiledImageLayer
+from volumina.config import cfg
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
 
@@ -98,6 +99,14 @@ class DirtyIndicator(QGraphicsItem):
             self._last_zero = False
         self.update(self._tiling.tileRectFs[tileId])
 
+    def setTiling(self, tiling):
+        self.prepareGeometryChange()
+        self._tiling = tiling
+        self._indicate = numpy.zeros(len(tiling))
+        self._zeroProgressTimestamp = [datetime.datetime.now()] * len(tiling)
+        self._last_zero = False
+        self.update()
+
 #*******************************************************************************
 # I m a g e S c e n e 2 D                                                      *
 #*******************************************************************************
@@ -211,7 +220,8 @@ class ImageScene2D(QGraphicsScene):
     def _finishViewMatrixChange(self):
         self.scene2data, isInvertible = self.data2scene.inverted()
         self._setSceneRect()
-        self._tiling.data2scene = self.data2scene
+        for tiling in self._tilings.values():
+            tiling.data2scene = self.data2scene
         self._tileProvider._onSizeChanged()
         QGraphicsScene.invalidate(self, self.sceneRect())
 
@@ -255,7 +265,7 @@ class ImageScene2D(QGraphicsScene):
 
     def setCacheSize(self, cache_size):
         if cache_size != self._tileProvider._cache_size:
-            self._tileProvider = TileProvider(self._tiling, self._stackedImageSources, cache_size=cache_size)
+            self._tileProvider = TileProvider(self._tileProvider.tiling, self._stackedImageSources, cache_size=cache_size)
             self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
 
     def cacheSize(self):
@@ -286,6 +296,9 @@ class ImageScene2D(QGraphicsScene):
         self.resetAxes(finish=False)
 
         self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name)
+        # tilings by block size, see _adaptBlockSize()
+        self._tilings = {self._tiling.blockSize: self._tiling}
+        self._blockSizeDecidedFor = None
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
         if self._tileProvider:
@@ -387,6 +400,13 @@ class ImageScene2D(QGraphicsScene):
         if self._tileProvider is None:
             return
 
+        # render zoomed out views from a coarser pyramid level
+        scale = math.sqrt(abs(painter.worldTransform().determinant()))
+        if cfg.getboolean('tiling', 'adaptive_block_size') and self.views():
+            self._adaptBlockSize(scale)
+        tiling = self._tileProvider.tiling
+        self._tileProvider.setLevel(tiling.levelForScale(scale))
+
         tiles = self._tileProvider.getTiles(sceneRectF)
         allComplete = True
         for tile in tiles:
@@ -396,6 +416,9 @@ class ImageScene2D(QGraphicsScene):
             #See also ilastik issue #132 and tests/lazy_test.py
             if tile.qimg is not None:
                 painter.drawImage(tile.rectF, tile.qimg)
+            if tile.tiling is not tiling:
+                # stand-in from the previous block size
+                continue
             if tile.progress < 1.0:
                 allComplete = False
             if self._showTileProgress:
@@ -411,6 +434,37 @@ class ImageScene2D(QGraphicsScene):
             for through in self._bowWave(self._n_preemptive):
                 self._tileProvider.prefetch(sceneRectF, through)
 
+    def _adaptBlockSize(self, scale):
+        '''Switch to the tile size that is cheapest to render at the current
+        zoom, given the size of the viewport and the measured cost of the
+        visible layers and of compositing. Nothing is decided before a tile
+        was rendered, and only when the zoom or the viewport changed.
+
+        '''
+        sims = self._stackedImageSources
+        timePerPixel = sum(layer.averageTimePerPixel for layer in sims.getRegisteredLayers()
+                           if layer.visible)
+        tileOverhead = self._tileProvider.tileOverhead()
+        if timePerPixel == 0 or tileOverhead is None:
+            return
+        viewportSize = self.views()[0].viewport().size()
+        key = (scale, viewportSize.width(), viewportSize.height())
+        if key == self._blockSizeDecidedFor:
+            return
+        self._blockSizeDecidedFor = key
+        blockSize = self._tileProvider.tiling.chooseBlockSize(viewportSize, scale, timePerPixel,
+                                                              tileOverhead=tileOverhead)
+        if blockSize != self._tileProvider.tiling.blockSize:
+            self._setBlockSize(blockSize)
+
+    def _setBlockSize(self, blockSize):
+        if blockSize not in self._tilings:
+            tiling = Tiling(self._dataShape, self.data2scene, blockSize=blockSize, name=self.name)
+            self._tilings[blockSize] = tiling
+        tiling = self._tilings[blockSize]
+        self._tileProvider.setTiling(tiling)
+        self._dirtyIndicator.setTiling(tiling)
+
     def joinRendering(self):
         return self._tileProvider.join()
 
@@ -22,7 +22,7 @@ from PyQt4.QtGui import QColor
 
 from volumina.interpreter import ClickInterpreter
 from volumina.pixelpipeline.asyncabcs import SourceABC
-from volumina.pixelpipeline.datasources import MinMaxSource 
+from volumina.pixelpipeline.datasources import MinMaxSource, channelSources
 
 from functools import partial
 
@@ -144,6 +144,8 @@ class Layer( QObject ):
         #compute cumulative moving average
         self._numTiles += 1
         self.averageTimePerTile = (timeSec + (self._numTiles-1)*self.averageTimePerTile) / self._numTiles
+        pixels = max(1, tileRect.width()*tileRect.height())
+        self.averageTimePerPixel = (timeSec/pixels + (self._numTiles-1)*self.averageTimePerPixel) / self._numTiles
 
     def toolTip(self):
         return self._toolTip
@@ -176,11 +178,11 @@ class Layer( QObject ):
         for datasource in filter(None, self._datasources):
             datasource.numberOfChannelsChanged.connect( self._updateNumberOfChannels )
 
-        if self.direct:
-            #in direct mode, we calculate the average time per tile for debug purposes
-            #this is useful to identify which of your layers cause slowness
-            self.averageTimePerTile = 0.0
-            self._numTiles = 0
+        #the average time per tile is useful to identify which of your layers cause
+        #slowness; the tile provider also uses it to schedule cheap layers first
+        self.averageTimePerTile = 0.0
+        self.averageTimePerPixel = 0.0
+        self._numTiles = 0
 
         self.visibleChanged.connect(self.changed)
         self.opacityChanged.connect(self.changed)
@@ -340,6 +342,11 @@ class NormalizableLayer( Layer ):
         self.rangeChanged.connect(self.changed)
         self.normalizeChanged.connect(self.changed)
 
+        # stable bounds from the statistics of the whole data
+        if normalize is None:
+            for mmSource in self._mmSources:
+                mmSource.precomputeBounds()
+
     def _bounds_changed(self, datasourceIdx, range):
         if self._autoMinMax[datasourceIdx]:
             self.set_normalize(datasourceIdx, None)
@@ -510,7 +517,10 @@ class RGBALayer( NormalizableLayer ):
         self._alpha_missing_value = alpha_missing_value
 
     @classmethod
-    def createFromMultichannel(cls, data):
-        # disect data
-        l = RGBALayer()
-        return l
+    def createFromMultichannel(cls, data, **kwargs):
+        '''RGBA layer of the first (up to four) channels of the
+        multichannel source 'data'. The channels of a tile are
+        fetched with a single request of data.'''
+        n = min(data.numberOfChannels, 4)
+        channels = channelSources(data, range(n)) + [None]*(4-n)
+        return cls(*channels, **kwargs)
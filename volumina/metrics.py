@@ -0,0 +1,130 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+#Python
+import time
+from threading import Lock
+
+#SciPy
+import numpy
+
+from volumina.config import cfg
+
+#*******************************************************************************
+# R i n g B u f f e r                                                          *
+#*******************************************************************************
+
+class RingBuffer( object ):
+    '''
+    Keeps the most recent 'size' samples of a float series.
+
+    Appending is O(1) and does not allocate; older samples are
+    overwritten. 'count' is the number of samples ever appended.
+
+    '''
+    def __init__( self, size ):
+        assert size > 0
+        self._data = numpy.zeros(size)
+        self._times = numpy.zeros(size)
+        self._lock = Lock()
+        self.count = 0
+
+    def __len__( self ):
+        return min(self.count, len(self._data))
+
+    def append( self, value, t=None ):
+        if t is None:
+            t = time.time()
+        with self._lock:
+            i = self.count % len(self._data)
+            self._data[i] = value
+            self._times[i] = t
+            self.count += 1
+
+    def values( self ):
+        '''Return (samples, timestamps), oldest first.'''
+        with self._lock:
+            n, size = self.count, len(self._data)
+            if n <= size:
+                return self._data[:n].copy(), self._times[:n].copy()
+            i = n % size
+            return (numpy.concatenate((self._data[i:], self._data[:i])),
+                    numpy.concatenate((self._times[i:], self._times[:i])))
+
+    def summary( self ):
+        '''Return a dict with the total count and the statistics of
+        the samples in the buffer; 'rate' is the number of samples
+        per second.'''
+        values, times = self.values()
+        summary = {'count': self.count, 'samples': len(values)}
+        if len(values) == 0:
+            return summary
+        summary.update(mean = float(values.mean()),
+                       min = float(values.min()),
+                       max = float(values.max()),
+                       median = float(numpy.percentile(values, 50)),
+                       p95 = float(numpy.percentile(values, 95)),
+                       last = float(values[-1]))
+        if len(values) > 1 and times[-1] > times[0]:
+            summary['rate'] = (len(values) - 1) / float(times[-1] - times[0])
+        return summary
+
+#*******************************************************************************
+# M e t r i c s                                                                *
+#*******************************************************************************
+
+class Metrics( object ):
+    '''
+    A named set of RingBuffers.
+
+    Recording a sample is cheap enough to be done for every tile from
+    the render threads; summaries are computed only in snapshot().
+    Times are recorded in seconds.
+
+    '''
+    def __init__( self, size=None ):
+        if size is None:
+            size = cfg.getint('metrics', 'history')
+        self._size = size
+        self._series = {}
+        self._lock = Lock()
+
+    def record( self, name, value ):
+        '''Append a sample to the series 'name'.'''
+        try:
+            series = self._series[name]
+        except KeyError:
+            with self._lock:
+                series = self._series.setdefault(name, RingBuffer(self._size))
+        series.append(value)
+
+    def mark( self, name ):
+        '''Record an event, e.g. a rendered tile; snapshot() reports its rate.'''
+        self.record(name, 1.0)
+
+    def series( self, name ):
+        return self._series[name]
+
+    def names( self ):
+        return self._series.keys()
+
+    def snapshot( self ):
+        '''Return a dict of the summaries (see RingBuffer.summary()) of all series.'''
+        return dict((name, series.summary()) for name, series in self._series.items())
+
+    def reset( self ):
+        with self._lock:
+            self._series = {}
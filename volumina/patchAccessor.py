@@ -91,16 +91,21 @@ class PatchAccessor():
         sy = int(numpy.floor(1.0 * starty / self._blockSize))
         ey = int(numpy.ceil(1.0 * endy / self._blockSize))
 
-        # Clip to rect bounds
+        # Clip to rect bounds; the last patches include the merged
+        # remainder of the shape
         sx = max(sx, 0)
         sy = max(sy, 0)
+        if startx < self.size_x:
+            sx = min(sx, self._cX - 1)
+        if starty < self.size_y:
+            sy = min(sy, self._cY - 1)
         ex = min(ex, self._cX)
         ey = min(ey, self._cY)
 
-        nums = []
-        for y in range(sy,ey):
-            nums += range(y*self._cX+sx, y*self._cX+ex)
-        return nums
+        if sx >= ex or sy >= ey:
+            return []
+        nums = numpy.arange(sy, ey)[:, numpy.newaxis] * self._cX + numpy.arange(sx, ex)
+        return nums.ravel().tolist()
 
 if __name__ == "__main__":
     pa = PatchAccessor(1000,1000, 100)
@@ -110,3 +115,7 @@ if __name__ == "__main__":
     assert pa.patchRectF(1) == QRectF(100,0,100,100)
     
     assert pa.getPatchesForRect( 50, 50, 150, 150 ) == [0, 1, 10, 11]
+
+    # the remainder of 20 is merged into the last patch
+    pa = PatchAccessor(1020,100, 100)
+    assert pa.getPatchesForRect( 1005, 0, 1010, 50 ) == [9]
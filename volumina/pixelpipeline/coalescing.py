@@ -0,0 +1,276 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''Sharing of datasource requests between several consumers.
+
+A SharedRequest wraps a datasource request whose result is needed by
+several consumers, e.g. the image sources of two layers showing the
+same data, or of the three orthogonal views. Each consumer gets its own
+SharedRequestView, so that the request is only cancelled when all of
+its consumers cancelled.
+
+The RequestCoalescer shares the in-flight requests of the same source
+and region.
+
+'''
+
+#Python
+import threading
+import weakref
+from collections import OrderedDict
+from functools import partial
+
+#PyQt
+from PyQt4.QtCore import Qt
+
+from asyncabcs import RequestABC
+from volumina.config import cfg
+
+def region( slicing ):
+    '''Hashable key of a slicing.'''
+    return tuple((s.start, s.stop, s.step) if isinstance(s, slice) else s for s in slicing)
+
+#*******************************************************************************
+# S h a r e d R e q u e s t                                                    *
+#*******************************************************************************
+
+class SharedRequest( object ):
+    '''
+    A request with several consumers.
+
+    The wrapped request is waited for, submitted and notified at most
+    once; its result is passed to all consumers. The request is done
+    once its result is available, waiting for it failed or all
+    consumers cancelled; 'onDone' is then called without arguments. A
+    done request gets no new consumers.
+
+    '''
+    def __init__( self, request, onDone=None ):
+        self._request = request
+        self._onDone = onDone
+        self._lock = threading.Lock()
+        self._waitLock = threading.Lock()
+        self._result = None
+        self._callbacks = None
+        self._submitted = False
+        self.consumers = 0
+        self.cancelled = 0
+        self.done = False
+
+    def view( self ):
+        '''Return the request of a new consumer, or None if the request
+        is done.'''
+        if not self.share():
+            return None
+        return SharedRequestView(self)
+
+    def share( self ):
+        '''Count a new consumer, see view(). Returns False if the
+        request is done.'''
+        with self._lock:
+            if self.done:
+                return False
+            self.consumers += 1
+            return True
+
+    def wait( self ):
+        try:
+            with self._waitLock:
+                if self._result is None:
+                    self._result = self._request.wait()
+        finally:
+            self._finish()
+        return self._result
+
+    def getResult( self ):
+        if self._result is None:
+            self._result = self._request.getResult()
+        return self._result
+
+    def submit( self ):
+        with self._lock:
+            if self._submitted:
+                return
+            self._submitted = True
+        self._request.submit()
+
+    def cancel( self ):
+        # only cancel the request when none of its consumers needs it
+        # anymore; it is done before share() can count a new consumer
+        with self._lock:
+            self.cancelled += 1
+            if self.cancelled < self.consumers or self.done:
+                return
+            self.done = True
+        self._request.cancel()
+        if self._onDone is not None:
+            self._onDone()
+
+    def adjustPriority( self, delta ):
+        if hasattr(self._request, 'adjustPriority'):
+            self._request.adjustPriority(delta)
+
+    def notify( self, callback ):
+        '''callback( result ) is called when the result is available.'''
+        with self._lock:
+            pending = self._result is None
+            if pending:
+                first = self._callbacks is None
+                if first:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+        if not pending:
+            callback(self._result)
+        elif first:
+            self._request.notify(self._onNotify)
+
+    def _onNotify( self, result, **kwargs ):
+        # lazyflow requests do not pass their result
+        with self._lock:
+            if self._result is None:
+                self._result = self._request.getResult()
+            callbacks, self._callbacks = self._callbacks, []
+        self._finish()
+        for callback in callbacks:
+            callback(self._result)
+
+    def _finish( self ):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+        if self._onDone is not None:
+            self._onDone()
+
+class SharedRequestView( object ):
+    '''The request of one consumer of a SharedRequest.'''
+    def __init__( self, shared ):
+        self._shared = shared
+
+    def wait( self ):
+        return self._select(self._shared.wait())
+
+    def getResult( self ):
+        return self._select(self._shared.getResult())
+
+    def cancel( self ):
+        self._shared.cancel()
+
+    def submit( self ):
+        self._shared.submit()
+
+    def adjustPriority( self, delta ):
+        self._shared.adjustPriority(delta)
+        return self
+
+    # callback( result = result, **kwargs )
+    def notify( self, callback, **kwargs ):
+        self._shared.notify(lambda result: callback(self._select(result), **kwargs))
+
+    def _select( self, result ):
+        '''The part of the shared result for this consumer.'''
+        return result
+assert issubclass(SharedRequestView, RequestABC)
+
+#*******************************************************************************
+# R e q u e s t C o a l e s c e r                                              *
+#*******************************************************************************
+
+class RequestCoalescer( object ):
+    '''
+    Shares the in-flight requests of the same source and region.
+
+    request(source, slicing) returns a view of a pending request of the
+    same source object and slicing, or of a new request of the source.
+    A request is in flight until it is done (see SharedRequest) or its
+    region becomes dirty; later requests of the region get a new
+    request, so that they see changes of the data. At most 'maxPending'
+    requests are tracked.
+
+    The coalescer is thread safe.
+
+    '''
+    def __init__( self, maxPending=256 ):
+        self._maxPending = maxPending
+        self._pending = OrderedDict() # (id(source), region) -> (source, SharedRequest)
+        self._lock = threading.RLock() # sources may request their own sources
+        self._watched = weakref.WeakKeyDictionary() # sources whose isDirty is connected
+        self.requests = 0
+        self.coalesced = 0
+
+    def request( self, source, slicing ):
+        if not cfg.getboolean('pixelpipeline', 'coalesce_requests'):
+            return source.request(slicing)
+        key = (id(source), region(slicing))
+        with self._lock:
+            self.requests += 1
+            self._watch(source)
+            entry = self._pending.get(key)
+            if entry is not None and entry[0] is source:
+                view = entry[1].view()
+                if view is not None:
+                    self.coalesced += 1
+                    return view
+            shared = SharedRequest(source.request(slicing), onDone=lambda: self._remove(key, shared))
+            self._pending[key] = (source, shared)
+            while len(self._pending) > self._maxPending:
+                self._pending.popitem(last=False)
+            return shared.view()
+
+    def statistics( self ):
+        '''Return a dict with the number of requests, of the coalesced
+        requests and of the requests in flight.'''
+        with self._lock:
+            return {'requests': self.requests,
+                    'coalesced': self.coalesced,
+                    'inFlight': len(self._pending)}
+
+    def _watch( self, source ):
+        if source in self._watched:
+            return
+        self._watched[source] = True
+        # the source must not be referenced by its own connection; direct,
+        # since the requesting threads may not run an event loop
+        source.isDirty.connect(partial(self._onSourceDirty, id(source)), type=Qt.DirectConnection)
+
+    def _onSourceDirty( self, sourceId, slicing ):
+        # drop the in-flight requests of the dirty region, they may miss
+        # the change
+        dirty = region(slicing)
+        with self._lock:
+            for key in list(self._pending):
+                if key[0] == sourceId and _overlaps(key[1], dirty):
+                    del self._pending[key]
+
+    def _remove( self, key, shared ):
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None and entry[1] is shared:
+                del self._pending[key]
+
+def _overlaps( a, b ):
+    '''Whether the regions a and b overlap; steps are ignored.'''
+    for ra, rb in zip(a, b):
+        aStart, aStop = ra[:2] if isinstance(ra, tuple) else (ra, ra + 1)
+        bStart, bStop = rb[:2] if isinstance(rb, tuple) else (rb, rb + 1)
+        if aStart is not None and bStop is not None and aStart >= bStop:
+            return False
+        if bStart is not None and aStop is not None and bStart >= aStop:
+            return False
+    return True
+
+# coalescer shared by the slice sources and the datasources
+requestCoalescer = RequestCoalescer()
@@ -0,0 +1,306 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''Conversion of 2D arrays to QImages for display.
+
+The converters write directly into the pixel buffer of a QImage,
+which may be passed in by the caller or is taken from the image pool,
+so that no intermediate images are created. Grayscale images are
+converted by vigra if it is installed; otherwise, and for colortables,
+the conversion is done with lookup tables in NumPy.
+
+'''
+
+#Python
+import sys
+import threading
+from collections import OrderedDict
+
+#SciPy
+import numpy
+
+#PyQt
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view, raw_view
+
+from imagepool import imagePool
+
+_has_vigra = True
+try:
+    import vigra
+except ImportError:
+    _has_vigra = False
+
+def _vigraHas( name ):
+    return _has_vigra and hasattr(vigra.colors, name)
+
+#*******************************************************************************
+# L o o k u p   t a b l e s                                                    *
+#*******************************************************************************
+
+# opaque gray ARGB32 pixel of each gray value
+_GRAY = (numpy.arange(256, dtype=numpy.uint32) * 0x010101) | 0xff000000
+
+class _LutCache( object ):
+    '''Least recently used lookup tables, by key.'''
+    def __init__( self, maxsize=16 ):
+        self._luts = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get( self, key, create ):
+        with self._lock:
+            lut = self._luts.pop(key, None)
+            if lut is None:
+                lut = create()
+            self._luts[key] = lut
+            while len(self._luts) > self._maxsize:
+                self._luts.popitem(last=False)
+            return lut
+
+_luts = _LutCache()
+
+def _grayLut( dtype, normalize ):
+    '''ARGB32 pixel for every value of an uint8 or uint16 dtype.'''
+    def create():
+        values = numpy.arange(numpy.iinfo(dtype).max + 1, dtype=numpy.float32)
+        gray = _scale(values, normalize)
+        return _GRAY.take(gray)
+    return _luts.get((numpy.dtype(dtype).str, normalize), create)
+
+def _scale( a, normalize ):
+    '''Map [nmin, nmax] linearly to the uint8 range [0, 255], clipping.'''
+    nmin, nmax = normalize
+    t = numpy.subtract(a, nmin, dtype=numpy.float32)
+    t *= 255.0 / (nmax - nmin)
+    numpy.clip(t, 0, 255, out=t)
+    return t.astype(numpy.uint8)
+
+def _channelLut( dtype, normalize ):
+    '''uint8 value of every value of an 8 or 16 bit integer dtype.'''
+    def create():
+        unsigned = numpy.dtype('u%d' % dtype.itemsize)
+        values = numpy.arange(2**(8*dtype.itemsize)).astype(unsigned).view(dtype)
+        if normalize is None:
+            return values.astype(numpy.uint8)
+        return _scale(values, normalize)
+    return _luts.get(('channel', dtype.str, normalize), create)
+
+def _premultiplied():
+    # _PREMULTIPLIED[a << 8 | c] is the color component c premultiplied
+    # by the alpha a, rounded
+    alpha, c = numpy.divmod(numpy.arange(2**16), 256)
+    return ((alpha * c + 127) // 255).astype(numpy.uint8)
+
+_PREMULTIPLIED = _premultiplied()
+
+# byte offsets of the red, green, blue and alpha component of an ARGB32 pixel
+_RGBA_BYTES = (2, 1, 0, 3) if sys.byteorder == 'little' else (1, 2, 3, 0)
+
+def _normalization( normalize ):
+    if normalize is None or normalize[0] >= normalize[1]:
+        return (0, 255)
+    return tuple(normalize)
+
+def _target( shape, out, format=QImage.Format_ARGB32_Premultiplied ):
+    h, w = shape
+    if out is None:
+        return imagePool.take(w, h, format)
+    assert out.format() == format
+    assert (out.height(), out.width()) == (h, w), \
+           "image size %dx%d does not match array shape %r" % (out.width(), out.height(), shape)
+    return out
+
+#*******************************************************************************
+# g r a y 2 a r g b                                                            *
+#*******************************************************************************
+
+def gray2argb( a, normalize=None, out=None, use_vigra=None ):
+    '''Convert a 2D array to an opaque gray QImage in Format_ARGB32_Premultiplied.
+
+    normalize -- (nmin, nmax); values are mapped linearly from this range
+                 to [0, 255] and clipped. None or an empty range mean (0, 255).
+    out       -- QImage of matching size and format to write into; an
+                 image is taken from the image pool if None
+    use_vigra -- use vigra's converter (default: if it is installed)
+
+    The array may be a strided view, e.g. of a downsampled slice.
+    uint8 and uint16 arrays are converted with a cached lookup table.
+
+    '''
+    assert a.ndim == 2, "gray2argb(): array has shape %r, which is not 2-D" % (a.shape,)
+    if use_vigra is None:
+        use_vigra = _vigraHas('gray2qimage_ARGB32Premultiplied')
+    normalize = _normalization(normalize)
+    img = _target(a.shape, out)
+
+    if use_vigra:
+        n = numpy.asarray(normalize, dtype=a.dtype)
+        vigra.colors.gray2qimage_ARGB32Premultiplied(numpy.ascontiguousarray(a), byte_view(img), n)
+    elif a.dtype == numpy.uint8 or a.dtype == numpy.uint16:
+        _grayLut(a.dtype, normalize).take(a, out=raw_view(img), mode='clip')
+    else:
+        _GRAY.take(_scale(a, normalize), out=raw_view(img), mode='clip')
+    return img
+
+#*******************************************************************************
+# r g b a 2 a r g b                                                            *
+#*******************************************************************************
+
+def _channel( a, normalize ):
+    '''The 2D array a as uint8, mapped from [nmin, nmax] to [0, 255] if normalize is not None.'''
+    if normalize is None and a.dtype == numpy.uint8:
+        return a
+    if a.dtype.kind in 'biu' and a.dtype.itemsize <= 2:
+        unsigned = numpy.dtype('u%d' % a.dtype.itemsize)
+        return _channelLut(a.dtype, normalize).take(a.view(unsigned), mode='clip')
+    if normalize is None:
+        return a.astype(numpy.uint8)
+    return _scale(a, normalize)
+
+def rgba2argb( channels, normalize=(None, None, None, None), out=None ):
+    '''Combine the red, green, blue and alpha 2D arrays to a QImage in Format_ARGB32_Premultiplied.
+
+    normalize -- (nmin, nmax) of each channel; values are mapped linearly
+                 from this range to [0, 255] and clipped. Channels with
+                 None or an empty range are cast to uint8.
+    out       -- QImage of matching size and format to write into; an
+                 image is taken from the image pool if None
+
+    8 and 16 bit channels are converted with a cached lookup table,
+    the others are scaled in place in float32. Every channel is written
+    into its bytes of the image once; the color channels are
+    premultiplied by lookup unless the image is opaque.
+
+    '''
+    assert len(channels) == 4 and len(normalize) == 4
+    shape = channels[0].shape
+    assert len(shape) == 2 and all(c.shape == shape for c in channels), \
+           "rgba2argb(): channels have shapes %r, which are not equal and 2-D" % ([c.shape for c in channels],)
+    img = _target(shape, out)
+    pixels = byte_view(img)
+
+    def channel( i ):
+        n = normalize[i]
+        return _channel(channels[i], tuple(n) if n is not None and n[0] < n[1] else None)
+
+    alpha = channel(3)
+    pixels[..., _RGBA_BYTES[3]] = alpha
+    if alpha.min() == 255:
+        for i in range(3):
+            pixels[..., _RGBA_BYTES[i]] = channel(i)
+    else:
+        alpha = alpha.astype(numpy.uint16) << 8
+        for i in range(3):
+            pixels[..., _RGBA_BYTES[i]] = _PREMULTIPLIED.take(alpha | channel(i))
+    return img
+
+#*******************************************************************************
+# c o l o r t a b l e 2 a r g b                                                *
+#*******************************************************************************
+
+def _colortableIndex( values, n, normalize ):
+    # index into a colortable of n colors, before wrapping around
+    if normalize is None:
+        return values if values.dtype.kind in 'biu' else values.astype(numpy.intp)
+    nmin, nmax = normalize
+    t = numpy.subtract(values, nmin, dtype=numpy.float64)
+    t *= (n - 1) / float(nmax - nmin)
+    numpy.floor(t, out=t)
+    return t.astype(numpy.intp)
+
+def colortable2argb( a, colorTable, normalize=None, out=None, luts=None ):
+    '''Convert a 2D array to a QImage in Format_ARGB32 by looking up its values in a colortable.
+
+    colorTable -- (n, 4) uint8 array with the bytes of each color in the
+                  memory order of a Format_ARGB32 pixel (B, G, R, A on
+                  little endian machines)
+    normalize  -- (nmin, nmax); values are mapped linearly from this range
+                  onto the colortable indices [0, n-1]. If None or an empty
+                  range, the values are used as indices directly.
+                  Indices outside of the colortable wrap around.
+    out        -- QImage of matching size and format to write into; an
+                  image is taken from the image pool if None
+    luts       -- dict to cache lookup tables in; it must be replaced when
+                  the colortable changes
+
+    For 8 and 16 bit data, the normalization and the colortable are
+    combined into a lookup table for all values of the dtype, which
+    is applied with a single numpy.take into the image buffer.
+
+    '''
+    assert a.ndim == 2, "colortable2argb(): array has shape %r, which is not 2-D" % (a.shape,)
+    img = _target(a.shape, out, QImage.Format_ARGB32)
+    colors = numpy.ascontiguousarray(colorTable, dtype=numpy.uint8).view(numpy.uint32).reshape(-1)
+    n = len(colors)
+    normalize = tuple(normalize) if normalize else None
+    if normalize is not None and (normalize[0] >= normalize[1] or normalize == (0, n - 1)):
+        normalize = None
+
+    if a.dtype.kind in 'biu' and a.dtype.itemsize <= 2:
+        unsigned = numpy.dtype('u%d' % a.dtype.itemsize)
+        key = (a.dtype.str, normalize)
+        lut = luts.get(key) if luts is not None else None
+        if lut is None:
+            values = numpy.arange(2**(8*unsigned.itemsize)).astype(unsigned).view(a.dtype)
+            lut = colors.take(_colortableIndex(values, n, normalize), mode='wrap')
+            if luts is not None:
+                luts[key] = lut
+        lut.take(a.view(unsigned), out=raw_view(img), mode='clip')
+    else:
+        colors.take(_colortableIndex(a, n, normalize), out=raw_view(img), mode='wrap')
+    return img
+
+#*******************************************************************************
+# O r i e n t a t i o n                                                        *
+#*******************************************************************************
+
+def axisOrientation( transform, eps=1e-9 ):
+    '''Describe a QTransform that only swaps and mirrors the axes.
+
+    Returns (transpose, flip0, flip1), such that orient(a, orientation)
+    is the array of img.transformed(transform), where img is the image
+    of the 2D array a. Translations are ignored, as by
+    QImage.transformed(). Returns None for transforms that scale,
+    shear or rotate by other angles than multiples of 90 degrees.
+
+    '''
+    if abs(transform.m13()) > eps or abs(transform.m23()) > eps or abs(transform.m33() - 1) > eps:
+        return None
+    m = [transform.m11(), transform.m12(), transform.m21(), transform.m22()]
+    m = [0 if abs(v) < eps else v for v in m]
+    if not all(v == 0 or abs(abs(v) - 1) < eps for v in m):
+        return None
+    m11, m12, m21, m22 = m
+    if m12 == 0 and m21 == 0 and m11 != 0 and m22 != 0:
+        return (False, m22 < 0, m11 < 0)
+    if m11 == 0 and m22 == 0 and m12 != 0 and m21 != 0:
+        return (True, m12 < 0, m21 < 0)
+    return None
+
+def orient( a, orientation ):
+    '''Return a view of the 2D array a in the given orientation (see axisOrientation()).'''
+    if orientation is None:
+        return a
+    transpose, flip0, flip1 = orientation
+    if transpose:
+        a = a.T
+    return a[::-1 if flip0 else 1, ::-1 if flip1 else 1]
+
+def orientedShape( shape, orientation ):
+    if orientation is not None and orientation[0]:
+        return tuple(shape[::-1])
+    return tuple(shape)
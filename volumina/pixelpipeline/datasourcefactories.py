@@ -15,7 +15,7 @@
 # Copyright 2011-2014, the ilastik developers
 
 from volumina.multimethods import multimethod
-from datasources import ArraySource, LazyflowSource
+from datasources import ArraySource, LazyflowSource, ChunkedSource
 import numpy
 
 hasLazyflow = True
@@ -24,6 +24,12 @@ try:
 except:
     hasLazyflow = False
 
+hasH5py = True
+try:
+    import h5py
+except ImportError:
+    hasH5py = False
+
 if hasLazyflow:
     def _createDataSourceLazyflow( slot, withShape ):
         #has to handle Lazyflow source
@@ -71,3 +77,28 @@ def createDataSource(source,withShape = False):
 @multimethod(numpy.ndarray)
 def createDataSource(source):
     return createDataSource(source,False)
+
+def _createDataSourceChunked( source, withShape ):
+    #arrays on disk are read in chunks on demand
+    src = ChunkedSource(source)
+    if withShape:
+        return src,src._shape
+    else:
+        return src
+
+@multimethod(numpy.memmap,bool)
+def createDataSource(source,withShape = False):
+    return _createDataSourceChunked( source, withShape )
+
+@multimethod(numpy.memmap)
+def createDataSource(source):
+    return _createDataSourceChunked( source, False )
+
+if hasH5py:
+    @multimethod(h5py.Dataset,bool)
+    def createDataSource(source,withShape = False):
+        return _createDataSourceChunked( source, withShape )
+
+    @multimethod(h5py.Dataset)
+    def createDataSource(source):
+        return _createDataSourceChunked( source, False )
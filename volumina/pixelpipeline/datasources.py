@@ -14,14 +14,20 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
+import math
+import itertools
 import threading
 import weakref
+from collections import OrderedDict
 from functools import partial
 from PyQt4.QtCore import QObject, pyqtSignal, QTimer
 from asyncabcs import RequestABC, SourceABC
+from coalescing import SharedRequest, SharedRequestView, region, requestCoalescer
+from statistics import statisticsJob, cachedStatistics, forgetStatistics, sourceShape
+from labelindex import LabelIndexJob
 import volumina
 from volumina.slicingtools import is_pure_slicing, slicing2shape, \
-    is_bounded, make_bounded, index2slice, sl
+    is_bounded, make_bounded, index2slice, sl, strip_steps
 from volumina.config import cfg
 import numpy as np
 
@@ -71,17 +77,63 @@ class ArrayRequest( object ):
         callback(result, **kwargs)
 assert issubclass(ArrayRequest, RequestABC)
 
+class BlockMeanRequest( ArrayRequest ):
+    def wait( self ):
+        if self._result is None:
+            self._result = block_mean(self._array, self._slicing)
+        return self._result
+
 #*******************************************************************************
 # A r r a y S o u r c e                                                        *
 #*******************************************************************************
 
+def block_mean( array, slicing ):
+    '''Reduce array[slicing] by averaging blocks of size 'step' instead of
+    picking every step-th element. Partial blocks at the border are
+    averaged over the elements they contain.'''
+    unstrided, strides = strip_steps(slicing)
+    a = array[unstrided]
+    dtype = a.dtype
+    for axis, sl in enumerate(strides):
+        step = sl.step or 1
+        if step == 1:
+            continue
+        n = a.shape[axis]
+        starts = np.arange(0, n, step)
+        counts = np.diff(np.append(starts, n))
+        shape = [1]*a.ndim
+        shape[axis] = len(counts)
+        a = np.add.reduceat(a.astype(np.float64), starts, axis=axis) / counts.reshape(shape)
+    if np.issubdtype(dtype, np.integer):
+        a = np.round(a)
+    return a.astype(dtype)
+
 class ArraySource( QObject ):
+    '''Serves an in-memory array.
+
+    Slicings with steps (as used for the pyramid levels of the tile
+    provider) are served by striding the array, or by averaging blocks if
+    downsampling='mean'. Use striding for label images.
+
+    For label images, labelIndex() provides the blocks in which each
+    label occurs (see LabelIndex). setDirty() marks the changed blocks
+    of the index dirty; they are rescanned in a background thread.
+
+    '''
     isDirty = pyqtSignal( object )
     numberOfChannelsChanged = pyqtSignal(int) # Never emitted
      
-    def __init__( self, array ):
+    def __init__( self, array, downsampling='stride', blockShape=None ):
         super(ArraySource, self).__init__()
+        assert downsampling in ('stride', 'mean')
         self._array = array
+        self._downsampling = downsampling
+        self._blockShape = blockShape
+        self._labelIndex = None
+        self._labelIndexJob = None
+        self._labelIndexDirty = [] # dirty slicings while the job runs
+        self._labelIndexRefresh = None # thread rescanning the dirty blocks
+        self._labelIndexLock = threading.Lock()
         
     @property
     def numberOfChannels(self):
@@ -99,13 +151,76 @@ class ArraySource( QObject ):
         assert(len(slicing) == len(self._array.shape)), \
             "slicing into an array of shape=%r requested, but slicing is %r" \
             % (slicing, self._array.shape)  
+        if self._downsampling == 'mean' and any((sl.step or 1) > 1 for sl in slicing):
+            return BlockMeanRequest(self._array, slicing)
         return ArrayRequest(self._array, slicing)
 
     def setDirty( self, slicing):
         if not is_pure_slicing(slicing):
             raise Exception('dirty region: slicing is not pure')
+        self._updateLabelIndex(slicing)
         self.isDirty.emit( slicing )
 
+    def labelIndex( self, wait=True, filename=None ):
+        '''The LabelIndex of the array, computed on the first call.
+
+        If wait is false, this never blocks: the index is computed in
+        the background and None is returned until it is available. If
+        filename is given, the index is loaded from or saved to this
+        file (see LabelIndexJob). If wait is true, the dirty blocks of
+        the index are rescanned first.'''
+        with self._labelIndexLock:
+            index, job = self._labelIndex, self._labelIndexJob
+            if index is None and job is None:
+                job = LabelIndexJob(self._array, self._blockShape, filename, self._setLabelIndex)
+                self._labelIndexJob = job
+        if index is not None:
+            if wait and index.dirty:
+                index.refresh(self._array)
+            return index
+        job.start()
+        if wait:
+            job.wait()
+            return self._labelIndex
+        return None
+
+    def _setLabelIndex( self, index ):
+        # called by the LabelIndexJob; regions that were marked dirty
+        # while it ran are scanned again
+        with self._labelIndexLock:
+            for slicing in self._labelIndexDirty:
+                index.markDirty(slicing)
+            self._labelIndexDirty = []
+            self._labelIndex = index
+            self._labelIndexJob = None
+        index.refresh(self._array)
+
+    def _updateLabelIndex( self, slicing ):
+        # only marks the blocks dirty, so that setDirty() stays cheap;
+        # a single thread rescans them until none is left
+        with self._labelIndexLock:
+            index = self._labelIndex
+            if index is None:
+                if self._labelIndexJob is not None:
+                    self._labelIndexDirty.append(slicing)
+                return
+            index.markDirty(slicing)
+            if self._labelIndexRefresh is not None:
+                return
+            thread = threading.Thread(target=self._refreshLabelIndex, name="LabelIndexRefresh")
+            thread.daemon = True
+            self._labelIndexRefresh = thread
+        thread.start()
+
+    def _refreshLabelIndex( self ):
+        index = self._labelIndex
+        while True:
+            index.refresh(self._array)
+            with self._labelIndexLock:
+                if not index.dirty:
+                    self._labelIndexRefresh = None
+                    return
+
     def __eq__( self, other ):
         if other is None:
             return False
@@ -139,25 +254,60 @@ class ArraySinkSource( ArraySource ):
 # R e l a b e l i n g A r r a y S o u r c e                                    * 
 #*******************************************************************************
 
+class RelabelingRequest( ArrayRequest ):
+    '''Reads and relabels a region of a RelabelingArraySource in wait().'''
+    def __init__( self, source, slicing ):
+        super(RelabelingRequest, self).__init__(source._array, slicing)
+        self._source = source
+
+    def wait( self ):
+        if self._result is None:
+            self._result = self._source._relabeled(self._slicing)
+        return self._result
+
 class RelabelingArraySource( ArraySource ):
-    """Applies a relabeling to each request before passing it on
-       Currently, it casts everything to uint8, so be careful."""
+    """Applies a relabeling to each request before passing it on.
+
+    The relabeling is applied when a request is waited for. Relabeled
+    regions are cached (up to CACHE_BYTES); changing single entries of
+    the relabeling only drops the cached regions and marks dirty the
+    blocks that contain the changed labels, which are looked up in the
+    labelIndex() of the data. Until the index is available, everything
+    is marked dirty."""
     isDirty = pyqtSignal( object )
-    def __init__( self, array ):
-        super(RelabelingArraySource, self).__init__(array)
+
+    CACHE_BYTES = 64 * 2**20
+
+    def __init__( self, array, blockShape=None ):
+        super(RelabelingArraySource, self).__init__(array, blockShape=blockShape)
         self.originalData = array
         self._relabeling = None
+        self._pendingLabels = set()
+        # The version is incremented by every change of the relabeling;
+        # regions relabeled with an older version are not cached.
+        self._version = 0
+        self._cache = OrderedDict() # region -> (bounded slicing, relabeled data)
+        self._cacheBytes = 0
+        self._lock = threading.Lock()
     
     def setRelabeling( self, relabeling ):
         """Sets new relabeling vector. It should have a len(relabling) == max(your data)+1
            and give, for each possible data value x, the relabling as relabeling[x]."""   
         assert relabeling.dtype == self._array.dtype, "relabeling.dtype=%r != self._array.dtype=%r" % (relabeling.dtype, self._array.dtype)
-        self._relabeling = relabeling
-        self.setDirty(5*(slice(None),))
+        with self._lock:
+            self._relabeling = relabeling
+            self._pendingLabels = set()
+            self._invalidate()
+        # the data is unchanged, so the label index stays valid
+        self.isDirty.emit( 5*(slice(None),) )
 
     def clearRelabeling( self ):
-        self._relabeling[:] = 0
-        self.setDirty(5*(slice(None),))
+        # only the labels that were not mapped to 0 change
+        with self._lock:
+            labels = np.flatnonzero(self._relabeling)
+            self._relabeling[:] = 0
+            self._version += 1
+        self._labelsChanged(labels)
 
     def setRelabelingEntry( self, index, value, setDirty=True ):
         """Sets the entry for data value index to value, such that afterwards
@@ -165,9 +315,15 @@ class RelabelingArraySource( ArraySource ):
            
            If setDirty is true, the source will signal dirtyness. If you plan to issue many calls to this function
            in a loop, setDirty to true only on the last call."""
-        self._relabeling[index] = value
+        with self._lock:
+            # regions that are being relabeled meanwhile are not cached
+            if self._relabeling[index] != value:
+                self._relabeling[index] = value
+                self._version += 1
+                self._pendingLabels.add(index)
         if setDirty:
-            self.setDirty(5*(slice(None),))
+            labels, self._pendingLabels = self._pendingLabels, set()
+            self._labelsChanged(sorted(labels))
 
     def request( self, slicing ):
         if not is_pure_slicing(slicing):
@@ -175,14 +331,276 @@ class RelabelingArraySource( ArraySource ):
         assert(len(slicing) == len(self._array.shape)), \
             "slicing into an array of shape=%r requested, but slicing is %r" \
             % (self._array.shape, slicing)
-        a = ArrayRequest(self._array, slicing)
-        a = a.wait()
-        
-        #oldDtype = a.dtype
-        if self._relabeling is not None:
-            a = self._relabeling[a]
-        #assert a.dtype == oldDtype 
-        return ArrayRequest(a, 5*(slice(None),))
+        return RelabelingRequest(self, slicing)
+
+    def setDirty( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('dirty region: slicing is not pure')
+        # the data may have changed, too
+        bounded = make_bounded(slicing, self._array.shape)
+        with self._lock:
+            self._invalidate(lambda s: _overlaps(s, bounded))
+        self._updateLabelIndex(slicing)
+        self.isDirty.emit( slicing )
+
+    def _labelsChanged( self, labels ):
+        if len(labels) == 0:
+            return
+        index = self.labelIndex(wait=False)
+        if index is None:
+            with self._lock:
+                self._invalidate()
+            self.isDirty.emit( 5*(slice(None),) )
+            return
+        numbers = index.blocks(labels)
+        with self._lock:
+            self._invalidate(lambda slicing: index.intersects(slicing, numbers))
+        for slicing in index.dirtySlicings(labels):
+            self.isDirty.emit( slicing )
+
+    def _invalidate( self, affected=None ):
+        '''Drop the cached regions for which affected(slicing) is true
+        (all if affected is None). Must be called with the lock held.'''
+        self._version += 1
+        for key, (slicing, data) in self._cache.items():
+            if affected is None or affected(slicing):
+                del self._cache[key]
+                self._cacheBytes -= data.nbytes
+
+    def _relabeled( self, slicing ):
+        key = region(slicing)
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None:
+                self._cache[key] = entry
+                return entry[1]
+            version = self._version
+            relabeling = self._relabeling
+        a = self._array[slicing]
+        if relabeling is None:
+            return a
+        a = np.take(relabeling, a)
+        with self._lock:
+            if version == self._version and a.nbytes <= self.CACHE_BYTES:
+                self._cache[key] = (make_bounded(slicing, self._array.shape), a)
+                self._cacheBytes += a.nbytes
+                while self._cacheBytes > self.CACHE_BYTES:
+                    old, (oldSlicing, oldData) = self._cache.popitem(last=False)
+                    self._cacheBytes -= oldData.nbytes
+        return a
+
+def _overlaps( a, b ):
+    '''Whether the regions of the bounded slicings a and b intersect.'''
+    return all(max(s.start, t.start) < min(s.stop, t.stop) for s, t in zip(a, b))
+
+#*******************************************************************************
+# C h u n k e d S o u r c e                                                    *
+#*******************************************************************************
+
+def embedding5d( shape ):
+    '''The axes of the 5D (t,x,y,z,c) shape that correspond to the axes
+    of an array of shape, as in createDataSource: 2D arrays are (x,y)
+    images, 3D arrays with at most 4 entries along the last axis (x,y,c)
+    images, other 3D arrays (x,y,z) volumes and 4D arrays (x,y,z,c)
+    volumes.'''
+    if len(shape) == 2:
+        return (1, 2)
+    elif len(shape) == 3 and shape[2] <= 4:
+        return (1, 2, 4)
+    elif len(shape) == 3:
+        return (1, 2, 3)
+    elif len(shape) == 4:
+        return (1, 2, 3, 4)
+    assert len(shape) == 5, "cannot embed an array of shape %r in 5D" % (shape,)
+    return (0, 1, 2, 3, 4)
+
+class _ChunkCache( object ):
+    '''Least recently used chunks, up to maxBytes.'''
+    def __init__( self, maxBytes ):
+        self.maxBytes = maxBytes
+        self._chunks = OrderedDict() # key -> chunk
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get( self, key ):
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is not None:
+                self._chunks[key] = chunk
+            return chunk
+
+    def put( self, key, chunk ):
+        if chunk.nbytes > self.maxBytes:
+            return
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._chunks[key] = chunk
+            self._bytes += chunk.nbytes
+            while self._bytes > self.maxBytes:
+                key, old = self._chunks.popitem(last=False)
+                self._bytes -= old.nbytes
+
+    def discard( self, affected=None ):
+        '''Drop the chunks whose key satisfies affected (all if affected
+        is None).'''
+        with self._lock:
+            for key, chunk in self._chunks.items():
+                if affected is None or affected(key):
+                    del self._chunks[key]
+                    self._bytes -= chunk.nbytes
+
+    @property
+    def nbytes( self ):
+        return self._bytes
+
+class ChunkedRequest( ArrayRequest ):
+    '''Reads a region of a ChunkedSource in wait().'''
+    def __init__( self, source, slicing, cached=True ):
+        super(ChunkedRequest, self).__init__(None, slicing)
+        self._source = source
+        self._cached = cached
+
+    def wait( self ):
+        if self._result is None:
+            if self._cached:
+                self._result = self._source._read(self._slicing)
+            else:
+                self._result = self._source._readDataset(self._source._bounded(self._slicing))
+        return self._result
+
+class ChunkedSource( QObject ):
+    '''Serves an array that is read from disk on demand: a numpy.memmap
+    (see rawFileSource), an h5py dataset or any object with shape, dtype
+    and NumPy slicing.
+
+    Arrays with fewer than 5 dimensions are embedded like in
+    createDataSource (see embedding5d). Requests are served from chunks
+    of chunkShape (default: the chunks of an HDF5 dataset, CHUNK_SHAPE
+    otherwise), which are read whole and kept in a least recently used
+    cache of cacheBytes (default: chunk_cache_mb of the [pixelpipeline]
+    config section). Slicings with steps, i.e. the pyramid levels of
+    the tile provider, are read strided from the array and not cached;
+    neither are the requests of uncachedRequest().
+
+    '''
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int) # Never emitted
+
+    CHUNK_SHAPE = (1, 64, 64, 64, 64)
+
+    def __init__( self, dataset, chunkShape=None, cacheBytes=None ):
+        super(ChunkedSource, self).__init__()
+        self._dataset = dataset
+        self._axes = embedding5d(dataset.shape)
+        shape = [1] * 5
+        for axis, n in zip(self._axes, dataset.shape):
+            shape[axis] = n
+        self._shape = tuple(shape)
+        if chunkShape is None:
+            chunkShape = self._datasetChunks()
+        self._chunkShape = tuple(max(1, min(c, n)) for c, n in zip(chunkShape, self._shape))
+        if cacheBytes is None:
+            cacheBytes = cfg.getint('pixelpipeline', 'chunk_cache_mb') * 2**20
+        self._cache = _ChunkCache(cacheBytes)
+
+    def _datasetChunks( self ):
+        chunks = getattr(self._dataset, 'chunks', None)
+        if chunks is None:
+            return self.CHUNK_SHAPE
+        chunkShape = [1] * 5
+        for axis, c in zip(self._axes, chunks):
+            chunkShape[axis] = c
+        return chunkShape
+
+    @property
+    def numberOfChannels( self ):
+        return self._shape[-1]
+
+    def clean_up( self ):
+        self._dataset = None
+        self._cache.discard()
+
+    def dtype( self ):
+        return self._dataset.dtype
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('ChunkedSource: slicing is not pure')
+        assert(len(slicing) == len(self._shape)), \
+            "slicing into an array of shape=%r requested, but slicing is %r" \
+            % (self._shape, slicing)
+        return ChunkedRequest(self, slicing)
+
+    def uncachedRequest( self, slicing ):
+        '''Like request(), but reads from the array without evicting the
+        cached chunks, e.g. for passes over the whole array.'''
+        if not is_pure_slicing(slicing):
+            raise Exception('ChunkedSource: slicing is not pure')
+        return ChunkedRequest(self, slicing, cached=False)
+
+    def setDirty( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('dirty region: slicing is not pure')
+        # the data on disk may have changed
+        bounded = self._bounded(slicing)
+        self._cache.discard(lambda coords: _overlaps(self._chunkSlicing(coords), bounded))
+        self.isDirty.emit( slicing )
+
+    def __eq__( self, other ):
+        if other is None:
+            return False
+        return self._dataset is getattr(other, '_dataset', None)
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+    def _bounded( self, slicing ):
+        return tuple(slice(s.start, min(s.stop, n), s.step)
+                     for s, n in zip(make_bounded(slicing, self._shape), self._shape))
+
+    def _chunkSlicing( self, coords ):
+        return tuple(slice(i*c, min((i+1)*c, n))
+                     for i, c, n in zip(coords, self._chunkShape, self._shape))
+
+    def _readDataset( self, slicing ):
+        data = self._dataset[tuple(slicing[axis] for axis in self._axes)]
+        return np.asarray(data).reshape(slicing2shape(slicing))
+
+    def _chunk( self, coords ):
+        chunk = self._cache.get(coords)
+        if chunk is None:
+            chunk = np.ascontiguousarray(self._readDataset(self._chunkSlicing(coords)))
+            self._cache.put(coords, chunk)
+        return chunk
+
+    def _read( self, slicing ):
+        slicing = self._bounded(slicing)
+        if any((s.step or 1) > 1 for s in slicing):
+            return self._readDataset(slicing)
+        ranges = [xrange(s.start // c, (s.stop - 1) // c + 1)
+                  for s, c in zip(slicing, self._chunkShape)]
+        chunks = list(itertools.product(*ranges))
+        if len(chunks) == 1:
+            origin = self._chunkSlicing(chunks[0])
+            return self._chunk(chunks[0])[tuple(slice(s.start - o.start, s.stop - o.start)
+                                                for s, o in zip(slicing, origin))]
+        result = np.empty(slicing2shape(slicing), dtype=self._dataset.dtype)
+        for coords in chunks:
+            origin = self._chunkSlicing(coords)
+            inner = [slice(max(s.start, o.start), min(s.stop, o.stop)) for s, o in zip(slicing, origin)]
+            result[tuple(slice(i.start - s.start, i.stop - s.start) for i, s in zip(inner, slicing))] = \
+                self._chunk(coords)[tuple(slice(i.start - o.start, i.stop - o.start) for i, o in zip(inner, origin))]
+        return result
+
+assert issubclass(ChunkedSource, SourceABC)
+
+def rawFileSource( filename, shape, dtype, offset=0, order='C', **kwargs ):
+    '''A ChunkedSource of the array of shape and dtype that is stored in
+    the raw binary file filename, starting at byte offset.'''
+    array = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order)
+    return ChunkedSource(array, **kwargs)
         
 #*******************************************************************************
 # L a z y f l o w R e q u e s t                                                *
@@ -190,7 +608,10 @@ class RelabelingArraySource( ArraySource ):
 
 class LazyflowRequest( object ):
     def __init__(self, op, slicing, prio, objectName="Unnamed LazyflowRequest" ):
-        self._req = op.Output[slicing]
+        # lazyflow does not support steps; downsampled slicings are
+        # requested at full resolution and strided afterwards
+        unstrided, self._strides = strip_steps(slicing)
+        self._req = op.Output[unstrided]
         self._slicing = slicing
         shape = op.Output.meta.shape
         if shape is not None:
@@ -199,13 +620,13 @@ class LazyflowRequest( object ):
         self._objectName = objectName
         
     def wait( self ):
-        a = self._req.wait()
+        a = self._req.wait()[self._strides]
         assert(isinstance(a, np.ndarray))
         assert(a.shape == self._shape), "LazyflowRequest.wait() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
         return a
         
     def getResult(self):
-        a = self._req.result
+        a = self._req.result[self._strides]
         assert(isinstance(a, np.ndarray))
         assert(a.shape == self._shape), "LazyflowRequest.getResult() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
         return a
@@ -429,6 +850,146 @@ class ConstantSource( QObject ):
 
 assert issubclass(ConstantSource, SourceABC)
 
+#*******************************************************************************
+# C h a n n e l S o u r c e                                                    *
+#*******************************************************************************
+
+class ChannelRequest( SharedRequestView ):
+    '''The request of one channel of a request of several channels.'''
+    def __init__( self, shared, index ):
+        super(ChannelRequest, self).__init__(shared)
+        self._index = index
+
+    def _select( self, result ):
+        return result[..., self._index:self._index+1]
+assert issubclass(ChannelRequest, RequestABC)
+
+class _ChannelBatcher( QObject ):
+    '''
+    Batches the requests of the ChannelSources of a multichannel source.
+
+    The first request of a region creates a single request of all
+    channels of the batch; the requests of the same region by the
+    other channels share it. A channel that requests a region again
+    starts a new batch. At most 'maxPending' incomplete batches are
+    kept; they are dropped when the source becomes dirty.
+
+    '''
+    def __init__( self, source, channels, maxPending=64 ):
+        super(_ChannelBatcher, self).__init__()
+        self._source = source
+        self._channels = sorted(channels)
+        self._first = self._channels[0]
+        self._maxPending = maxPending
+        self._pending = OrderedDict() # region -> (SharedRequest, channels)
+        self._lock = threading.Lock()
+        self._source.isDirty.connect(self._onSourceDirty)
+
+    def request( self, slicing, channel ):
+        key = region(slicing[:-1])
+        with self._lock:
+            batch, channels = self._pending.pop(key, (None, None))
+            if batch is None or channel in channels or not batch.share():
+                allChannels = slice(self._first, self._channels[-1]+1)
+                batch = SharedRequest(self._source.request(tuple(slicing[:-1]) + (allChannels,)))
+                batch.share()
+                channels = set()
+            channels.add(channel)
+            if len(channels) < len(self._channels):
+                self._pending[key] = (batch, channels)
+                while len(self._pending) > self._maxPending:
+                    self._pending.popitem(last=False)
+        return ChannelRequest(batch, channel - self._first)
+
+    def _onSourceDirty( self, slicing ):
+        with self._lock:
+            self._pending.clear()
+
+class ChannelSource( QObject ):
+    '''Serves a single channel of a multichannel source.
+
+    Create the ChannelSources of a source with channelSources(), so that
+    their requests of the same region are served by a single request
+    of the multichannel source.
+
+    '''
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int) # Never emitted
+
+    def __init__( self, source, channel, batcher=None ):
+        super(ChannelSource, self).__init__()
+        assert 0 <= channel < source.numberOfChannels
+        self._source = source
+        self._channel = channel
+        self._batcher = batcher
+        self._source.isDirty.connect(self._onSourceDirty)
+
+    @property
+    def numberOfChannels(self):
+        return 1
+
+    @property
+    def channel( self ):
+        return self._channel
+
+    @property
+    def dataSlot(self):
+        return getattr(self._source, 'dataSlot', None)
+
+    def clean_up(self):
+        self._source.clean_up()
+
+    def dtype(self):
+        return self._source.dtype()
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('ChannelSource: slicing is not pure')
+        c = slicing[-1]
+        assert (c.start or 0) == 0 and c.stop in (None, 1), \
+            "ChannelSource: slicing %r requests other channels than 0" % (slicing,)
+        if self._batcher is not None:
+            return self._batcher.request(slicing, self._channel)
+        return self._source.request(tuple(slicing[:-1]) + (slice(self._channel, self._channel+1),))
+
+    def uncachedRequest( self, slicing ):
+        '''See ChunkedSource.uncachedRequest; other sources are requested
+        as usual.'''
+        uncached = getattr(self._source, 'uncachedRequest', None)
+        if uncached is None:
+            return self.request(slicing)
+        return uncached(tuple(slicing[:-1]) + (slice(self._channel, self._channel+1),))
+
+    def setDirty( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('dirty region: slicing is not pure')
+        self.isDirty.emit( slicing )
+
+    def _onSourceDirty( self, slicing ):
+        c = slicing[-1]
+        if (c.start or 0) <= self._channel and (c.stop is None or self._channel < c.stop):
+            self.setDirty( tuple(slicing[:-1]) + (slice(None),) )
+
+    def __eq__( self, other ):
+        if other is None:
+            return False
+        return isinstance(other, ChannelSource) and \
+               self._source == other._source and self._channel == other._channel
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+assert issubclass(ChannelSource, SourceABC)
+
+def channelSources( source, channels=None ):
+    '''Return a ChannelSource for each of the channels (default: all)
+    of the multichannel source. Their requests of the same region are
+    batched into one request of the source.'''
+    if channels is None:
+        channels = range(source.numberOfChannels)
+    batcher = _ChannelBatcher(source, channels) if len(channels) > 1 else None
+    return [ChannelSource(source, c, batcher) for c in channels]
+
 
 class MinMaxUpdateRequest( object ):
     def __init__( self, rawRequest, update_func ):
@@ -440,6 +1001,12 @@ class MinMaxUpdateRequest( object ):
         self._result = rawData
         self._update_func(rawData)
         return self._result
+
+    def cancel( self ):
+        self._rawRequest.cancel()
+
+    def submit( self ):
+        self._rawRequest.submit()
     
     # callback( result = result, **kwargs )
     def notify( self, callback, **kwargs ):
@@ -455,34 +1022,109 @@ class MinMaxUpdateRequest( object ):
 assert issubclass(MinMaxUpdateRequest, RequestABC)
 
 
+def _strided( data, maxSamples ):
+    '''A strided view of data with roughly at most maxSamples elements.'''
+    if data.size <= maxSamples:
+        return data
+    axes = [i for i, n in enumerate(data.shape) if n > 1]
+    step = int(math.ceil((float(data.size) / maxSamples) ** (1.0 / len(axes))))
+    slicing = [slice(None)] * data.ndim
+    for i in axes:
+        slicing[i] = slice(None, None, step)
+    return data[tuple(slicing)]
+
+class _Reservoir( object ):
+    '''A uniform random sample of at most 'size' of the values added so
+    far (reservoir sampling).'''
+    def __init__( self, size ):
+        self._values = np.empty(size, dtype=np.float64)
+        self._n = 0
+        self.seen = 0
+
+    def add( self, values ):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        head = values[:len(self._values) - self._n]
+        self._values[self._n:self._n + len(head)] = head
+        self._n += len(head)
+        self.seen += len(head)
+        rest = values[len(head):]
+        if len(rest) > 0:
+            # the i-th value replaces a random value with probability
+            # size / (seen + i + 1)
+            slots = (np.random.random(len(rest)) * (self.seen + 1 + np.arange(len(rest)))).astype(np.intp)
+            keep = slots < len(self._values)
+            self._values[slots[keep]] = rest[keep]
+            self.seen += len(rest)
+
+    def percentiles( self, q ):
+        return np.percentile(self._values[:self._n], q)
+
 class MinMaxSource( QObject ):
     """
     A datasource that serves as a normalizing decorator for other datasources.
+
+    The bounds of the data are estimated from the results of the requests:
+    at most 'maxSamples' strided values of each result are examined. With
+    the default percentiles (0, 100), the bounds are the minimum and the
+    maximum of the examined values; otherwise, they are the percentiles
+    of a random sample of all examined values, e.g. (0.1, 99.9) ignores
+    outliers. Changes of the bounds are published (boundsChanged and a
+    single dirty signal for everything) at most once per 'interval'
+    milliseconds. The defaults are read from the [pixelpipeline] section
+    of the config (minmax_samples, minmax_percentiles, minmax_interval_ms).
+
+    precomputeBounds() sets stable bounds from the statistics of the
+    whole raw source instead. When the data of the raw source changes,
+    the bounds are kept and the statistics are computed again once the
+    data did not change for statistics_delay_ms milliseconds.
     """
     isDirty = pyqtSignal( object )
     boundsChanged = pyqtSignal(object) # When a new min/max is discovered in the result of a request, this signal is fired with the new (dmin, dmax)
     numberOfChannelsChanged = pyqtSignal(int)
     
     _delayedBoundsChange = pyqtSignal() # Internal use only.  Allows non-main threads to start the delayedDirtySignal timer.
+    _delayedRecompute = pyqtSignal() # Internal use only.  Restarts the recompute timer from any thread.
     
+    RESERVOIR_SIZE = 2**16
     
-    def __init__( self, rawSource, parent=None ):
+    def __init__( self, rawSource, parent=None, percentiles=None, maxSamples=None, interval=None ):
         """
         rawSource: The original datasource whose data will be normalized
         """
         super(MinMaxSource, self).__init__(parent)
         
         self._rawSource = rawSource
+        self._rawSource.isDirty.connect( self._onRawDirty )
         self._rawSource.isDirty.connect( self.isDirty )
         self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
         self._bounds = [1e9,-1e9]
         
+        if percentiles is None:
+            percentiles = tuple(float(q) for q in cfg.get('pixelpipeline', 'minmax_percentiles').split(','))
+        if maxSamples is None:
+            maxSamples = cfg.getint('pixelpipeline', 'minmax_samples')
+        if interval is None:
+            interval = cfg.getint('pixelpipeline', 'minmax_interval_ms')
+        self.percentiles = percentiles
+        self._maxSamples = maxSamples
+        self._reservoir = _Reservoir(self.RESERVOIR_SIZE)
+        self._lock = threading.Lock()
+        self._boundsChangePending = False
+        self._fixed = False # bounds from the statistics of the whole source
+        self._statisticsJob = None
+        
         self._delayedDirtySignal = QTimer()
         self._delayedDirtySignal.setSingleShot(True)
-        self._delayedDirtySignal.setInterval(10)
-        self._delayedDirtySignal.timeout.connect( partial(self.setDirty, sl[:,:,:,:,:]) )
+        self._delayedDirtySignal.setInterval(interval)
+        self._delayedDirtySignal.timeout.connect( self._publishBounds )
         self._delayedBoundsChange.connect(self._delayedDirtySignal.start)
 
+        self._recomputeTimer = QTimer()
+        self._recomputeTimer.setSingleShot(True)
+        self._recomputeTimer.setInterval(cfg.getint('pixelpipeline', 'statistics_delay_ms'))
+        self._recomputeTimer.timeout.connect( self._recomputeBounds )
+        self._delayedRecompute.connect(self._recomputeTimer.start)
+
     @property
     def numberOfChannels(self):
         return self._rawSource.numberOfChannels
@@ -501,12 +1143,90 @@ class MinMaxSource( QObject ):
         return self._rawSource.dtype()
     
     def request( self, slicing ):
-        rawRequest = self._rawSource.request(slicing)
+        # layers showing the same raw source share its requests
+        rawRequest = requestCoalescer.request(self._rawSource, slicing)
         return MinMaxUpdateRequest( rawRequest, self._getMinMax )
 
     def setDirty( self, slicing ):
         self.isDirty.emit(slicing)
 
+    def resetBounds( self ):
+        '''Forget the bounds and estimate them anew from the next requests.'''
+        self._recomputeTimer.stop()
+        if self._statisticsJob is not None:
+            self._statisticsJob.cancel()
+            self._statisticsJob = None
+        with self._lock:
+            self._bounds = [1e9,-1e9]
+            self._reservoir = _Reservoir(self.RESERVOIR_SIZE)
+            self._fixed = False
+        self.setDirty( sl[:,:,:,:,:] )
+
+    def precomputeBounds( self ):
+        '''Set the bounds from the statistics of the whole raw source (see
+        volumina.pixelpipeline.statistics).
+
+        Only sources whose data is readily available (ArraySource,
+        ChunkedSource and their channels) are processed, so that no
+        pipeline is computed just for the contrast. The statistics are
+        computed in the background; the bounds are estimated from the
+        requests until they are available. Returns the StatisticsJob,
+        or None if the statistics are cached or not computed.'''
+        if not cfg.getboolean('pixelpipeline', 'volume_statistics'):
+            return None
+        if not _hasAvailableData(self._rawSource):
+            return None
+        stats = cachedStatistics(self._rawSource)
+        if stats is not None:
+            self.setStatistics(stats)
+            return None
+        shape = sourceShape(self._rawSource)
+        if shape is None:
+            return None
+        job = statisticsJob(self._rawSource, shape)
+        job.finished.connect(partial(self._statisticsFinished, job))
+        self._statisticsJob = job
+        job.start()
+        return job
+
+    def setStatistics( self, stats ):
+        '''Fix the bounds to the percentiles of the VolumeStatistics stats.'''
+        self._statisticsJob = None
+        if stats is None:
+            return
+        if tuple(self.percentiles) == (0, 100):
+            bounds = [stats.min, stats.max]
+        else:
+            bounds = list(stats.percentiles(self.percentiles))
+        with self._lock:
+            self._bounds = bounds
+            self._fixed = True
+        self.boundsChanged.emit(bounds)
+        self.setDirty( sl[:,:,:,:,:] )
+
+    def _statisticsFinished( self, job, stats ):
+        # the statistics of a job that was cancelled in the meantime are
+        # not used
+        if job is self._statisticsJob:
+            self.setStatistics(stats)
+
+    def _onRawDirty( self, slicing ):
+        # the statistics of the whole source are outdated; the fixed
+        # bounds are kept until they are computed again, after the data
+        # stopped changing (e.g. at the end of a brush stroke)
+        forgetStatistics(self._rawSource)
+        running = self._statisticsJob is not None
+        if running:
+            self._statisticsJob.cancel()
+            self._statisticsJob = None
+        with self._lock:
+            fixed = self._fixed
+        if fixed or running:
+            self._delayedRecompute.emit()
+
+    def _recomputeBounds( self ):
+        return self.precomputeBounds()
+
     def __eq__( self, other ):
         equal = True
         if other is None:
@@ -519,42 +1239,60 @@ class MinMaxSource( QObject ):
         return not ( self == other )
 
     def _getMinMax(self, data):
-        dmin = np.min(data)
-        dmax = np.max(data)
-        dmin = min(self._bounds[0], dmin)
-        dmax = max(self._bounds[1], dmax)
-        dirty = False
-        if (self._bounds[0]-dmin) > 1e-2:
-            dirty = True
-        if (dmax-self._bounds[1]) > 1e-2:
-            dirty = True
-
-        if dirty:
-            self._bounds[0] = min(self._bounds[0], dmin)
-            self._bounds[1] = max(self._bounds[0], dmax)
-            self.boundsChanged.emit(self._bounds)
-
-            # Our min/max have changed, which means we must force the TileProvider to re-request all tiles.
+        if self._fixed:
+            return
+        sample = _strided(np.asarray(data), self._maxSamples)
+        if sample.dtype.kind == 'f':
+            sample = sample[np.isfinite(sample)]
+        if sample.size == 0:
+            return
+
+        with self._lock:
+            if tuple(self.percentiles) == (0, 100):
+                dmin = min(self._bounds[0], np.min(sample))
+                dmax = max(self._bounds[1], np.max(sample))
+                dirty = (self._bounds[0]-dmin) > 1e-2 or (dmax-self._bounds[1]) > 1e-2
+            else:
+                self._reservoir.add(sample)
+                dmin, dmax = self._reservoir.percentiles(self.percentiles)
+                tolerance = 1e-2 * (dmax - dmin)
+                dirty = self._bounds[0] > self._bounds[1] \
+                        or abs(dmin - self._bounds[0]) > tolerance \
+                        or abs(dmax - self._bounds[1]) > tolerance
+            if not dirty:
+                return
+            self._bounds = [dmin, dmax]
+
+            # Our bounds have changed, which means we must force the TileProvider to re-request all tiles.
             # If we simply mark everything dirty now, then nothing changes for the tile we just rendered.
             # (It was already dirty.  That's why we are rendering it right now.)
             # And when this data gets back to the TileProvider that requested it, the TileProvider will mark this tile clean again.
             # To ENSURE that the current tile is marked dirty AFTER the TileProvider has stored this data (and marked the tile clean),
             #  we'll use a timer to set everything dirty.
             # This fixes ilastik issue #418
-
-            # Finally, note that before this timer was added, the problem described above occurred at random due to a race condition:
-            # Sometimes the 'dirty' signal was processed BEFORE the data (bad) and sometimes it was processed after the data (good),
-            # due to the fact that the Qt signals are always delivered in the main thread.
-            # Perhaps a better way to fix this would be to store a timestamp in the TileProvider for dirty notifications, which 
-            # could be compared with the request timestamp before clearing the dirty state for each tile.
-
-            # Signal everything dirty with a timer, as described above.            
-            self._delayedBoundsChange.emit()
-
-            # Now, that said, we can still give a slightly more snappy response to the OTHER tiles (not this one)
-            # if we immediately tell the TileProvider we are dirty.  This duplicates some requests, but that shouldn't be a big deal.
-            self.setDirty( sl[:,:,:,:,:] )
+            # The timer also collects the bound changes of the following
+            # requests, so that everything is re-rendered at most once per
+            # interval while the bounds are growing.
+            if self._boundsChangePending:
+                return
+            self._boundsChangePending = True
+        self._delayedBoundsChange.emit()
+
+    def _publishBounds( self ):
+        with self._lock:
+            self._boundsChangePending = False
+            if self._fixed:
+                return
+            bounds = self._bounds
+        self.boundsChanged.emit(bounds)
+        self.setDirty( sl[:,:,:,:,:] )
 
 
 assert issubclass(MinMaxSource, SourceABC)
 
+def _hasAvailableData( source ):
+    '''Whether the data of source can be read without computing it.'''
+    if isinstance(source, ChannelSource):
+        return _hasAvailableData(source._source)
+    return isinstance(source, (ArraySource, ChunkedSource))
+
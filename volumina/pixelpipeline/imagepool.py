@@ -0,0 +1,120 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+#Python
+import threading
+from collections import OrderedDict, defaultdict
+
+#PyQt
+from PyQt4.QtGui import QImage
+
+from volumina.config import cfg
+
+#*******************************************************************************
+# I m a g e P o o l                                                            *
+#*******************************************************************************
+
+class ImagePool( object ):
+    '''
+    Recycles QImages of the same size and format.
+
+    take() returns a free image of the requested size and format or
+    allocates a new one. The content of a recycled image is undefined;
+    it must be overwritten completely.
+
+    give() returns an image that is no longer needed. Only give back
+    images that the caller took from the pool and never handed out:
+    the pool cannot tell whether an image is still in use, and QImage
+    copies share their data with the original until they are written
+    to. The free images are limited to 'maxmemory' bytes; the least
+    recently returned ones are discarded first.
+
+    The pool is thread safe.
+
+    '''
+    def __init__( self, maxmemory=None ):
+        if maxmemory is None:
+            maxmemory = cfg.getint('pixelpipeline', 'image_pool_mb') * 2**20
+        self._maxmemory = maxmemory
+        self._free = OrderedDict()       # id -> image, least recently returned first
+        self._bySize = defaultdict(list) # (width, height, format) -> ids
+        self._memoryUsage = 0
+        self._lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+        self.returned = 0
+        self.discarded = 0
+
+    def take( self, width, height, format=QImage.Format_ARGB32_Premultiplied ):
+        key = (width, height, format)
+        with self._lock:
+            ids = self._bySize.get(key)
+            if ids:
+                img = self._free.pop(ids.pop())
+                self._memoryUsage -= img.byteCount()
+                self.reused += 1
+                return img
+            self.allocated += 1
+        return QImage(width, height, format)
+
+    def give( self, img ):
+        '''Return img to the pool; returns whether it will be reused.'''
+        if img is None:
+            return False
+        nbytes = img.byteCount()
+        if nbytes <= 0 or nbytes > self._maxmemory:
+            return False
+        with self._lock:
+            if id(img) in self._free:
+                return False
+            self._free[id(img)] = img
+            self._bySize[(img.width(), img.height(), img.format())].append(id(img))
+            self._memoryUsage += nbytes
+            self.returned += 1
+            while self._memoryUsage > self._maxmemory:
+                self._discardOldest()
+        return True
+
+    def clear( self ):
+        with self._lock:
+            while self._free:
+                self._discardOldest()
+
+    def statistics( self ):
+        '''Return a dict with the number and memory of the free images
+        and the counters of allocated, reused, returned and discarded
+        images.'''
+        with self._lock:
+            return {'images': len(self._free),
+                    'memoryUsage': self._memoryUsage,
+                    'maxMemory': self._maxmemory,
+                    'allocated': self.allocated,
+                    'reused': self.reused,
+                    'returned': self.returned,
+                    'discarded': self.discarded}
+
+    def _discardOldest( self ):
+        # call with self._lock held
+        imgId, img = self._free.popitem(last=False)
+        key = (img.width(), img.height(), img.format())
+        self._bySize[key].remove(imgId)
+        if not self._bySize[key]:
+            del self._bySize[key]
+        self._memoryUsage -= img.byteCount()
+        self.discarded += 1
+
+# pool shared by the image sources and the tile providers
+imagePool = ImagePool()
@@ -30,8 +30,11 @@ from PyQt4.QtCore import QObject, QRect, pyqtSignal, QMutex
 from PyQt4.QtGui import QImage, QColor
 from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte_view
 from asyncabcs import SourceABC, RequestABC
-from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
+from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing, level2step
 from volumina.config import cfg
+from volumina.metrics import Metrics
+from conversion import gray2argb, colortable2argb, rgba2argb, orient, orientedShape
+from imagepool import imagePool
 import numpy as np
 
 _has_vigra = True
@@ -51,10 +54,17 @@ class ImageSource( QObject ):
     isDirty -- a rectangular region has changed; transmits
                an empty QRect if the whole image is dirty
 
+    The 'metrics' of an image source collect the time its requests
+    waited for data ('wait') and converted it to an image ('convert');
+    the TileProvider adds the per layer times of the tile pipeline.
+
     '''
 
     isDirty = pyqtSignal( QRect )
 
+    # whether request() accepts the 'orientation' keyword
+    orientable = False
+
     def __init__( self, guarantees_opaqueness = False, parent = None, direct=False ):
         ''' direct: whether this request will be computed synchronously in the GUI thread (direct=True)
                     or whether the request will be put on a worker queue to be computed in a worker thread
@@ -63,8 +73,18 @@ class ImageSource( QObject ):
         super(ImageSource, self).__init__( parent = parent )
         self._opaque = guarantees_opaqueness
         self.direct = direct
+        self.metrics = Metrics()
+
+    def request( self, rect, along_through=None, level=0 ):
+        '''Request the image of rect (in data coordinates).
 
-    def request( self, rect, along_through=None ):
+        level       -- pyramid level; the image of level n is downsampled
+                       by 2**n along both axes
+        orientation -- only if the source is 'orientable': transpose and
+                       mirror the data before it is converted to an image
+                       (see conversion.axisOrientation())
+
+        '''
         raise NotImplementedError
 
     def setDirty( self, slicing ):
@@ -103,6 +123,7 @@ assert issubclass(ImageSource, SourceABC)
 class GrayscaleImageSource( ImageSource ):
     loggingName = __name__ + ".GrayscaleImageSource"
     logger = logging.getLogger(loggingName)
+    orientable = True
     
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
@@ -115,7 +136,7 @@ class GrayscaleImageSource( ImageSource ):
         if hasattr(self._layer, "normalizeChanged"):
             self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0, orientation=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  GrayscaleImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -124,23 +145,29 @@ class GrayscaleImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=level2step(level))
         req = self._arraySource2D.request(s, along_through)
-        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
+        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct,
+                                      orientation=orientation, metrics=self.metrics )
 assert issubclass(GrayscaleImageSource, SourceABC)
 
 class GrayscaleImageRequest( object ):
     loggingName = __name__ + ".GrayscaleImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, normalize=None, direct=False ):
+    def __init__( self, arrayrequest, normalize=None, direct=False, orientation=None, metrics=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self.direct = direct
+        self._orientation = orientation
+        self._metrics = metrics
         
     def wait(self):
         return self.toImage()
+
+    def cancel( self ):
+        self._arrayreq.cancel()
         
     def toImage( self ):
         t = time.time()
@@ -150,49 +177,21 @@ class GrayscaleImageRequest( object ):
         tWAIT = 1000.0*(time.time()-tWAIT)
         
         tAR = time.time()
-        a = self._arrayreq.getResult()
+        a = orient(self._arrayreq.getResult(), self._orientation)
         tAR = 1000.0*(time.time()-tAR)
         
         assert a.ndim == 2, "GrayscaleImageRequest.toImage(): result has shape %r, which is not 2-D" % (a.shape,)
        
-        normalize = self._normalize 
-        if not normalize:
-            normalize = [0,255]
-            
-        aCopy = a.copy()
-        
-        #
-        # new conversion
-        #
-        tImg = None
-        if _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
-            if not a.flags.contiguous:
-                a = a.copy()
-            if self._normalize is None or \
-               self._normalize[0] >= self._normalize[1] or \
-               self._normalize == [0, 0]: #FIXME: fix volumina conventions
-                n = np.asarray([0, 255], dtype=a.dtype)
-            else:
-                n = np.asarray(self._normalize, dtype=a.dtype)
-            tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
-            vigra.colors.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
-            tImg = 1000.0*(time.time()-tImg)
-        else:
-            self.logger.warning("using slow image creation function")
-            tImg = time.time()
-            if self._normalize:
-                #clipping has been implemented in this commit,
-                #but it is not yet available in the packages obtained via easy_install
-                #http://www.informatik.uni-hamburg.de/~meine/hg/qimage2ndarray/diff/fcddc70a6dea/qimage2ndarray/__init__.py
-                a = np.clip(aCopy, *self._normalize)
-            img = gray2qimage(a, self._normalize)
-            ret = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
-            tImg = 1000.0*(time.time()-tImg)
-        
+        tImg = time.time()
+        img = gray2argb(a, self._normalize)
+        tImg = 1000.0*(time.time()-tImg)
+
+        if self._metrics is not None:
+            self._metrics.record('wait', tWAIT/1000.0)
+            self._metrics.record('convert', tImg/1000.0)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
-            self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
+            self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), self._normalize, tTOT, tAR, tWAIT, tImg))
             
         return img
             
@@ -211,6 +210,8 @@ assert issubclass(GrayscaleImageRequest, RequestABC)
 #*******************************************************************************
 
 class AlphaModulatedImageSource( ImageSource ):
+    orientable = True
+
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(AlphaModulatedImageSource, self).__init__()
@@ -219,7 +220,7 @@ class AlphaModulatedImageSource( ImageSource ):
 
         self._arraySource2D.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0, orientation=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  AlphaModulatedImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -228,24 +229,30 @@ class AlphaModulatedImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=level2step(level))
         req = self._arraySource2D.request(s, along_through)
-        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0] )
+        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0],
+                                           orientation=orientation, metrics=self.metrics )
 assert issubclass(AlphaModulatedImageSource, SourceABC)
 
 class AlphaModulatedImageRequest( object ):
     loggingName = __name__ + ".AlphaModulatedImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, tintColor, normalize=(0,255)):
+    def __init__( self, arrayrequest, tintColor, normalize=(0,255), orientation=None, metrics=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self._tintColor = tintColor
+        self._orientation = orientation
+        self._metrics = metrics
 
     def wait(self):
         return self.toImage()
 
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def toImage( self ):
         t = time.time()
        
@@ -254,7 +261,7 @@ class AlphaModulatedImageRequest( object ):
         tWAIT = 1000.0*(time.time()-tWAIT)
         
         tAR = time.time()
-        a = self._arrayreq.getResult()
+        a = orient(self._arrayreq.getResult(), self._orientation)
         tAR = 1000.0*(time.time()-tAR)
 
         tImg = None
@@ -262,7 +269,7 @@ class AlphaModulatedImageRequest( object ):
             if not a.flags.contiguous:
                 a = a.copy()
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            img = imagePool.take(a.shape[1], a.shape[0])
             tintColor = np.asarray([self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF()], dtype=np.float32);
             normalize = np.asarray(self._normalize, dtype=a.dtype)
             if normalize[0] > normalize[1]:
@@ -283,6 +290,9 @@ class AlphaModulatedImageRequest( object ):
             img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
             tImg = 1000.0*(time.time()-tImg)
        
+        if self._metrics is not None:
+            self._metrics.record('wait', tWAIT/1000.0)
+            self._metrics.record('convert', tImg/1000.0)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
@@ -308,6 +318,7 @@ assert issubclass(AlphaModulatedImageRequest, RequestABC)
 class ColortableImageSource( ImageSource ):
     loggingName = __name__ + ".ColortableImageSource"
     logger = logging.getLogger(loggingName)
+    orientable = True
     
     def __init__( self, arraySource2D, layer ):
         """ colorTable: a list of QRgba values """
@@ -328,7 +339,7 @@ class ColortableImageSource( ImageSource ):
         self._colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
 
         for i, c in enumerate(layerColorTable):
-            #note that we use qimage2ndarray.byte_view() on a QImage with Format_ARGB32 below.
+            #note that colortable2argb() writes the colors into the bytes of a QImage with Format_ARGB32.
             #this means that the memory layout actually is B, G, R, A
 
             if isinstance(c, QColor):
@@ -339,10 +350,12 @@ class ColortableImageSource( ImageSource ):
             self._colorTable[i,1] = color.green()
             self._colorTable[i,2] = color.red()
             self._colorTable[i,3] = color.alpha() 
+        # lookup tables of the colortable for each dtype and normalization
+        self._luts = {}
         
         self.isDirty.emit(QRect()) # empty rect == everything is dirty
         
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0, orientation=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  ColortableImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d) = %r" \
@@ -351,25 +364,32 @@ class ColortableImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=level2step(level))
         req = self._arraySource2D.request(s, along_through)
-        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct )
+        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct,
+                                       orientation=orientation, metrics=self.metrics, luts=self._luts )
 assert issubclass(ColortableImageSource, SourceABC)
 
 class ColortableImageRequest( object ):
     loggingName = __name__ + ".ColortableImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, colorTable, normalize, direct=False ):
+    def __init__( self, arrayrequest, colorTable, normalize, direct=False, orientation=None, metrics=None, luts=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._colorTable = colorTable
+        self._luts = luts
         self.direct = direct
         self._normalize = normalize
+        self._orientation = orientation
+        self._metrics = metrics
         assert normalize is None or len(normalize) == 2
 
     def wait(self):
         return self.toImage()
+
+    def cancel( self ):
+        self._arrayreq.cancel()
         
     def toImage( self ):
         t = time.time()
@@ -379,55 +399,18 @@ class ColortableImageRequest( object ):
         tWAIT = 1000.0*(time.time()-tWAIT)
         
         tAR = time.time()
-        a = self._arrayreq.getResult()
+        a = orient(self._arrayreq.getResult(), self._orientation)
         tAR = 1000.0*(time.time()-tAR)
         
         assert a.ndim == 2
 
-        if self._normalize and self._normalize[0] < self._normalize[1]:
-            nmin, nmax = self._normalize
-            if nmin:
-                a = a - nmin
-            scale = (len(self._colorTable)-1) / float(nmax - nmin + 1e-35) #if max==min
-            if scale != 1.0:
-                a = a * scale
-            if len(self._colorTable) <= 2**8:
-                a = np.asarray( a, dtype=np.uint8 )
-            elif len(self._colorTable) <= 2**16:
-                a = np.asarray( a, dtype=np.uint16 )
-            elif len(self._colorTable) <= 2**32:
-                a = np.asarray( a, dtype=np.uint32 )
-
-        # Use vigra if possible (much faster)
-        tImg = None
-        if _has_vigra and hasattr(vigra.colors, 'applyColortable'):
-            tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
-            if not issubclass( a.dtype.type, np.integer ):
-                raise NotImplementedError()
-                #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
-                #this problem 
-                import warnings
-                warnings.warn("Data for colortable layers cannot be float, casting",RuntimeWarning)
-                a=a.astype(np.int32)
-            vigra.colors.applyColortable(a, self._colorTable, byte_view(img))
-            tImg = 1000.0*(time.time()-tImg)
+        tImg = time.time()
+        img = colortable2argb(a, self._colorTable, self._normalize, luts=self._luts)
+        tImg = 1000.0*(time.time()-tImg)
 
-        # Without vigra, do it the slow way 
-        else:
-            raise NotImplementedError()
-            if _has_vigra:
-                # If this warning is annoying you, try this:
-                # warnings.filterwarnings("once")
-                warnings.warn("Using slow colortable images.  Upgrade to VIGRA > 1.9 to use faster implementation.")
-
-            #make sure that a has values in range [0, colortable_length)
-            a = np.remainder(a, len(self._colorTable))
-            #apply colortable
-            colortable = np.roll(np.fliplr(self._colorTable), -1, 1) # self._colorTable is BGRA, but array2qimage wants RGBA
-            img = colortable[a]
-            img = array2qimage(img)
-            
+        if self._metrics is not None:
+            self._metrics.record('wait', tWAIT/1000.0)
+            self._metrics.record('convert', tImg/1000.0)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), tTOT, tAR, tWAIT, tImg))
@@ -449,6 +432,8 @@ assert issubclass(ColortableImageRequest, RequestABC)
 #*******************************************************************************
 
 class RGBAImageSource( ImageSource ):
+    orientable = True
+
     def __init__( self, red, green, blue, alpha, layer, guarantees_opaqueness = False ):
         '''
         If you don't want to set all the channels,
@@ -468,7 +453,7 @@ class RGBAImageSource( ImageSource ):
         for arraySource in self._channels:
             arraySource.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0, orientation=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  RGBAImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -477,7 +462,7 @@ class RGBAImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing( qrect )
+        s = rect2slicing( qrect, step=level2step(level) )
         r = self._channels[0].request(s, along_through)
         g = self._channels[1].request(s, along_through)
         b = self._channels[2].request(s, along_through)
@@ -485,38 +470,42 @@ class RGBAImageSource( ImageSource ):
         shape = list( slicing2shape(s) )
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
-        return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize )
+        return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize,
+                                 orientation=orientation, metrics=self.metrics )
 assert issubclass(RGBAImageSource, SourceABC)
 
 class RGBAImageRequest( object ):
     def __init__( self, r, g, b, a, shape,
-                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None ):
+                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None,
+                  orientation=None, metrics=None ):
         self._mutex = QMutex()
         self._requests = r, g, b, a
+        self._orientation = orientation
+        self._metrics = metrics
         self._normalize = [normalizeR, normalizeG, normalizeB, normalizeA]
-        shape.append(4)
-        self._data = np.empty(shape, dtype=np.uint8)
+        self._shape = orientedShape(shape, orientation)
         self._requestsFinished = 4 * [False,]
 
     def wait(self):
+        t = time.time()
         for req in self._requests:
             req.wait()
+        if self._metrics is not None:
+            self._metrics.record('wait', time.time()-t)
         return self.toImage()
 
+    def cancel( self ):
+        for req in self._requests:
+            req.cancel()
+
     def toImage( self ):
-        for i, req in enumerate(self._requests):
-            a = req.getResult()
-            normalize = self._normalize[i]
-            if normalize is not None and \
-               normalize[0] < normalize[1]:
-                a = a.astype(np.float32)
-                a = (a - normalize[0])*255.0 / (normalize[1]-normalize[0])
-                a[a > 255] = 255
-                a[a < 0]   = 0
-                a = a.astype(np.uint8)
-            self._data[:,:,i] = a
-        img = array2qimage(self._data)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
+        t = time.time()
+        channels = [orient(req.getResult(), self._orientation) for req in self._requests]
+        assert channels[0].shape == self._shape
+        img = rgba2argb(channels, self._normalize)
+        if self._metrics is not None:
+            self._metrics.record('convert', time.time()-t)
+        return img
 
     def notify( self, callback, **kwargs ):
         for i in xrange(4):
@@ -538,11 +527,13 @@ assert issubclass(RGBAImageRequest, RequestABC)
 
 class RandomImageSource( ImageSource ):
     '''Random noise image for testing and debugging.'''
-    def request( self, qrect, along_through=None ):
+    orientable = True
+
+    def request( self, qrect, along_through=None, level=0, orientation=None ):
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=level2step(level))
         shape = slicing2shape( s )
-        return RandomImageRequest( shape )
+        return RandomImageRequest( orientedShape(shape, orientation) )
 assert issubclass(RandomImageSource, SourceABC)
 
 class RandomImageRequest( object ):
@@ -554,6 +545,9 @@ class RandomImageRequest( object ):
         assert d.ndim == 2
         img = gray2qimage(d)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+    def cancel( self ):
+        pass
             
     def notify( self, callback, **kwargs ):
         img = self.wait()
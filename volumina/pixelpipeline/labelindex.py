@@ -0,0 +1,362 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''Index of the blocks of a label image in which each label occurs.
+
+Operations on single labels, e.g. changing the color of a segment or
+extracting its mesh, only need to touch the blocks that contain the
+label, or its bounding box, instead of the whole volume.
+
+A LabelIndex is computed block by block, either directly
+(computeLabelIndex) or in a background thread (LabelIndexJob), and can
+be saved to and loaded from a file. Changed blocks are marked dirty and
+rescanned later (refresh()); only their entries are replaced.
+
+'''
+
+#Python
+import os
+import threading
+
+#SciPy
+import numpy as np
+
+#PyQt
+from PyQt4.QtCore import QObject, pyqtSignal
+
+from volumina.slicingtools import make_bounded
+
+#*******************************************************************************
+# L a b e l I n d e x                                                          *
+#*******************************************************************************
+
+class LabelIndex( object ):
+    '''
+    The blocks of a 5D (t,x,y,z,c) label image in which each label
+    occurs, and the bounding box of each label.
+
+    The image is cut into blocks of blockShape, numbered in C order of
+    the block grid. A new index is empty; update() scans the blocks of
+    the image. The index may be queried while another thread updates
+    it.
+
+    markDirty() records changed blocks without scanning them, so that it
+    is cheap enough for every change of the data; refresh() rescans
+    them. Until then, blocks() counts the dirty blocks as containing
+    every label, while the bounding boxes are those of the last scan.
+
+    '''
+    BLOCK_SHAPE = (1, 64, 64, 64, 1)
+
+    def __init__( self, shape, blockShape=None ):
+        if blockShape is None:
+            blockShape = self.BLOCK_SHAPE
+        self.shape = tuple(int(n) for n in shape)
+        self.blockShape = tuple(max(1, min(b, n)) for b, n in zip(blockShape, self.shape))
+        self.grid = tuple((n + b - 1) // b for n, b in zip(self.shape, self.blockShape))
+        self.blockCount = int(np.prod(self.grid))
+        self._lock = threading.Lock() # guards the dirty blocks and the state
+        self._refreshLock = threading.Lock()
+        self._dirty = set()
+        self._scanning = set() # dirty blocks that are being rescanned
+        empty = np.empty((0, len(self.shape)), dtype=np.intp)
+        self._build(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.intp), empty, empty)
+
+    def _build( self, labels, blocks, lo, hi ):
+        order = np.lexsort((blocks, labels))
+        self._setState(labels[order], blocks[order], lo[order], hi[order])
+
+    def _setState( self, labels, blocks, lo, hi, scanned=() ):
+        # The (label, block) pairs with the bounding box of the label in
+        # the block, sorted by label, and the table of the labels. The
+        # state is replaced at once, so that readers see a consistent one.
+        starts = np.flatnonzero(np.append(True, labels[1:] != labels[:-1])) if len(labels) > 0 \
+                 else np.empty(0, dtype=np.intp)
+        table = labels[starts]
+        offsets = np.append(starts, len(labels))
+        if len(labels) > 0:
+            tableLo = np.minimum.reduceat(lo, starts, axis=0)
+            tableHi = np.maximum.reduceat(hi, starts, axis=0)
+        else:
+            tableLo, tableHi = lo, hi
+        with self._lock:
+            self._state = (labels, blocks, lo, hi, table, offsets, tableLo, tableHi)
+            self._scanning.difference_update(scanned)
+
+    @property
+    def labels( self ):
+        '''Sorted array of the labels that occur in the image.'''
+        return self._state[4]
+
+    def __contains__( self, label ):
+        table = self._state[4]
+        i = np.searchsorted(table, label)
+        return i < len(table) and table[i] == label
+
+    def update( self, array, slicing=None, progress=None, cancelled=None ):
+        '''Scan the blocks of array that intersect slicing (all blocks if
+        slicing is None), e.g. after the data changed.
+
+        progress(fraction) is called after every block. If cancelled()
+        returns true, the scan stops and the index is left unchanged;
+        returns whether the scan was completed.'''
+        if slicing is None:
+            numbers = np.arange(self.blockCount)
+        else:
+            numbers = self.blocksForSlicing(slicing)
+        with self._refreshLock:
+            return self._rescan(array, numbers, progress, cancelled)
+
+    def markDirty( self, slicing ):
+        '''Mark the blocks that intersect slicing for rescanning by
+        refresh().'''
+        numbers = self.blocksForSlicing(slicing)
+        with self._lock:
+            self._dirty.update(numbers.tolist())
+
+    @property
+    def dirty( self ):
+        '''Whether blocks are marked dirty or being rescanned.'''
+        with self._lock:
+            return bool(self._dirty or self._scanning)
+
+    def refresh( self, array, cancelled=None ):
+        '''Rescan the dirty blocks of array; see update().'''
+        with self._refreshLock:
+            with self._lock:
+                numbers = np.array(sorted(self._dirty), dtype=np.intp)
+                self._scanning, self._dirty = self._dirty, set()
+            if self._rescan(array, numbers, cancelled=cancelled):
+                return True
+            with self._lock:
+                self._dirty.update(self._scanning)
+                self._scanning = set()
+            return False
+
+    def _rescan( self, array, numbers, progress=None, cancelled=None ):
+        if len(numbers) == 0:
+            return True
+        parts = []
+        for i, number in enumerate(numbers):
+            if cancelled is not None and cancelled():
+                return False
+            parts.append(self._scan(array, number))
+            if progress is not None:
+                progress((i + 1) / float(len(numbers)))
+        if len(numbers) == self.blockCount:
+            self._build(*[np.concatenate(p) for p in zip(*parts)])
+            return True
+        # splice the pairs of the scanned blocks into the sorted pairs of
+        # the others, which stay in place
+        labels, blocks, lo, hi = self._state[:4]
+        scanned = np.zeros(self.blockCount, dtype=bool)
+        scanned[numbers] = True
+        keep = np.logical_not(scanned[blocks])
+        labels, blocks, lo, hi = labels[keep], blocks[keep], lo[keep], hi[keep]
+        new = [np.concatenate(p) for p in zip(*parts)]
+        order = np.argsort(new[0], kind='mergesort')
+        new = [a[order] for a in new]
+        pos = np.searchsorted(labels, new[0])
+        labels, blocks, lo, hi = [np.insert(a, pos, b, axis=0) for a, b in zip((labels, blocks, lo, hi), new)]
+        self._setState(labels, blocks, lo, hi, scanned=numbers.tolist())
+        return True
+
+    def _scan( self, array, number ):
+        # the labels of a block and their bounding boxes
+        slicing = self.blockSlicing(number)
+        block = np.asarray(array[slicing])
+        labels, inverse = np.unique(block.ravel(), return_inverse=True)
+        blocks = np.empty(len(labels), dtype=np.intp)
+        blocks[:] = number
+        lo = np.empty((len(labels), block.ndim), dtype=np.intp)
+        hi = np.empty((len(labels), block.ndim), dtype=np.intp)
+        order = np.argsort(inverse, kind='mergesort')
+        starts = np.searchsorted(inverse[order], np.arange(len(labels)))
+        for axis, s in enumerate(slicing):
+            shape = [1] * block.ndim
+            shape[axis] = block.shape[axis]
+            coords = np.broadcast_to(np.arange(block.shape[axis]).reshape(shape), block.shape).ravel()[order]
+            lo[:, axis] = np.minimum.reduceat(coords, starts) + s.start
+            hi[:, axis] = np.maximum.reduceat(coords, starts) + s.start + 1
+        return labels.astype(np.int64), blocks, lo, hi
+
+    def blocks( self, labels ):
+        '''Sorted array of the numbers of the blocks that contain any of
+        the labels, including the dirty blocks.'''
+        with self._lock:
+            state = self._state
+            dirty = np.array(sorted(self._dirty | self._scanning), dtype=np.intp)
+        pairBlocks, table, offsets = state[1], state[4], state[5]
+        labels = np.atleast_1d(np.asarray(labels))
+        idx = np.searchsorted(table, labels)
+        inRange = idx < len(table)
+        idx = idx[inRange]
+        found = idx[table[idx] == labels[inRange]]
+        parts = [pairBlocks[offsets[i]:offsets[i+1]] for i in found]
+        return np.unique(np.concatenate(parts + [dirty]))
+
+    def boundingBox( self, label ):
+        '''The smallest slicing that contains all occurrences of label,
+        or None if the label does not occur.'''
+        table, tableLo, tableHi = self._state[4], self._state[6], self._state[7]
+        i = np.searchsorted(table, label)
+        if i >= len(table) or table[i] != label:
+            return None
+        return tuple(slice(int(l), int(h)) for l, h in zip(tableLo[i], tableHi[i]))
+
+    def blockSlicing( self, number ):
+        coords = np.unravel_index(number, self.grid)
+        return tuple(slice(c*b, min((c+1)*b, n))
+                     for c, b, n in zip(coords, self.blockShape, self.shape))
+
+    def blocksForSlicing( self, slicing ):
+        '''Sorted array of the numbers of the blocks that intersect the
+        region of slicing.'''
+        slicing = make_bounded(slicing, self.shape)
+        ranges = [np.arange(s.start // b, (s.stop - 1) // b + 1) if s.stop > s.start else np.arange(0)
+                  for s, b in zip(slicing, self.blockShape)]
+        mesh = np.meshgrid(*ranges, indexing='ij')
+        return np.ravel_multi_index([m.ravel() for m in mesh], self.grid)
+
+    def boundingSlicing( self, numbers ):
+        '''The smallest slicing that contains the blocks numbers.'''
+        coords = np.column_stack(np.unravel_index(numbers, self.grid))
+        lo, hi = coords.min(axis=0), coords.max(axis=0) + 1
+        return tuple(slice(l*b, min(h*b, n))
+                     for l, h, b, n in zip(lo, hi, self.blockShape, self.shape))
+
+    def intersects( self, slicing, numbers ):
+        '''Whether the region of slicing intersects any of the blocks
+        numbers.'''
+        if len(numbers) == 0:
+            return False
+        slicing = make_bounded(slicing, self.shape)
+        coords = np.column_stack(np.unravel_index(numbers, self.grid))
+        lo = np.array([s.start // b for s, b in zip(slicing, self.blockShape)])
+        hi = np.array([(s.stop - 1) // b + 1 for s, b in zip(slicing, self.blockShape)])
+        return bool(np.any(np.all((coords >= lo) & (coords < hi), axis=1)))
+
+    def dirtySlicings( self, labels, maxSlicings=64 ):
+        '''Slicings that cover the blocks containing any of the labels:
+        one per block, or their bounding slicing if there are more than
+        maxSlicings blocks.'''
+        numbers = self.blocks(labels)
+        if len(numbers) == 0:
+            return []
+        if len(numbers) > maxSlicings:
+            return [self.boundingSlicing(numbers)]
+        return [self.blockSlicing(n) for n in numbers]
+
+    def save( self, filename ):
+        labels, blocks, lo, hi = self._state[:4]
+        with open(filename, 'wb') as f:
+            np.savez(f, shape=self.shape, blockShape=self.blockShape,
+                     labels=labels, blocks=blocks, lo=lo, hi=hi)
+
+    @classmethod
+    def load( cls, filename ):
+        data = np.load(filename)
+        index = cls(tuple(data['shape']), tuple(data['blockShape']))
+        index._build(data['labels'], data['blocks'], data['lo'], data['hi'])
+        return index
+
+def computeLabelIndex( array, blockShape=None ):
+    '''Return the LabelIndex of array, computed in this thread.'''
+    index = LabelIndex(array.shape, blockShape)
+    index.update(array)
+    return index
+
+#*******************************************************************************
+# L a b e l I n d e x J o b                                                    *
+#*******************************************************************************
+
+class LabelIndexJob( QObject ):
+    '''
+    Computes the LabelIndex of an array in a background thread (start())
+    or in the calling thread (run()).
+
+    If filename is given, the index is loaded from this file if it
+    exists and belongs to an array of the same shape, and saved to it
+    otherwise. Whether a saved index matches the data is up to the
+    caller. onDone(index) is called in the thread of the job when the
+    index is available.
+
+    '''
+    progress = pyqtSignal(float)  # fraction of the blocks scanned
+    finished = pyqtSignal(object) # LabelIndex
+
+    def __init__( self, array, blockShape=None, filename=None, onDone=None ):
+        super(LabelIndexJob, self).__init__()
+        self._array = array
+        self._blockShape = blockShape
+        self._filename = filename
+        self._onDone = onDone
+        self._cancelled = False
+        self._thread = None
+        self.result = None
+
+    @property
+    def cancelled( self ):
+        return self._cancelled
+
+    @property
+    def started( self ):
+        return self._thread is not None
+
+    def start( self ):
+        '''Run the job in a background thread, unless it was started
+        already.'''
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name="LabelIndexJob")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel( self ):
+        '''Stop after the current block; a cancelled job does not emit
+        finished.'''
+        self._cancelled = True
+
+    def wait( self, timeout=None ):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.result
+
+    def run( self ):
+        index = self._load()
+        if index is None:
+            index = LabelIndex(self._array.shape, self._blockShape)
+            if not index.update(self._array, progress=self.progress.emit,
+                                cancelled=lambda: self._cancelled):
+                return None
+            if self._filename is not None:
+                index.save(self._filename)
+        self.result = index
+        if self._onDone is not None:
+            self._onDone(index)
+        self.finished.emit(index)
+        return index
+
+    def _load( self ):
+        if self._filename is None or not os.path.exists(self._filename):
+            return None
+        try:
+            index = LabelIndex.load(self._filename)
+        except (IOError, KeyError, ValueError):
+            return None
+        if index.shape != tuple(self._array.shape):
+            return None
+        return index
@@ -19,6 +19,7 @@ from asyncabcs import SourceABC, RequestABC
 import numpy as np
 import volumina
 from volumina.slicingtools import SliceProjection, is_pure_slicing, intersection, sl
+from coalescing import requestCoalescer
 from volumina.colorama import Fore
 
 projectionAlongTXC = SliceProjection( abscissa = 2, ordinate = 3, along = [0,1,4] )
@@ -135,7 +136,8 @@ class SliceSource( QObject ):
             volumina.printLock.acquire()
             print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
             volumina.printLock.release()
-        return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
+        # the views and layers of the same datasource share its requests
+        return SliceRequest(requestCoalescer.request(self._datasource, slicing), self.sliceProjection)
         
     def setDirty( self, slicing ):
         assert isinstance(slicing, tuple)
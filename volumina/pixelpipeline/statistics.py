@@ -0,0 +1,288 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+'''Statistics of whole datasources.
+
+The bounds that a MinMaxSource estimates from the rendered tiles change
+while the user navigates. A StatisticsJob instead streams over the
+whole datasource in blocks of bounded size and computes its minimum,
+maximum and histogram once. The results are cached per datasource.
+
+'''
+
+#Python
+import threading
+import itertools
+import weakref
+
+#SciPy
+import numpy as np
+
+#PyQt
+from PyQt4.QtCore import QObject, pyqtSignal
+
+from volumina.config import cfg
+
+def sourceShape( source ):
+    '''The 5D shape of a datasource, or None if it is unknown.'''
+    shape = None
+    if hasattr(source, '_array'):
+        shape = source._array.shape
+    elif getattr(source, '_shape', None) is not None:
+        shape = tuple(source._shape)
+    elif hasattr(source, '_source') and hasattr(source, 'channel'):
+        shape = sourceShape(source._source)
+        if shape is not None:
+            shape = tuple(shape[:-1]) + (1,)
+    if shape is None or len(shape) != 5:
+        return None
+    return shape
+
+def blocks( shape, itemsize, maxBytes ):
+    '''Slicings of the blocks of at most maxBytes that cover shape.
+
+    Blocks are made smaller along t, z, x, y and c, in this order, so
+    that they consist of whole slices if possible.'''
+    block = list(shape)
+    for axis in (0, 3, 1, 2, 4):
+        nbytes = itemsize * np.prod(block)
+        if nbytes > maxBytes:
+            block[axis] = max(1, int(block[axis] * maxBytes // nbytes))
+    starts = [xrange(0, n, b) for n, b in zip(shape, block)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(s, min(s + b, n)) for s, b, n in zip(start, block, shape))
+
+#*******************************************************************************
+# V o l u m e S t a t i s t i c s                                              *
+#*******************************************************************************
+
+class VolumeStatistics( object ):
+    '''Minimum, maximum and histogram of the (finite) values of a
+    datasource; counts[i] is the number of values in
+    [edges[i], edges[i+1]).'''
+    def __init__( self, dmin, dmax, counts, edges ):
+        self.min = dmin
+        self.max = dmax
+        self.counts = counts
+        self.edges = edges
+
+    def percentiles( self, q ):
+        '''Estimate the percentiles q (sequence of values in [0, 100])
+        from the histogram.'''
+        cdf = np.cumsum(self.counts, dtype=np.float64)
+        result = []
+        for p in q:
+            if p <= 0:
+                result.append(self.min)
+                continue
+            if p >= 100:
+                result.append(self.max)
+                continue
+            target = p / 100.0 * cdf[-1]
+            i = int(np.searchsorted(cdf, target))
+            below = cdf[i-1] if i > 0 else 0.0
+            fraction = (target - below) / max(self.counts[i], 1)
+            value = self.edges[i] + fraction * (self.edges[i+1] - self.edges[i])
+            result.append(min(max(value, self.min), self.max))
+        return result
+
+#*******************************************************************************
+# S t a t i s t i c s J o b                                                    *
+#*******************************************************************************
+
+class StatisticsJob( QObject ):
+    '''
+    Computes the VolumeStatistics of a datasource block by block.
+
+    run() computes the statistics in the calling thread, start() in a
+    background thread. Integer data of up to 16 bits is read once and
+    counted exactly; other data is read twice, for the range and for a
+    histogram with 'bins' bins. At most 'blockBytes' of data are
+    requested at once (default: statistics_block_mb of the
+    [pixelpipeline] config section), with uncachedRequest() if the
+    source has it, so that the pass does not evict the data in view
+    from the cache of the source. The result is cached, see
+    cachedStatistics().
+
+    '''
+    progress = pyqtSignal(float)  # fraction of the work done
+    finished = pyqtSignal(object) # VolumeStatistics, None if the source has no finite values
+
+    def __init__( self, source, shape, bins=256, blockBytes=None ):
+        super(StatisticsJob, self).__init__()
+        if blockBytes is None:
+            blockBytes = cfg.getint('pixelpipeline', 'statistics_block_mb') * 2**20
+        self._source = source
+        self._shape = shape
+        self._bins = bins
+        self._blockBytes = blockBytes
+        self._cancelled = False
+        self._request = None
+        self._thread = None
+        self.done = False
+        self.result = None
+
+    @property
+    def cancelled( self ):
+        return self._cancelled
+
+    @property
+    def started( self ):
+        return self._thread is not None
+
+    def start( self ):
+        '''Run the job in a background thread, unless it was started
+        already.'''
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name="StatisticsJob")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel( self ):
+        '''Stop after the current block; a cancelled job does not emit
+        finished.'''
+        self._cancelled = True
+        request = self._request
+        if request is not None and hasattr(request, 'cancel'):
+            request.cancel()
+
+    def wait( self, timeout=None ):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.result
+
+    def run( self ):
+        try:
+            dtype = np.dtype(self._source.dtype())
+            slicings = list(blocks(self._shape, dtype.itemsize, self._blockBytes))
+            if dtype.kind in 'biu' and dtype.itemsize <= 2:
+                stats = self._counted(slicings, dtype)
+            else:
+                stats = self._binned(slicings)
+        except _Cancelled:
+            return None
+        finally:
+            _finishJob(self._source, self)
+        self.result = stats
+        self.done = True
+        _cacheStatistics(self._source, stats)
+        self.finished.emit(stats)
+        return stats
+
+    def _data( self, slicings, passes, first ):
+        # the blocks of the source, with progress reports
+        total = float(len(slicings) * passes)
+        for i, slicing in enumerate(slicings):
+            if self._cancelled:
+                raise _Cancelled()
+            self._request = getattr(self._source, 'uncachedRequest', self._source.request)(slicing)
+            data = np.asarray(self._request.wait())
+            self._request = None
+            if self._cancelled:
+                raise _Cancelled()
+            yield data
+            self.progress.emit((first + i + 1) / total)
+
+    def _counted( self, slicings, dtype ):
+        lo = 0 if dtype.kind == 'b' else np.iinfo(dtype).min
+        n = 2 if dtype.kind == 'b' else 2**(8 * dtype.itemsize)
+        unsigned = np.dtype('u%d' % dtype.itemsize)
+        counts = np.zeros(n, dtype=np.int64)
+        for data in self._data(slicings, 1, 0):
+            # signed values are counted by their bit patterns, whose
+            # order is rotated by half the range
+            blockCounts = np.bincount(np.ascontiguousarray(data).view(unsigned).ravel())
+            counts[:len(blockCounts)] += blockCounts
+        if lo < 0:
+            counts = np.roll(counts, n // 2)
+        nonzero = np.flatnonzero(counts)
+        if len(nonzero) == 0:
+            return None
+        edges = np.arange(lo, lo + n + 1)
+        return VolumeStatistics(lo + nonzero[0], lo + nonzero[-1], counts, edges)
+
+    def _binned( self, slicings ):
+        dmin, dmax = np.inf, -np.inf
+        for data in self._data(slicings, 2, 0):
+            data = _finite(data)
+            if data.size > 0:
+                dmin = min(dmin, data.min())
+                dmax = max(dmax, data.max())
+        if dmin > dmax:
+            return None
+        counts = np.zeros(self._bins, dtype=np.int64)
+        edges = np.linspace(dmin, dmax, self._bins + 1)
+        for data in self._data(slicings, 2, len(slicings)):
+            counts += np.histogram(_finite(data), bins=edges)[0]
+        return VolumeStatistics(dmin, dmax, counts, edges)
+
+class _Cancelled( Exception ):
+    pass
+
+def _finite( data ):
+    if data.dtype.kind == 'f':
+        return data[np.isfinite(data)]
+    return data
+
+#*******************************************************************************
+# C a c h e                                                                    *
+#*******************************************************************************
+
+# id(source) -> (weakref to source, VolumeStatistics)
+_statistics = {}
+# id(source) -> running StatisticsJob
+_jobs = {}
+_lock = threading.Lock()
+
+def cachedStatistics( source ):
+    '''The VolumeStatistics of source, or None if they were not computed.'''
+    with _lock:
+        entry = _statistics.get(id(source))
+        if entry is not None and entry[0]() is source:
+            return entry[1]
+    return None
+
+def forgetStatistics( source ):
+    '''Drop the cached statistics of source, e.g. after its data changed.'''
+    with _lock:
+        _statistics.pop(id(source), None)
+
+def statisticsJob( source, shape=None ):
+    '''The StatisticsJob of source: the one that is already running or a
+    new one, which still has to be started.'''
+    if shape is None:
+        shape = sourceShape(source)
+    with _lock:
+        job = _jobs.get(id(source))
+        if job is None or job._source is not source or job.cancelled:
+            job = StatisticsJob(source, shape)
+            _jobs[id(source)] = job
+        return job
+
+def _finishJob( source, job ):
+    with _lock:
+        if _jobs.get(id(source)) is job:
+            del _jobs[id(source)]
+
+def _cacheStatistics( source, stats ):
+    key = id(source)
+    def forget( ref ):
+        with _lock:
+            if key in _statistics and _statistics[key][0] is ref:
+                del _statistics[key]
+    with _lock:
+        _statistics[key] = (weakref.ref(source, forget), stats)
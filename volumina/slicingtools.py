@@ -115,9 +115,9 @@ def slicing2rect(slicing):
                  h.stop - h.start,
                  v.stop - v.start)
 
-def rect2slicing(qrect, seq=tuple):
-    result = seq((slice(qrect.x(), qrect.x() + qrect.width()),
-                  slice(qrect.y(), qrect.y() + qrect.height())))
+def rect2slicing(qrect, seq=tuple, step=None):
+    result = seq((slice(qrect.x(), qrect.x() + qrect.width(), step),
+                  slice(qrect.y(), qrect.y() + qrect.height(), step)))
     return result
 
 def slicing2shape( slicing ):
@@ -125,9 +125,32 @@ def slicing2shape( slicing ):
     slicing = box(slicing)
     shape = []
     for sl in slicing:
-        shape.append(sl.stop - sl.start)
+        step = sl.step or 1
+        shape.append((sl.stop - sl.start + step - 1) // step)
     return tuple(shape)
 
+def level2step( level ):
+    '''Step of the slicings that request pyramid level 'level'.
+
+    Level 0 is the full resolution; each level halves the resolution
+    along both axes of a slice. The step of level 0 is None, so that
+    full resolution slicings are unchanged.
+
+    '''
+    return 2**level if level > 0 else None
+
+def strip_steps( slicing ):
+    '''Split a slicing into the unstrided slicing and the strides that
+    reduce the result of the former to the result of the original slicing.
+
+    >>> strip_steps((slice(0, 10, 2), slice(3, 5)))
+    ((slice(0, 10, None), slice(3, 5, None)), (slice(None, None, 2), slice(None, None, None)))
+
+    '''
+    slicing = box(slicing)
+    return (tuple(slice(sl.start, sl.stop) for sl in slicing),
+            tuple(slice(None, None, sl.step) for sl in slicing))
+
 def index2slice( slicing ):
     '''Convert integer indices to proper slice instances.
 
@@ -17,23 +17,34 @@
 #Python
 import sys
 import time
+import math
 import collections
 import warnings
-from collections import defaultdict, OrderedDict
-from threading import Thread, Lock
-from Queue import Queue, Empty, Full, LifoQueue
+import heapq
+import itertools
+from collections import defaultdict, OrderedDict, deque
+from threading import Thread, Lock, Condition
+from Queue import Empty, Full
 import weakref
 import atexit
+import json
 
 #SciPy
 import numpy
 
 #PyQt
-from PyQt4.QtCore import QRect, QRectF, QMutex, QObject, pyqtSignal, Qt
+from PyQt4.QtCore import QRect, QRectF, QSize, QPoint, QMutex, QObject, pyqtSignal, Qt
 from PyQt4.QtGui import QImage, QPainter, QTransform, QColor
+from qimage2ndarray import raw_view
 
 #volumina
 from patchAccessor import PatchAccessor
+from volumina.config import cfg
+from volumina.compositing import createCompositor
+from volumina.metrics import Metrics
+from volumina.pixelpipeline.imagepool import imagePool
+from volumina.pixelpipeline.coalescing import requestCoalescer
+from volumina.pixelpipeline.conversion import axisOrientation
 import volumina
 
 #*******************************************************************************
@@ -94,13 +105,20 @@ class Tiling(object):
     blockSize  -- base tile size: blockSize x blockSize (default 256)
     overlap    -- overlap between tiles positive number prevents rendering
                   artifacts between tiles for certain zoom levels (default 1)
+    maxLevel   -- highest pyramid level for zoomed out views; level n has
+                  1/2**n of the full resolution along both axes (default:
+                  'max_lod_level' in the [tiling] section of ~/.voluminarc)
 
     '''
 
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=256, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", maxLevel=None):
         self.blockSize = blockSize
+        if maxLevel is None:
+            maxLevel = cfg.getint('tiling', 'max_lod_level')
+        # a tile must keep at least one pixel per axis
+        self.maxLevel = max(0, min(maxLevel, int(math.log(blockSize, 2))))
         self.overlap = overlap
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
@@ -179,8 +197,12 @@ class Tiling(object):
         return br
 
     def containsF(self, point):
-        for i, p in enumerate(self.tileRectFs):
-            if p.contains(point):
+        '''Number of the first tile whose tile rect contains point, or
+        None. Only the tiles of the grid cells around point are tested.'''
+        margin = 1 + self._overlap_draw
+        around = QRectF(point.x() - margin, point.y() - margin, 2*margin, 2*margin)
+        for i in self.intersected(around):
+            if self.tileRectFs[i].contains(point):
                 return i
 
     def intersected(self, sceneRect):
@@ -194,6 +216,71 @@ class Tiling(object):
                             rect.bottomRight().x(), rect.bottomRight().y() )
         return patchNumbers
 
+    def levelForScale(self, scale):
+        '''Return the pyramid level to render when the scene is drawn
+        with the given scale factor, i.e. the coarsest level that still
+        has at least one data pixel per screen pixel.'''
+        if scale >= 1.0 or self.maxLevel == 0:
+            return 0
+        if scale <= 0:
+            return self.maxLevel
+        level = int(math.floor(math.log(1.0/scale, 2) + 1e-9))
+        return min(level, self.maxLevel)
+
+    # candidate block sizes of chooseBlockSize()
+    BLOCK_SIZES = (128, 256, 512, 1024)
+
+    def chooseBlockSize(self, viewportSize, scale, timePerPixel=0.0, hysteresis=0.2,
+                        tileOverhead=None):
+        '''Return the block size that minimizes the estimated time to
+        render a viewport.
+
+        Small tiles waste less work outside of the viewport, large tiles
+        have less per tile overhead. The estimate counts the tiles that
+        cover a viewport of viewportSize (screen pixels) at the given scale,
+        each costing tileOverhead plus the per pixel cost of the pixels
+        at the pyramid level for scale. The current block size is kept
+        unless another one is estimated to be faster by the fraction
+        'hysteresis'.
+
+        Arguments:
+        viewportSize -- QSize of the viewport
+        scale        -- screen pixels per scene pixel
+        timePerPixel -- measured cost of the layers, e.g. the sum of
+                        Layer.averageTimePerPixel of the visible layers
+        tileOverhead -- seconds per tile for requesting, scheduling and
+                        compositing, e.g. TileProvider.tileOverhead()
+                        (default: tile_overhead_ms of the [tiling]
+                        config section)
+
+        The cost per pixel of conversion and compositing is pixel_cost_ns
+        of the [tiling] config section.
+
+        '''
+        if scale <= 0 or viewportSize.isEmpty():
+            return self.blockSize
+        if tileOverhead is None:
+            tileOverhead = cfg.getfloat('tiling', 'tile_overhead_ms') * 1e-3
+        pixelCost = cfg.getfloat('tiling', 'pixel_cost_ns') * 1e-9
+        level = self.levelForScale(scale)
+        w = viewportSize.width() / float(scale)
+        h = viewportSize.height() / float(scale)
+        def cost(blockSize):
+            nTiles = (w/blockSize + 1) * (h/blockSize + 1)
+            pixels = (blockSize / 2.0**level)**2
+            return nTiles * (tileOverhead + (pixelCost + timePerPixel)*pixels)
+        best = min(self.BLOCK_SIZES, key=cost)
+        if cost(best) < (1.0 - hysteresis) * cost(self.blockSize):
+            return best
+        return self.blockSize
+
+    def levelSize(self, tileNr, level):
+        '''Size of the image of tile tileNr at pyramid level 'level'.'''
+        size = self.imageRects[tileNr].size()
+        step = 2**level
+        return QSize((size.width() + step - 1) // step,
+                     (size.height() + step - 1) // step)
+
     def __len__(self):
         return len(self.imageRectFs)
 
@@ -216,29 +303,116 @@ class TiledImageLayer(object):
             yield self[i]
 
 class _MultiCache( object ):
+    '''A set of caches (one per uid) that remembers the order of use.
+
+    The dict of caches is only modified when caches are added or
+    removed; touching a cache just updates the separately kept usage
+    order. Thus, lookups in self.caches never spuriously fail while
+    another thread touches a cache.
+
+    '''
     def __init__( self, first_uid, default_factory=lambda:None,
-                  maxcaches=None ):
+                  maxcaches=None, container=defaultdict ):
         self._maxcaches = maxcaches
-        self.caches = OrderedDict()
+        self._container = container
+        self.caches = {}
+        self._order = OrderedDict()
         self.add( first_uid, default_factory=default_factory)
 
     def add( self, uid, default_factory=lambda:None ):
         if uid not in self.caches:
-            cache = defaultdict(default_factory)
+            cache = self._container(default_factory)
             self.caches[uid] = cache
+            self._order[uid] = None
         else:
             raise Exception('MultiCache.add: uid %s is already in use' % str(uid))
 
         # remove oldest cache, if necessary
         old_uid = None
         if self._maxcaches and len(self.caches) > self._maxcaches:
-            old_uid, v = self.caches.popitem(False) # removes item in LIFO order
+            old_uid, v = self._order.popitem(False) # removes item in LIFO order
+            del self.caches[old_uid]
         return old_uid
 
     def touch( self, uid ):
-        c = self.caches[uid]
-        del self.caches[uid]
-        self.caches[uid] = c
+        del self._order[uid]
+        self._order[uid] = None
+
+    def get( self, uid, key ):
+        '''Look up key in the cache of uid without inserting a default value.
+
+        In contrast to self.caches[uid][key], this does not modify the
+        cache and is therefore safe to call without holding a lock.
+
+        '''
+        cache = self.caches[uid]
+        value = cache.get(key, _missing)
+        if value is _missing:
+            return cache.default_factory()
+        return value
+
+_missing = object()
+
+class _TileBitmap( object ):
+    '''Boolean flags of the tiles of a stack, as a container of a
+    _MultiCache.
+
+    The flags are kept in a NumPy bitmap, so that many tiles can be
+    marked at once (setMany(), setAll()). Tiles beyond the bitmap have
+    the default value. The bitmap grows by replacing the array, so that
+    lookups need no lock.
+
+    '''
+    def __init__( self, default_factory=lambda: True ):
+        self.default_factory = default_factory
+        self._default = bool(default_factory())
+        self._bits = numpy.empty(0, dtype=bool)
+
+    def __len__( self ):
+        return len(self._bits)
+
+    def __getitem__( self, tile_id ):
+        bits = self._bits
+        if tile_id < len(bits):
+            return bool(bits[tile_id])
+        return self._default
+
+    def get( self, tile_id, default=None ):
+        return self[tile_id]
+
+    def __setitem__( self, tile_id, b ):
+        self._grow(tile_id + 1)
+        self._bits[tile_id] = b
+
+    def setMany( self, tile_ids, b ):
+        tile_ids = numpy.asarray(tile_ids, dtype=numpy.intp)
+        if len(tile_ids) > 0:
+            self._grow(tile_ids.max() + 1)
+            self._bits[tile_ids] = b
+
+    def setAll( self, b ):
+        '''Set the flag of all tiles, including those beyond the bitmap.'''
+        self._default = bool(b)
+        self._bits[:] = b
+
+    def _grow( self, n ):
+        old = self._bits
+        if n > len(old):
+            bits = numpy.empty(max(n, 2*len(old)), dtype=bool)
+            bits[:len(old)] = old
+            bits[len(old):] = self._default
+            self._bits = bits
+
+# layer id of the partial blends in the LRU bookkeeping of _TilesCache
+_blendBase = object()
+
+def _commonPrefixLength( a, b ):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
 
 
 from functools import wraps
@@ -259,29 +433,158 @@ def synchronous( tlockname ):
 
 
 class _TilesCache( object ):
-    def __init__(self, first_stack_id, sims, maxstacks=None):
+    '''Cache for composited tiles and layer patches of several stacks.
+
+    Besides the number of stacks (maxstacks), the cache limits the
+    total number of bytes occupied by the cached QImages
+    (maxmemory). When the limit is exceeded, the least recently used
+    images are evicted -- regardless of the stack they belong to --
+    and the corresponding tiles and layer patches are marked dirty.
+
+    The cache is read-mostly: only methods that modify it acquire the
+    lock. Lookups (tile(), layer(), tileDirty(), ...) never block, so
+    that the GUI thread does not wait for the render threads while
+    painting. Cached values are replaced atomically by the writers,
+    and the bookkeeping for lookups (LRU order, hit/miss counters) is
+    recorded in a log which is applied by the next writer.
+
+    '''
+    READ_LOG_SIZE = 1024
+
+    def __init__(self, first_stack_id, sims, maxstacks=None, maxmemory=None):
         self._lock = Lock()
         self._sims = sims
 
         kwargs = {'first_uid' : first_stack_id,
                   'maxcaches' : maxstacks}
         self._tileCache = _MultiCache(default_factory=lambda: (None, 0.), **kwargs)
-        self._tileCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
+        self._tileCacheDirty = _MultiCache(default_factory=lambda: True,
+                                           container=_TileBitmap, **kwargs)
         self._layerCache = _MultiCache(**kwargs)
         self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
+        # dirty part (scene QRect) of a cached layer patch, None if the
+        # whole patch is dirty
+        self._layerCacheDirtyRect = _MultiCache(**kwargs)
         self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        self._blendCache = _MultiCache(default_factory=lambda: (None, (), ()), **kwargs)
+
+        # Byte size of every cached image in least recently used order.
+        # Keys are (stack_id, layer_id, tile_id), where layer_id is None
+        # for composited tiles and _blendBase for partial blends.
+        self._maxmemory = maxmemory
+        self._memoryUsage = 0
+        self._lru = OrderedDict()
+
+        self.tileHits = 0
+        self.tileMisses = 0
+        self.layerHits = 0
+        self.layerMisses = 0
+        self.evictions = 0
+
+        # lookups since the last write: (lru key, hit)
+        self._readLog = deque()
 
-    @synchronous('_lock')
     def __contains__( self, stack_id ):
         return stack_id in self._tileCache.caches
 
-    @synchronous('_lock')
     def __len__( self ):
         return len(self._tileCache.caches)
 
     @synchronous('_lock')
+    def statistics( self ):
+        self._applyReadLog()
+        return {'memoryUsage' : self._memoryUsage,
+                'maxMemory'   : self._maxmemory,
+                'images'      : len(self._lru),
+                'stacks'      : len(self._tileCache.caches),
+                'tileHits'    : self.tileHits,
+                'tileMisses'  : self.tileMisses,
+                'layerHits'   : self.layerHits,
+                'layerMisses' : self.layerMisses,
+                'evictions'   : self.evictions}
+
+    @synchronous('_lock')
+    def setMaxMemory( self, maxmemory ):
+        self._maxmemory = maxmemory
+        self._applyReadLog()
+        self._evict()
+
+    def _logRead( self, key, hit ):
+        self._readLog.append((key, hit))
+        # Apply the log opportunistically, but never wait for the lock.
+        if len(self._readLog) > self.READ_LOG_SIZE and self._lock.acquire(False):
+            try:
+                self._applyReadLog()
+            finally:
+                self._lock.release()
+
+    def _applyReadLog( self ):
+        '''Must be called with the lock held.'''
+        readLog = self._readLog
+        while True:
+            try:
+                key, hit = readLog.popleft()
+            except IndexError:
+                break
+            layer_id = key[1]
+            if hit:
+                nbytes = self._lru.pop(key, None)
+                if nbytes is not None:
+                    self._lru[key] = nbytes
+            if layer_id is None:
+                if hit:
+                    self.tileHits += 1
+                else:
+                    self.tileMisses += 1
+            elif layer_id is not _blendBase:
+                if hit:
+                    self.layerHits += 1
+                else:
+                    self.layerMisses += 1
+
+    def _account( self, key, img ):
+        '''Update the memory bookkeeping for a (re)placed image.
+
+        Must be called with the lock held.
+
+        '''
+        self._applyReadLog()
+        self._memoryUsage -= self._lru.pop(key, 0)
+        if img is not None:
+            nbytes = img.byteCount()
+            self._lru[key] = nbytes
+            self._memoryUsage += nbytes
+        self._evict()
+
+    def _evict( self ):
+        # never evict the most recently used image, even if it alone
+        # exceeds the memory limit
+        while self._maxmemory is not None and \
+              self._memoryUsage > self._maxmemory and len(self._lru) > 1:
+            key, nbytes = self._lru.popitem(False)
+            self._memoryUsage -= nbytes
+            self.evictions += 1
+            stack_id, layer_id, tile_id = key
+            # the evicted image may still be in use, e.g. painted by the
+            # GUI, so it is not given back to the image pool
+            if layer_id is None:
+                self._tileCache.caches[stack_id][tile_id] = (None, 0.)
+                self._tileCacheDirty.caches[stack_id][tile_id] = True
+            elif layer_id is _blendBase:
+                self._blendCache.caches[stack_id][tile_id] = (None, (), ())
+            else:
+                self._layerCache.caches[stack_id][(layer_id, tile_id)] = None
+                self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = True
+                self._layerCacheDirtyRect.caches[stack_id][(layer_id, tile_id)] = None
+
+    def _forgetStack( self, stack_id ):
+        for key in [k for k in self._lru if k[0] == stack_id]:
+            self._memoryUsage -= self._lru.pop(key)
+
     def tile( self, stack_id, tile_id ):
-        return self._tileCache.caches[stack_id][tile_id]
+        tile = self._tileCache.get(stack_id, tile_id)
+        self._logRead((stack_id, None, tile_id), tile[0] is not None)
+        return tile
     @synchronous('_lock')
     def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
         if len(stack_visible) > 0:
@@ -289,7 +592,7 @@ class _TilesCache( object ):
             occluded = numpy.asarray(stack_occluded)
             visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
             if numpy.count_nonzero(visibleAndNotOccluded) > 0:
-                dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
+                dirty = numpy.asarray([self._layerCacheDirty.get(stack_id, (ims, tile_id))
                                        for ims in self._sims.viewImageSources()])
                 num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
                 denom = float(numpy.count_nonzero(visibleAndNotOccluded))
@@ -299,10 +602,10 @@ class _TilesCache( object ):
         else:
             progress = 1.0
         self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        self._account((stack_id, None, tile_id), img)
 
-    @synchronous('_lock')
     def tileDirty( self, stack_id, tile_id ):
-        return self._tileCacheDirty.caches[stack_id][tile_id]
+        return self._tileCacheDirty.get(stack_id, tile_id)
     @synchronous('_lock')
     def setTileDirty( self, stack_id, tile_id, b):
         self._tileCacheDirty.caches[stack_id][tile_id] = b
@@ -310,39 +613,99 @@ class _TilesCache( object ):
     def setTileDirtyAll( self, tile_id, b):
         for stack_id in self._tileCacheDirty.caches:
             self._tileCacheDirty.caches[stack_id][tile_id] = b
-
     @synchronous('_lock')
+    def setTilesDirtyAll( self, tile_ids, b ):
+        '''Mark the tiles tile_ids (not) dirty in all stacks.'''
+        tile_ids = numpy.asarray(tile_ids, dtype=numpy.intp)
+        for bitmap in self._tileCacheDirty.caches.values():
+            bitmap.setMany(tile_ids, b)
+    @synchronous('_lock')
+    def setAllTilesDirtyAll( self, b ):
+        '''Mark every tile of all stacks (not) dirty.'''
+        for bitmap in self._tileCacheDirty.caches.values():
+            bitmap.setAll(b)
+
     def layer(self, stack_id, layer_id, tile_id ):
-        return self._layerCache.caches[stack_id][(layer_id,tile_id)]
+        img = self._layerCache.get(stack_id, (layer_id,tile_id))
+        self._logRead((stack_id, layer_id, tile_id), img is not None)
+        return img
     @synchronous('_lock')
     def setLayer( self, stack_id, layer_id, tile_id, img ):
         self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
+        self._account((stack_id, layer_id, tile_id), img)
 
-    @synchronous('_lock')
     def layerDirty(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)]
+        return self._layerCacheDirty.get(stack_id, (layer_id, tile_id))
     @synchronous('_lock')
-    def setLayerDirty( self, stack_id, layer_id, tile_id, b ):
-        self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+    def setLayerDirty( self, stack_id, layer_id, tile_id, b, rect=None ):
+        self._setLayerDirty( stack_id, (layer_id, tile_id), b, rect )
     @synchronous('_lock')
-    def setLayerDirtyAll( self, layer_id, tile_id, b ):
+    def setLayerDirtyAll( self, layer_id, tile_id, b, rect=None ):
         for stack_id in self._layerCacheDirty.caches:
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+            self._setLayerDirty( stack_id, (layer_id, tile_id), b, rect )
+
+    def _setLayerDirty( self, stack_id, key, b, rect ):
+        '''Mark a layer patch (not) dirty. A rect (scene coordinates)
+        restricts the dirty part of a cached patch; it is united with
+        the part that is already dirty. Must be called with the lock
+        held.'''
+        dirtyRect = None
+        if b and rect is not None and self._layerCache.caches[stack_id].get(key) is not None:
+            if not self._layerCacheDirty.caches[stack_id][key]:
+                dirtyRect = rect
+            else:
+                dirtyRect = self._layerCacheDirtyRect.caches[stack_id].get(key)
+                if dirtyRect is not None:
+                    dirtyRect = dirtyRect.united(rect)
+        self._layerCacheDirty.caches[stack_id][key] = b
+        self._layerCacheDirtyRect.caches[stack_id][key] = dirtyRect
 
     @synchronous('_lock')
+    def setLayerTilesDirtyAll( self, layer_id, tileRects, b ):
+        '''Like setLayerDirtyAll() for many tiles; tileRects is a
+        sequence of (tile_id, rect).'''
+        for stack_id in self._layerCacheDirty.caches:
+            for tile_id, rect in tileRects:
+                self._setLayerDirty( stack_id, (layer_id, tile_id), b, rect )
+
+    def layerDirtyRect( self, stack_id, layer_id, tile_id ):
+        '''The dirty part (scene QRect) of a dirty layer patch, or None
+        if the whole patch needs to be refreshed.'''
+        return self._layerCacheDirtyRect.get(stack_id, (layer_id, tile_id))
+
     def layerTimestamp(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]
+        return self._layerCacheTimestamp.get(stack_id, (layer_id, tile_id))
     @synchronous('_lock')
     def setLayerTimestamp( self, stack_id, layer_id, tile_id, time):
         self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = time
 
+    def blendBase( self, stack_id, tile_id ):
+        '''Return (img, baseSignature, signature) for a tile.
+
+        img is the blend of the bottommost layers described by
+        baseSignature, signature describes all layers of the last
+        rendering of the tile (see TileProvider._renderTile).
+
+        '''
+        blend = self._blendCache.get(stack_id, tile_id)
+        self._logRead((stack_id, _blendBase, tile_id), blend[0] is not None)
+        return blend
+    @synchronous('_lock')
+    def setBlendBase( self, stack_id, tile_id, img, baseSignature, signature ):
+        self._blendCache.caches[stack_id][tile_id] = (img, baseSignature, signature)
+        self._account((stack_id, _blendBase, tile_id), img)
+
     @synchronous('_lock')
     def addStack( self, stack_id ):
-        self._tileCache.add( stack_id )
+        old_stack_id = self._tileCache.add( stack_id )
         self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
         self._layerCache.add( stack_id )
         self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
+        self._layerCacheDirtyRect.add( stack_id )
         self._layerCacheTimestamp.add( stack_id, default_factory=float )
+        self._blendCache.add( stack_id, default_factory=lambda: (None, (), ()) )
+        if old_stack_id is not None:
+            self._forgetStack( old_stack_id )
 
     @synchronous('_lock')
     def touchStack( self, stack_id ):
@@ -350,16 +713,150 @@ class _TilesCache( object ):
         self._tileCacheDirty.touch( stack_id )
         self._layerCache.touch( stack_id )
         self._layerCacheDirty.touch( stack_id )
+        self._layerCacheDirtyRect.touch( stack_id )
         self._layerCacheTimestamp.touch( stack_id )
+        self._blendCache.touch( stack_id )
 
     @synchronous('_lock')
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id,
                                req_timestamp, img):
+        '''Store the layer patch img, unless a more recent request has
+        already updated the layer tile. Returns whether img was stored.'''
         if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
             self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
             self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
+            self._layerCacheDirtyRect.caches[stack_id][(layer_id, tile_id)] = None
             self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
             self._tileCacheDirty.caches[stack_id][tile_id] = True
+            self._account((stack_id, layer_id, tile_id), img)
+            return True
+        return False
+
+
+class _RequestScheduler( object ):
+    '''
+    Priority queue of layer requests for the TileProvider workers.
+
+    Requests with a lower priority key are served first; among equal
+    keys the most recently scheduled request comes first, as in a
+    LifoQueue. Scheduling a request under the key of a queued one
+    cancels the queued request, since only the newer one can still
+    update the cache. Requests for which isLive(request) turns false,
+    e.g. because the user scrolled to another slice, are dropped on
+    dropStale() and when they are dequeued, before any work is done;
+    onDrop(request) is called for each dropped request, with the lock
+    of the scheduler held.
+
+    As with Queue.Queue, task_done() must be called for every dequeued
+    request; join() blocks until all requests are processed or dropped.
+
+    '''
+    def __init__( self, isLive, maxsize=0, onDrop=None ):
+        self._isLive = isLive
+        self._onDrop = onDrop
+        self._maxsize = maxsize
+        self._heap = []
+        self._queued = {}
+        self._seq = itertools.count()
+        self._unfinished = 0
+        self._mutex = Lock()
+        self._notEmpty = Condition(self._mutex)
+        self._allDone = Condition(self._mutex)
+
+        self.scheduled = 0
+        self.executed = 0
+        self.cancelled = 0
+        self.dropped = 0
+
+    def qsize( self ):
+        with self._mutex:
+            return len(self._queued)
+
+    def put_nowait( self, request, priority, key ):
+        with self._mutex:
+            old = self._queued.pop(key, None)
+            if old is not None:
+                old[-1] = None
+                self.cancelled += 1
+                self._taskDone()
+            elif self._maxsize > 0 and len(self._queued) >= self._maxsize:
+                raise Full
+            entry = [priority, -next(self._seq), key, request]
+            heapq.heappush(self._heap, entry)
+            self._queued[key] = entry
+            self._unfinished += 1
+            self.scheduled += 1
+            self._notEmpty.notify()
+
+    def get_nowait( self ):
+        return self.get(False)
+
+    def get( self, block=True, timeout=None ):
+        with self._mutex:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                while self._heap:
+                    priority, seq, key, request = heapq.heappop(self._heap)
+                    if request is None:
+                        continue
+                    del self._queued[key]
+                    if not self._isLive(request):
+                        self._drop(request)
+                        continue
+                    self.executed += 1
+                    return request
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self._notEmpty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._notEmpty.wait(remaining)
+
+    def task_done( self ):
+        with self._mutex:
+            self._taskDone()
+
+    def join( self ):
+        with self._mutex:
+            while self._unfinished:
+                self._allDone.wait()
+
+    def dropStale( self ):
+        '''Drop all queued requests that are no longer live.'''
+        with self._mutex:
+            for entry in self._heap:
+                request = entry[-1]
+                if request is not None and not self._isLive(request):
+                    entry[-1] = None
+                    del self._queued[entry[2]]
+                    self._drop(request)
+            self._heap = [entry for entry in self._heap if entry[-1] is not None]
+            heapq.heapify(self._heap)
+
+    def statistics( self ):
+        with self._mutex:
+            return {'queued': len(self._queued),
+                    'scheduled': self.scheduled,
+                    'executed': self.executed,
+                    'cancelled': self.cancelled,
+                    'dropped': self.dropped}
+
+    def _drop( self, request ):
+        # call with self._mutex held
+        self.dropped += 1
+        if self._onDrop is not None:
+            self._onDrop(request)
+        self._taskDone()
+
+    def _taskDone( self ):
+        # call with self._mutex held
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._allDone.notify_all()
 
 
 class TileProvider( QObject ):
@@ -367,6 +864,7 @@ class TileProvider( QObject ):
 
     Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling')
     sceneRectChanged = pyqtSignal( QRectF )
+    metricsUpdated = pyqtSignal( object )
 
 
     '''TileProvider __init__
@@ -375,14 +873,36 @@ class TileProvider( QObject ):
     cache_size                -- maximal number of encountered stacks
                                  to cache, i.e. slices if the imagesources
                                  draw from slicesources (default 10)
-    request_queue_size        -- maximal number of request to queue up (default 100000)
+    cache_memory              -- maximal number of bytes occupied by cached tiles and
+                                 layer patches; least recently used images are evicted
+                                 first (default: 'cache_memory_mb' in the [tiling]
+                                 section of ~/.voluminarc)
+    request_queue_size        -- maximal number of request to queue up (default 100000);
+                                 requests are served in order of visibility, distance
+                                 to the center of the last refreshed rect and layer
+                                 cost (averageTimePerTile), requests for stacks no
+                                 longer shown or prefetched are dropped
     n_threads                 -- maximal number of request threads; this determines the
                                  maximal number of simultaneously running requests
                                  to the pixelpipeline (default: 2)
     layerIdChange_means_dirty -- layerId changes invalidate the cache; by default only
                                  stackId changes do that (default False)
+    incremental_compositing   -- keep the blend of the layers below the most recently
+                                 changed one, so that a repeatedly updated layer (e.g.
+                                 while painting labels) is composited without
+                                 re-blending the whole stack (default True)
+    compositor                -- how layer patches are blended: 'qpainter', 'numpy' or
+                                 a volumina.compositing.Compositor instance
+                                 (default: 'compositor' in the [tiling] section
+                                 of ~/.voluminarc)
     parent                    -- QObject
 
+    Metrics:
+    The time spent in each stage of the pipeline is recorded in ring
+    buffers; see metricsSnapshot(). At most every 'interval' seconds
+    ([metrics] section of ~/.voluminarc) the snapshot is emitted with
+    metricsUpdated while tiles are rendered.
+
     '''
 
     @property
@@ -397,8 +917,9 @@ class TileProvider( QObject ):
     _global_instance_list = []
 
     def __init__( self, tiling, stackedImageSources, cache_size=100,
-                  request_queue_size=100000, n_threads=2,
-                  layerIdChange_means_dirty=False, parent=None ):
+                  cache_memory=None, request_queue_size=100000, n_threads=2,
+                  layerIdChange_means_dirty=False, incremental_compositing=True,
+                  compositor=None, parent=None ):
         QObject.__init__( self, parent = parent )
 
         # Used for thread debug names
@@ -410,16 +931,42 @@ class TileProvider( QObject ):
         self.axesSwapped = False
         self._sims = stackedImageSources
         self._cache_size = cache_size
+        if cache_memory is None:
+            cache_memory = cfg.getint('tiling', 'cache_memory_mb') * 2**20
+        self._cache_memory = cache_memory
         self._request_queue_size = request_queue_size
         self._n_threads = n_threads
         self._layerIdChange_means_dirty = layerIdChange_means_dirty
-
-        self._current_stack_id = self._sims.stackId
+        self._incrementalCompositing = incremental_compositing
+        if compositor is None:
+            compositor = cfg.get('tiling', 'compositor')
+        self._compositor = createCompositor(compositor)
+
+        # the pyramid level is the last entry of the stack id, so that
+        # each level is cached separately
+        self._level = 0
+        self._current_stack_id = self._levelStackId( self._sims.stackId )
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
-
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+                                  maxstacks=self._cache_size,
+                                  maxmemory=self._cache_memory)
+        # caches of other tilings of the slice, by block size
+        self._inactiveTilings = {}
+
+        self._viewportRect = None
+        self._prefetchStacks = set()
+        self._dirtyLayerQueue = _RequestScheduler(self._isLiveRequest, self._request_queue_size,
+                                                  self._onRequestDropped)
+        self._prefetchQueue = _RequestScheduler(self._isLivePrefetch, self._request_queue_size,
+                                                self._onRequestDropped)
+
+        # requests the workers are currently waiting for, by id(image_req)
+        self._inFlight = {}
+        self._inFlightLock = Lock()
+        self._cancelledInFlight = 0
+
+        self.metrics = Metrics()
+        self._metricsInterval = cfg.getfloat('metrics', 'interval')
+        self._lastMetricsUpdate = time.time()
 
         self._sims.layerDirty.connect(self._onLayerDirty)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
@@ -446,18 +993,30 @@ class TileProvider( QObject ):
         tiles may be already (partially) updated. If you want to wait
         until the rendering is fully complete, call join().
 
+        After a switch of the tiling (see setTiling()), tiles of the
+        previous tiling are returned first for the regions that are not
+        rendered yet; their 'tiling' is not the current tiling.
+
         '''
         self.requestRefresh( rectF )
         tile_nos = self.tiling.intersected( rectF )
         stack_id = self._current_stack_id
+        tiles = []
+        missing = QRectF()
         for tile_no in tile_nos:
             qimg, progress = self._cache.tile(stack_id, tile_no)
-            yield TileProvider.Tile(
-                tile_no,
-                qimg,
-                QRectF(self.tiling.imageRects[tile_no]),
-                progress,
-                self.tiling)
+            if qimg is None and self.tiling.maxLevel > 0:
+                qimg = self._otherLevelTile(stack_id, tile_no)
+            rectF = QRectF(self.tiling.imageRects[tile_no])
+            if qimg is None:
+                missing = missing.united(rectF)
+            tiles.append(TileProvider.Tile(tile_no, qimg, rectF, progress, self.tiling))
+
+        if not missing.isEmpty():
+            for tile in self._inactiveTiles(stack_id, missing):
+                yield tile
+        for tile in tiles:
+            yield tile
 
     def requestRefresh( self, rectF ):
         '''Requests tiles to be refreshed.
@@ -466,6 +1025,8 @@ class TileProvider( QObject ):
         the end of the rendering.
 
         '''
+        if rectF.isValid():
+            self._viewportRect = QRectF(rectF)
         tile_nos = self.tiling.intersected( rectF )
         for tile_no in tile_nos:
             stack_id = self._current_stack_id
@@ -482,7 +1043,8 @@ class TileProvider( QObject ):
 
         '''
         if self._cache_size > 1:
-            stack_id = (self._current_stack_id[0], enumerate(through))
+            stack_id = (self._current_stack_id[0], enumerate(through), self._level)
+            self._prefetchStacks.add(stack_id)
             if stack_id not in self._cache:
                 self._cache.addStack(stack_id)
                 self._cache.touchStack( self._current_stack_id )
@@ -490,6 +1052,50 @@ class TileProvider( QObject ):
             for tile_no in tile_nos:
                 self._refreshTile( stack_id, tile_no, prefetch=True )
 
+    def setTiling( self, tiling ):
+        '''Switch to another tiling of the same slice, e.g. with another
+        block size (see Tiling.chooseBlockSize()).
+
+        The cache of the previous tiling is kept, with a quarter of the
+        memory budget, and stays subject to dirty notifications, so
+        switching back reuses its tiles. Caches of older tilings are
+        dropped, so that all caches together stay within the budget.
+
+        '''
+        if tiling is self.tiling:
+            return
+        inactiveMemory = self._cache_memory // 4
+        previous = self._inactiveTilings.get(tiling.blockSize)
+        self._cache.setMaxMemory(inactiveMemory)
+        self._inactiveTilings = {self.tiling.blockSize: (self.tiling, self._cache)}
+        if previous is not None and previous[0] is tiling:
+            cache = previous[1]
+            cache.setMaxMemory(self._cache_memory - inactiveMemory)
+        else:
+            cache = _TilesCache(self._current_stack_id, self._sims,
+                                maxstacks=self._cache_size,
+                                maxmemory=self._cache_memory - inactiveMemory)
+        self.tiling = tiling
+        self._cache = cache
+        self._setCurrentStack( self._current_stack_id )
+        self.sceneRectChanged.emit(QRectF())
+
+    @property
+    def level( self ):
+        return self._level
+
+    def setLevel( self, level ):
+        '''Render at pyramid level 'level' (see Tiling.levelForScale()).
+
+        Tiles of the previous level are shown until the tiles of the new
+        level are rendered.
+
+        '''
+        level = max(0, min(level, self.tiling.maxLevel))
+        if level != self._level:
+            self._level = level
+            self._setCurrentStack( self._levelStackId(self._current_stack_id) )
+
     def join( self ):
         '''Wait until all refresh request are processed.
 
@@ -499,6 +1105,82 @@ class TileProvider( QObject ):
         '''
         return self._dirtyLayerQueue.join()
 
+    def cacheStatistics( self ):
+        '''Return a dict with the memory usage and the hit, miss and
+        eviction counters of the tile cache.'''
+        return self._cache.statistics()
+
+    def tileOverhead( self ):
+        '''Return the measured overhead per tile, the mean time to
+        composite a tile, or None if no tile was composited yet.'''
+        try:
+            values = self.metrics.series('composite').values()[0]
+        except KeyError:
+            return None
+        if len(values) == 0:
+            return None
+        return float(values.mean())
+
+    def schedulerStatistics( self ):
+        '''Return a dict with the number of queued, scheduled, executed,
+        cancelled (superseded by a newer request for the same layer tile)
+        and dropped (stale) requests, for refresh and prefetch requests,
+        and the number of requests cancelled while a worker waited for
+        them.'''
+        return {'refresh': self._dirtyLayerQueue.statistics(),
+                'prefetch': self._prefetchQueue.statistics(),
+                'cancelledInFlight': self._cancelledInFlight}
+
+    def metricsSnapshot( self ):
+        '''Return a dict with the current performance metrics:
+
+        pipeline  -- composite time per tile, rendered tiles (with their
+                     rate per second) and depth of the request queue
+        layers    -- per layer (by name): time requests were queued,
+                     waited for data, converted the data to an image
+                     and, unless the image source is orientable,
+                     transformed the image to the scene
+        cache     -- cacheStatistics() and the tile and layer hit ratios
+        scheduler -- schedulerStatistics()
+        imagePool -- statistics of the shared image pool
+        requestCoalescer -- requests of datasources and how many of
+                     them shared an in-flight request
+
+        Times are in seconds. All values are JSON serializable, see
+        metricsJson().
+
+        '''
+        cache = self.cacheStatistics()
+        for kind in ('tile', 'layer'):
+            lookups = cache[kind + 'Hits'] + cache[kind + 'Misses']
+            cache[kind + 'HitRatio'] = cache[kind + 'Hits'] / float(lookups) if lookups else None
+
+        layers = {}
+        for ims in self._sims.viewImageSources():
+            metrics = getattr(ims, 'metrics', None)
+            if metrics is None:
+                continue
+            name = self._layerName(ims)
+            if name in layers:
+                name = "%s (%d)" % (name, len(layers))
+            layers[name] = metrics.snapshot()
+
+        return {'time': time.time(),
+                'pipeline': self.metrics.snapshot(),
+                'layers': layers,
+                'cache': cache,
+                'scheduler': self.schedulerStatistics(),
+                'imagePool': imagePool.statistics(),
+                'requestCoalescer': requestCoalescer.statistics()}
+
+    def metricsJson( self, **kwargs ):
+        '''Return metricsSnapshot() as JSON; kwargs are passed to json.dumps().'''
+        return json.dumps( self.metricsSnapshot(), **kwargs )
+
+    def _layerName( self, ims ):
+        layer = getattr(ims, '_layer', None)
+        name = getattr(layer, 'name', None) or str(ims.objectName()) or repr(ims)
+        return unicode(name)
 
     def notifyThreadsToStop( self ):
         '''Signals render threads to stop.
@@ -544,8 +1226,6 @@ class TileProvider( QObject ):
 
     def _dirtyLayersWorker( self ):
         while self._keepRendering:
-            # Save reference to the queue in case self._dirtyLayerQueue reassigned during this pass.
-            # See onSizeChanged()
             dirtyLayerQueue = self._dirtyLayerQueue
             prefetchQueue = self._prefetchQueue
 
@@ -570,7 +1250,10 @@ class TileProvider( QObject ):
                 #This avoids a lot of warnings.
                 continue
 
-            ims, transform, tile_nr, stack_id, image_req, timestamp, cache = result
+            ims, transform, tile_nr, stack_id, image_req, timestamp, cache, tiling, offset = result
+            with self._inFlightLock:
+                self._inFlight[id(image_req)] = [result, False]
+            self.metrics.record('queueDepth', queue.qsize())
             try:
                 try:
                     layerTimestamp = cache.layerTimestamp( stack_id, ims, tile_nr )
@@ -578,24 +1261,44 @@ class TileProvider( QObject ):
                     pass
                 else:
                     if timestamp > layerTimestamp:
+                        start = time.time()
+                        self._recordLayerTime(ims, 'queued', start - timestamp)
                         img = image_req.wait()
-                        img = img.transformed(transform)
+                        if self._inFlight[id(image_req)][1]:
+                            # cancelled; the layer tile stays dirty
+                            self._onRequestDropped(result)
+                            continue
+                        patch = self._transformed(ims, img, transform)
+                        self._timePerTile(ims, time.time()-start, patch.size())
+                        merged = None
                         try:
-                            cache.updateTileIfNecessary( stack_id, ims, tile_nr, timestamp, img )
+                            merged = self._merged(cache, stack_id, ims, tile_nr, patch, offset)
+                            updated = merged is not None and \
+                                      cache.updateTileIfNecessary( stack_id, ims, tile_nr, timestamp, merged )
                         except KeyError:
-                            pass
-                        else:
-                            if stack_id == self._current_stack_id and cache is self._cache:
-                                self.sceneRectChanged.emit(QRectF(self.tiling.imageRects[tile_nr]))
+                            updated = False
+                        if not updated:
+                            if merged is not None and merged is not patch:
+                                # the merged copy was never handed out
+                                imagePool.give(merged)
+                        elif stack_id == self._current_stack_id and cache is self._cache:
+                            self.sceneRectChanged.emit(QRectF(tiling.imageRects[tile_nr]))
             except:
-                with volumina.printLock:
-                    sys.excepthook( *sys.exc_info() )
+                # a cancelled request may fail when waited for
+                if self._inFlight[id(image_req)][1]:
+                    self._onRequestDropped(result)
+                else:
+                    with volumina.printLock:
+                        sys.excepthook( *sys.exc_info() )
                     # if hasattr( ims, '_layer' ):
                         # For debug, print out the layer name if possible
                         # sys.stderr.write("Error was encountered while requesting data from layer: "\
                         #                 "'{}'\n".format( ims._layer.name ) )
             finally:
+                with self._inFlightLock:
+                    del self._inFlight[id(image_req)]
                 queue.task_done()
+                self._publishMetrics()
 
     def _refreshTile( self, stack_id, tile_no, prefetch=False ):
         if not self.axesSwapped:
@@ -603,6 +1306,8 @@ class TileProvider( QObject ):
         else:
             transform = QTransform().rotate(90).scale(1,-1)
         transform *= self.tiling.data2scene
+        # orientable image sources deliver patches in scene orientation
+        orientation = axisOrientation(transform)
 
         try:
             if self._cache.tileDirty( stack_id, tile_no ):
@@ -619,9 +1324,11 @@ class TileProvider( QObject ):
                        and not self._sims.isOccluded(ims) \
                        and self._sims.isVisible(ims):
 
-                        rect = self.tiling.imageRects[tile_no]
+                        # only request the dirty part of a cached patch
+                        rect, offset = self._dirtyRegion(stack_id, ims, tile_no)
                         dataRect = self.tiling.scene2data.mapRect(rect)
-                        ims_req = ims.request(dataRect, stack_id[1])
+                        ims_req, ims_transform = self._request(ims, dataRect, stack_id,
+                                                               transform, orientation)
                         if ims.direct and not prefetch:
                             # The ImageSource 'ims' is fast (it has the
                             # direct flag set to true) so we process
@@ -631,26 +1338,30 @@ class TileProvider( QObject ):
                             start = time.time()
                             img = ims_req.wait()
 
-                            img = img.transformed(transform)
+                            patch = self._transformed(ims, img, ims_transform)
                             stop = time.time()
 
-                            ims._layer.timePerTile(stop-start,
-                                                   self.tiling.imageRects[tile_no])
+                            self._timePerTile(ims, stop-start, patch.size())
 
-                            self._cache.updateTileIfNecessary(
-                                stack_id, ims, tile_no, time.time(), img )
+                            patch = self._merged(self._cache, stack_id, ims, tile_no, patch, offset)
+                            if patch is not None:
+                                self._cache.updateTileIfNecessary(
+                                    stack_id, ims, tile_no, time.time(), patch )
                             img = self._renderTile( stack_id, tile_no )
                             self._cache.setTile(stack_id, tile_no,
                                                 img, self._sims.viewVisible(),
                                                 self._sims.viewOccluded() )
+                            self._publishMetrics()
                         else:
-                            req = (ims, transform, tile_no, stack_id,
-                                   ims_req, time.time(), self._cache)
+                            req = (ims, ims_transform, tile_no, stack_id,
+                                   ims_req, time.time(), self._cache, self.tiling, offset)
+                            priority = self._requestPriority( ims, tile_no, prefetch )
+                            key = (stack_id, ims, tile_no)
                             try:
                                 if prefetch:
-                                    self._prefetchQueue.put_nowait( req )
+                                    self._prefetchQueue.put_nowait( req, priority, key )
                                 else:
-                                    self._dirtyLayerQueue.put_nowait( req )
+                                    self._dirtyLayerQueue.put_nowait( req, priority, key )
                             except Full:
                                 msg = " ".join(("Request queue full.",
                                                 "Dropping tile refresh request.",
@@ -659,80 +1370,308 @@ class TileProvider( QObject ):
         except KeyError:
             pass
 
-    def _renderTile( self, stack_id, tile_nr): 
-        qimg = None
-        p = None
-        for i, v in enumerate(reversed(self._sims)):
-            visible, layerOpacity, layerImageSource = v
+    def _dirtyRegion( self, stack_id, ims, tile_no ):
+        '''Return the part of the image rect of a tile that has to be
+        requested for ims, and its offset (in pixels of the stack's
+        pyramid level) in the layer patch; the offset is None if the
+        whole patch is requested.
+
+        The dirty part is aligned to the pixels of the pyramid level, so
+        that the requested pixels coincide with those of the patch.'''
+        imageRect = self.tiling.imageRects[tile_no]
+        dirty = self._cache.layerDirtyRect(stack_id, ims, tile_no)
+        # partial patches are only merged if data and scene pixels match
+        if dirty is None or abs(self.tiling.data2scene.determinant()) != 1:
+            return imageRect, None
+        dirty = dirty.intersected(imageRect)
+        if dirty.isEmpty():
+            return imageRect, None
+        step = 2**stack_id[2]
+        x0, y0 = imageRect.x(), imageRect.y()
+        x1, y1 = x0 + imageRect.width(), y0 + imageRect.height()
+        left = x0 + (dirty.x() - x0) // step * step
+        top = y0 + (dirty.y() - y0) // step * step
+        right = min(x1, x0 + (dirty.x() + dirty.width() - x0 + step - 1) // step * step)
+        bottom = min(y1, y0 + (dirty.y() + dirty.height() - y0 + step - 1) // step * step)
+        rect = QRect(left, top, right - left, bottom - top)
+        if rect == imageRect:
+            return imageRect, None
+        return rect, ((left - x0) // step, (top - y0) // step)
+
+    def _merged( self, cache, stack_id, ims, tile_no, patch, offset ):
+        '''Return the layer patch with the partial patch (see
+        _dirtyRegion) pasted at offset into a copy of the cached patch.
+
+        If the cached patch is gone in the meantime, the layer patch is
+        marked dirty as a whole and None is returned.'''
+        if offset is None:
+            return patch
+        base = cache.layer(stack_id, ims, tile_no)
+        x, y = offset
+        w, h = patch.width(), patch.height()
+        if base is None or x + w > base.width() or y + h > base.height():
+            cache.setLayerDirty(stack_id, ims, tile_no, True)
+            if stack_id == self._current_stack_id and cache is self._cache:
+                self.sceneRectChanged.emit(QRectF(self.tiling.imageRects[tile_no]))
+            return None
+        merged = self._copy(base)
+        if patch.format() != merged.format():
+            patch = patch.convertToFormat(merged.format())
+        raw_view(merged)[y:y+h, x:x+w] = raw_view(patch)
+        return merged
+
+    def _requestPriority( self, ims, tile_no, prefetch ):
+        # visible tiles first, then the other refreshed tiles and
+        # finally the prefetched ones; within each class, by distance
+        # from the viewport center (in tiles) and the cost of the layer
+        rect = QRectF(self.tiling.imageRects[tile_no])
+        viewport = self._viewportRect
+        if prefetch:
+            visibility = 2
+        elif viewport is None or rect.intersects(viewport):
+            visibility = 0
+        else:
+            visibility = 1
+        distance = 0
+        if viewport is not None:
+            d = rect.center() - viewport.center()
+            distance = int((d.x()**2 + d.y()**2)**0.5 / self.tiling.blockSize)
+        cost = getattr(getattr(ims, '_layer', None), 'averageTimePerTile', 0.0)
+        return (visibility, distance, cost)
+
+    def _request( self, ims, dataRect, stack_id, transform, orientation ):
+        '''Request the patch of ims; returns the request and the transform
+        that remains to be applied to its image (None if the image source
+        already delivers it in scene orientation).'''
+        args = (dataRect, stack_id[1])
+        if stack_id[2] > 0:
+            args += (stack_id[2],)
+        if orientation is not None and getattr(ims, 'orientable', False):
+            return ims.request(*args, orientation=orientation), None
+        return ims.request(*args), transform
+
+    def _transformed( self, ims, img, transform ):
+        if transform is None:
+            return img
+        start = time.time()
+        img = img.transformed(transform)
+        self._recordLayerTime(ims, 'transform', time.time() - start)
+        return img
+
+    def _recordLayerTime( self, ims, name, seconds ):
+        metrics = getattr(ims, 'metrics', None)
+        if metrics is not None:
+            metrics.record(name, seconds)
+
+    def _publishMetrics( self ):
+        now = time.time()
+        if 0 < self._metricsInterval <= now - self._lastMetricsUpdate:
+            self._lastMetricsUpdate = now
+            self.metricsUpdated.emit( self.metricsSnapshot() )
+
+    def _timePerTile( self, ims, seconds, size ):
+        layer = getattr(ims, '_layer', None)
+        if layer is not None and hasattr(layer, 'timePerTile'):
+            layer.timePerTile(seconds, QRect(QPoint(0,0), size))
+
+    def _isLiveRequest( self, req ):
+        ims, transform, tile_nr, stack_id, image_req, timestamp, cache, tiling, offset = req
+        return stack_id == self._current_stack_id and cache is self._cache
+
+    def _isLivePrefetch( self, req ):
+        ims, transform, tile_nr, stack_id, image_req, timestamp, cache, tiling, offset = req
+        return stack_id in self._prefetchStacks and cache is self._cache
+
+    def _onRequestDropped( self, req ):
+        # _refreshTile cleared the dirty flag of the tile when it queued
+        # the request; set it again for dropped and cancelled requests,
+        # so that the layer tile, which stays dirty, is requested again
+        # when the stack is shown
+        ims, transform, tile_nr, stack_id, image_req, timestamp, cache, tiling, offset = req
+        try:
+            cache.setTileDirty(stack_id, tile_nr, True)
+        except KeyError:
+            pass
+
+    def _cancelStale( self ):
+        # drop queued requests for stacks that are no longer needed and
+        # cancel those the workers are already waiting for, down to the
+        # data source
+        self._dirtyLayerQueue.dropStale()
+        self._prefetchQueue.dropStale()
+        with self._inFlightLock:
+            for entry in self._inFlight.itervalues():
+                req, cancelled = entry
+                if cancelled or self._isLiveRequest(req) or self._isLivePrefetch(req):
+                    continue
+                image_req = req[4]
+                if hasattr(image_req, 'cancel'):
+                    entry[1] = True
+                    self._cancelledInFlight += 1
+                    image_req.cancel()
+
+    def _renderTile( self, stack_id, tile_nr ):
+        start = time.time()
+        qimg = self._compositeTile( stack_id, tile_nr )
+        if qimg is not None:
+            self.metrics.record('composite', time.time() - start)
+            self.metrics.mark('tiles')
+        return qimg
+
+    def _compositeTile( self, stack_id, tile_nr ):
+        # visible layer patches from bottom to top
+        layers = []
+        for visible, layerOpacity, layerImageSource in reversed(self._sims):
             if not visible:
                 continue
-
             patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
             if patch is not None:
-                if qimg is None:
-                    qimg = QImage(self.tiling.imageRects[tile_nr].size(), QImage.Format_ARGB32_Premultiplied)
-                    qimg.fill(0xffffffff) # Use a hex constant instead.
-                    p = QPainter(qimg)
-                p.setOpacity(layerOpacity)
-                p.drawImage(0,0, patch)
-        
-        if p is not None:
-            p.end()
+                layers.append((layerImageSource, layerOpacity, patch))
+
+        if not layers:
+            return None
+
+        if not self._incrementalCompositing:
+            qimg = self._newCanvas(tile_nr, stack_id[2])
+            self._blend(qimg, layers)
+            return qimg
+
+        # The signature identifies the content of every blended layer.
+        # By comparing it to the signature of the previous rendering,
+        # we find the bottommost layer that has changed; the blend of
+        # the layers below it is kept, so that the next update of the
+        # same layer only needs to blend it and the layers above.
+        signature = tuple((ims, opacity, patch.cacheKey()) for ims, opacity, patch in layers)
+        base, baseSignature, lastSignature = self._cache.blendBase(stack_id, tile_nr)
+        firstChanged = _commonPrefixLength(signature, lastSignature)
+
+        start = 0
+        if base is not None and baseSignature == signature[:len(baseSignature)]:
+            start = len(baseSignature)
+            qimg = self._copy(base)
+        else:
+            base, baseSignature = None, ()
+            qimg = self._newCanvas(tile_nr, stack_id[2])
 
+        if start < firstChanged < len(layers):
+            self._blend(qimg, layers[start:firstChanged])
+            base, baseSignature = self._copy(qimg), signature[:firstChanged]
+            start = firstChanged
+        self._blend(qimg, layers[start:])
+
+        self._cache.setBlendBase(stack_id, tile_nr, base, baseSignature, signature)
         return qimg
-    
+
+    def _newCanvas( self, tile_nr, level ):
+        return self._compositor.newCanvas(self.tiling.levelSize(tile_nr, level))
+
+    def _copy( self, qimg ):
+        copy = imagePool.take(qimg.width(), qimg.height(), qimg.format())
+        raw_view(copy)[...] = raw_view(qimg)
+        return copy
+
+    def _blend( self, qimg, layers ):
+        self._compositor.blend(qimg, [(opacity, patch) for ims, opacity, patch in layers])
+
     def _onLayerDirty(self, dirtyImgSrc, dataRect ):
         sceneRect = self.tiling.data2scene.mapRect(dataRect)
         if dirtyImgSrc in self._sims.viewImageSources():
             visibleAndNotOccluded = self._sims.isVisible( dirtyImgSrc ) \
                                     and not self._sims.isOccluded( dirtyImgSrc )
-            for tile_no in xrange(len(self.tiling)):
+            for tiling, cache in self._tilingsAndCaches():
                 # an invalid rect means everything is dirty
-                if not sceneRect.isValid() \
-                   or self.tiling.tileRects[tile_no].intersected( sceneRect ):
-                    for ims in self._sims.viewImageSources():
-                        self._cache.setLayerDirtyAll(ims, tile_no, True)
-                    if visibleAndNotOccluded:
-                        self._cache.setTileDirtyAll(tile_no, True)
+                if sceneRect.isValid():
+                    # image rects extend beyond the patches by the overlap
+                    o = tiling.overlap
+                    tiles = tiling.intersected( QRectF(sceneRect.adjusted(-o, -o, o, o)) )
+                else:
+                    tiles = xrange(len(tiling))
+                tileRects = []
+                for tile_no in tiles:
+                    rect = None
+                    if sceneRect.isValid():
+                        rect = sceneRect.intersected( tiling.imageRects[tile_no] )
+                        if rect.isEmpty():
+                            continue
+                    tileRects.append((tile_no, rect))
+                # only the changed layer needs to be requested again,
+                # and only within rect
+                cache.setLayerTilesDirtyAll(dirtyImgSrc, tileRects, True)
+                if visibleAndNotOccluded:
+                    cache.setTilesDirtyAll([tile_no for tile_no, rect in tileRects], True)
             if visibleAndNotOccluded:
                 self.sceneRectChanged.emit( QRectF(sceneRect) )
 
     def _onStackIdChanged( self, oldId, newId ):
-        if newId in self._cache:
-            self._cache.touchStack( newId )
-        else:
-            self._cache.addStack( newId )
-        self._current_stack_id = newId
-        self._prefetchQueue = Queue(self._request_queue_size)
+        self._setCurrentStack( self._levelStackId(newId) )
         self.sceneRectChanged.emit(QRectF())
 
+    def _setCurrentStack( self, stack_id ):
+        if stack_id in self._cache:
+            self._cache.touchStack( stack_id )
+        else:
+            self._cache.addStack( stack_id )
+        self._current_stack_id = stack_id
+        self._prefetchStacks = set()
+        self._cancelStale()
+
+    def _levelStackId( self, stack_id ):
+        return tuple(stack_id[:2]) + (self._level,)
+
+    def _inactiveTiles( self, stack_id, rectF ):
+        # cached tiles of inactive tilings within rectF
+        for tiling, cache in self._inactiveTilings.values():
+            if stack_id not in cache:
+                continue
+            for tile_no in tiling.intersected( rectF ):
+                qimg, progress = cache.tile(stack_id, tile_no)
+                if qimg is not None:
+                    yield TileProvider.Tile(tile_no, qimg, QRectF(tiling.imageRects[tile_no]),
+                                            progress, tiling)
+
+    def _otherLevelTile( self, stack_id, tile_no ):
+        # the cached tile of the nearest other level, if any
+        levels = sorted(xrange(self.tiling.maxLevel+1), key=lambda l: abs(l-stack_id[2]))
+        for level in levels[1:]:
+            other = stack_id[:2] + (level,)
+            if other in self._cache:
+                qimg = self._cache.tile(other, tile_no)[0]
+                if qimg is not None:
+                    return qimg
+
     def _onLayerIdChanged( self, ims, oldId, newId ):
         if self._layerIdChange_means_dirty:
             self._onLayerDirty( ims, QRect() )
 
     def _onVisibleChanged(self, ims, visible):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
         if not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onOpacityChanged(self, ims, opacity):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
         if self._sims.isVisible( ims ) and not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onSizeChanged(self):
+        self._inactiveTilings = {}
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+                                  maxstacks=self._cache_size,
+                                  maxmemory=self._cache_memory)
+        self._cancelStale()
         self.sceneRectChanged.emit(QRectF())
 
     def _onOrderChanged(self):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._setAllTilesDirty()
         self.sceneRectChanged.emit(QRectF())
+
+    def _setAllTilesDirty(self):
+        for tiling, cache in self._tilingsAndCaches():
+            cache.setAllTilesDirtyAll(True)
+
+    def _tilingsAndCaches(self):
+        # the current tiling first, then the inactive ones
+        return [(self.tiling, self._cache)] + self._inactiveTilings.values()
     
     @classmethod
     def _stopAllWorkerThreads(cls):
@@ -81,6 +81,9 @@ class ClickableSegmentationLayer(QObject):
         layer.colortableIsRandom = True
         self.layer = layer
         self.relabelingSource = source
+        #index the blocks of the labels in the background, so that
+        #toggling a label only repaints the blocks that contain it
+        source.labelIndex(wait=False)
 
     def setMaxLabel(self, l):
         self._M = l
@@ -97,6 +100,15 @@ class ClickableSegmentationLayer(QObject):
         color = QColor.fromRgba(color)
         return color
     
+    def labelBoundingBox(self, label):
+        """ return the smallest 5D slicing that contains object 'label',
+            or None if it does not occur or the label index is still
+            being computed in the background """
+        index = self.relabelingSource.labelIndex(wait=False)
+        if index is None:
+            return None
+        return index.boundingBox(label)
+
     def labelShown(self, label):
         return label in self._clickedObjects
 